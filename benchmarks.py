@@ -0,0 +1,308 @@
+"""
+Accuracy and speed checks for the surface pipeline.
+
+Each function prints a short report and returns the numbers as a dict, so it
+can be run interactively against a real measurement folder, e.g.::
+
+    from interferometer.benchmarks import compare_precision
+    compare_precision(folder, clear_outer, clear_inner, Z)
+"""
+
+import time
+import tracemalloc
+import numpy as np
+
+try:
+    from .nan_fill import fill_nans, FILL_METHODS
+    from .resampling import resampling_operator, match_zernike_basis
+    from .zernike_fit import fit_zernike, clear_fit_operators, decompose_surfaces
+    from .data_loader import load_measurements, FLOAT32_TOLERANCE_UM
+    from .surface_processing import read_genraw_data, preprocess_frame, measure_h5_circle, format_data_from_avg_circle, format_stack_from_avg_circle, prepare_surface, radial_averaged_surface, SurfaceProducts, SURFACE_PRESETS, resolve_grid_size, define_pupil_using_optimization, continuous_pupil_merit_function, hough_image, define_pupil_hough
+    from .pupil_fitting import define_pupil_analytic, IntegralPupilMerit, define_pupil_pyramid, define_pupil_hough_parallel
+except ImportError:
+    from nan_fill import fill_nans, FILL_METHODS
+    from resampling import resampling_operator, match_zernike_basis
+    from zernike_fit import fit_zernike, clear_fit_operators, decompose_surfaces
+    from data_loader import load_measurements, FLOAT32_TOLERANCE_UM
+    from surface_processing import read_genraw_data, preprocess_frame, measure_h5_circle, format_data_from_avg_circle, format_stack_from_avg_circle, prepare_surface, radial_averaged_surface, SurfaceProducts, SURFACE_PRESETS, resolve_grid_size, define_pupil_using_optimization, continuous_pupil_merit_function, hough_image, define_pupil_hough
+    from pupil_fitting import define_pupil_analytic, IntegralPupilMerit, define_pupil_pyramid, define_pupil_hough_parallel
+
+def _timed(func, *args, **kwargs):
+    #Run func once, returning (result, seconds, peak traced memory in bytes)
+    tracemalloc.start()
+    tic = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - tic
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def _rms(vals):
+    vals = vals[~np.isnan(vals)]
+    return np.sqrt(np.mean(vals**2)) if len(vals) > 0 else 0.0
+
+def compare_precision(folder, clear_outer, clear_inner, Z, ID_crop=1.25):
+    #Process a measurement folder in float64 and float32 and compare the averaged surfaces
+    ref, t64, mem64 = _timed(load_measurements, folder, clear_outer, clear_inner, Z, ID_crop, use_cache=False)
+    test, t32, mem32 = _timed(load_measurements, folder, clear_outer, clear_inner, Z, ID_crop, use_cache=False, dtype=np.float32)
+
+    delta = test.astype(np.float64) - ref
+    max_error = np.nanmax(np.abs(delta))
+    report = {
+        'float64_s': t64, 'float32_s': t32,
+        'float64_peak_MB': mem64 / 1e6, 'float32_peak_MB': mem32 / 1e6,
+        'max_error_um': max_error, 'rms_error_um': _rms(delta),
+        'within_tolerance': bool(max_error <= FLOAT32_TOLERANCE_UM),
+    }
+    print(f"float64: {t64:.2f} s, {mem64 / 1e6:.1f} MB peak | float32: {t32:.2f} s, {mem32 / 1e6:.1f} MB peak")
+    print(f"max |float32 - float64| = {max_error * 1e3:.4f} nm, rms = {report['rms_error_um'] * 1e3:.4f} nm "
+          f"(tolerance {FLOAT32_TOLERANCE_UM * 1e3:.2f} nm)")
+    return report
+
+def compare_pupil_fit(files, refine=True):
+    #Fit the pupil of each frame with Nelder-Mead and the analytic edge fit; report speed and agreement
+    t_opt, t_fit, deltas = [], [], []
+    for path in files:
+        data, valid = preprocess_frame(read_genraw_data(path))
+        tic = time.perf_counter()
+        ref = define_pupil_using_optimization(data)
+        t_opt.append(time.perf_counter() - tic)
+        tic = time.perf_counter()
+        fit = define_pupil_analytic(data, refine=refine)
+        t_fit.append(time.perf_counter() - tic)
+        deltas.append(np.asarray(fit) - np.asarray(ref))
+
+    deltas = np.abs(deltas)
+    report = {
+        'optimizer_s': float(np.mean(t_opt)), 'analytic_s': float(np.mean(t_fit)),
+        'speedup': float(np.sum(t_opt) / np.sum(t_fit)),
+        'max_center_error_px': float(np.max(deltas[:, :2])), 'max_radius_error_px': float(np.max(deltas[:, 2])),
+    }
+    print(f"Nelder-Mead: {report['optimizer_s'] * 1e3:.1f} ms/frame | analytic: {report['analytic_s'] * 1e3:.2f} ms/frame "
+          f"({report['speedup']:.0f}x faster)")
+    print(f"max |analytic - Nelder-Mead|: center {report['max_center_error_px']:.3f} px, radius {report['max_radius_error_px']:.3f} px")
+    return report
+
+def merit_evaluation_rate(path, n_evals=200, seed=0):
+    #Evaluations per second of the full-image and integral pupil merit functions on random candidates
+    data, valid = preprocess_frame(read_genraw_data(path))
+    thresh_image = valid.astype(float)
+    rng = np.random.default_rng(seed)
+    size = thresh_image.shape[0]
+    candidates = np.column_stack([rng.uniform(0.3, 0.7, n_evals) * size, rng.uniform(0.3, 0.7, n_evals) * size,
+                                  rng.uniform(0.2, 0.45, n_evals) * size])
+
+    tic = time.perf_counter()
+    full = [continuous_pupil_merit_function(xyr, thresh_image) for xyr in candidates]
+    t_full = time.perf_counter() - tic
+    tic = time.perf_counter()
+    merit = IntegralPupilMerit(thresh_image)
+    fast = [merit(xyr) for xyr in candidates]
+    t_fast = time.perf_counter() - tic
+
+    report = {'full_evals_per_s': n_evals / t_full, 'integral_evals_per_s': n_evals / t_fast,
+              'max_abs_difference': float(np.max(np.abs(np.subtract(full, fast))))}
+    print(f"full-image merit: {report['full_evals_per_s']:.0f} evals/s | integral merit: {report['integral_evals_per_s']:.0f} evals/s "
+          f"(includes setup), max |difference| = {report['max_abs_difference']:.2e}")
+    return report
+
+def compare_pyramid_search(files):
+    #Full-resolution pupil searches against their coarse-to-fine pyramid versions, per frame
+    searches = {
+        'optimizer (full merit)': lambda data: define_pupil_using_optimization(data, merit='full'),
+        'optimizer (integral merit)': define_pupil_using_optimization,
+        'pyramid optimizer': lambda data: define_pupil_pyramid(data, coarse='optimizer'),
+        'pyramid hough': lambda data: define_pupil_pyramid(data, coarse='hough'),
+    }
+    frames = [preprocess_frame(read_genraw_data(path))[0] for path in files]
+    times = {name: [] for name in searches}
+    circles = {name: [] for name in searches}
+    for data in frames:
+        for name, search in searches.items():
+            tic = time.perf_counter()
+            circles[name].append(search(data))
+            times[name].append(time.perf_counter() - tic)
+
+    reference = np.asarray(circles['optimizer (full merit)'])
+    report = {}
+    for name in searches:
+        error = float(np.max(np.abs(np.asarray(circles[name]) - reference)))
+        report[name] = {'s_per_frame': float(np.mean(times[name])), 'max_error_px': error}
+        print(f"{name:>28}: {np.mean(times[name]) * 1e3:8.1f} ms/frame, max |delta| vs full-resolution optimizer {error:.3f} px")
+    return report
+
+def compare_hough(files):
+    #Retrying serial Hough detection against the single-pass threaded version: time and HoughCircles calls per frame
+    report = {}
+    for name, detect in [('serial', define_pupil_hough), ('parallel', define_pupil_hough_parallel)]:
+        times, calls, centers = [], [], []
+        for path in files:
+            data, valid = preprocess_frame(read_genraw_data(path))
+            rows = np.flatnonzero(valid.any(axis=1))
+            img = hough_image(data)
+            tic = time.perf_counter()
+            circles, n_calls = detect(img, rows[-1] - rows[0])
+            times.append(time.perf_counter() - tic)
+            calls.append(n_calls)
+            centers.append(np.median(circles, 0)[:2] if circles else [np.nan, np.nan])
+        report[name] = {'s_per_frame': float(np.mean(times)), 'calls_per_frame': float(np.mean(calls)), 'centers': np.asarray(centers)}
+        print(f"{name:>8} Hough: {np.mean(times) * 1e3:.1f} ms/frame, {np.mean(calls):.1f} HoughCircles calls/frame")
+    shift = np.nanmax(np.abs(report['serial']['centers'] - report['parallel']['centers']))
+    print(f"max center difference: {shift:.2f} px")
+    return report
+
+def _synthetic_crop(size, seed=0):
+    #Smooth random surface on a square crop with the holes of a real frame: outside the pupil,
+    #a central obscuration and a few dropouts. Returns (truth, holed)
+    rng = np.random.default_rng(seed)
+    u = np.linspace(-1, 1, size)
+    X, Y = np.meshgrid(u, u)
+    truth = np.zeros((size, size))
+    for n in range(1, 7):
+        for m in range(n + 1):
+            truth += rng.normal(scale=0.1 / n) * X**m * Y**(n - m)
+    truth += 0.02 * np.sin(6 * X + rng.uniform(0, 6)) * np.cos(5 * Y)
+
+    R = np.hypot(X, Y)
+    holes = (R > 0.99) | (R < 0.12)
+    for _ in range(5):
+        cx, cy = rng.uniform(-0.7, 0.7, 2)
+        holes |= np.hypot(X - cx, Y - cy) < rng.uniform(0.01, 0.04)
+    holed = truth.copy()
+    holed[holes] = np.nan
+    return truth, holed
+
+def compare_nan_fill(size=350, seeds=(0, 1, 2), border=3):
+    #Time and accuracy of each fill engine on synthetic crops. Errors are measured on the hole
+    #pixels within `border` pixels of valid data, the only ones that influence the resampling spline
+    from scipy.ndimage import binary_dilation
+    xs = ys = np.linspace(-1, 1, size)
+    report = {}
+    for method in FILL_METHODS:
+        times, errors = [], []
+        for seed in seeds:
+            truth, holed = _synthetic_crop(size, seed)
+            holes = np.isnan(holed)
+            near = holes & binary_dilation(~holes, iterations=border)
+            tic = time.perf_counter()
+            filled = fill_nans(holed, method, xs, ys)
+            times.append(time.perf_counter() - tic)
+            errors.append(_rms(filled[near] - truth[near]))
+        report[method] = {'s_per_frame': float(np.mean(times)), 'rms_error': float(np.mean(errors))}
+        print(f"{method:>24}: {np.mean(times) * 1e3:8.1f} ms/frame, rms error near holes {np.mean(errors):.2e}")
+    return report
+
+def compare_resampling(n_frames=10, crop_size=351, grid_size=500, seed=0):
+    #RectBivariateSpline per frame against the cached sparse operator, per frame and as one stack
+    from scipy import interpolate
+    rng = np.random.default_rng(seed)
+    frames = rng.standard_normal((n_frames, crop_size, crop_size))
+    xs = np.linspace(-1, 1, crop_size)
+    xi = np.linspace(-1, 1, grid_size)
+
+    tic = time.perf_counter()
+    ref = np.array([interpolate.RectBivariateSpline(xs, xs, frame)(xi, xi) for frame in frames])
+    t_spline = time.perf_counter() - tic
+    resampling_operator.cache_clear()
+    tic = time.perf_counter()
+    op = resampling_operator(crop_size, crop_size, 1.0, grid_size, 1.0)
+    t_build = time.perf_counter() - tic
+    tic = time.perf_counter()
+    single = np.array([op.apply(frame) for frame in frames])
+    t_single = time.perf_counter() - tic
+    tic = time.perf_counter()
+    stacked = op.apply(frames)
+    t_stack = time.perf_counter() - tic
+
+    report = {'spline_s_per_frame': t_spline / n_frames, 'build_s': t_build, 'operator_s_per_frame': t_single / n_frames,
+              'stack_s_per_frame': t_stack / n_frames,
+              'max_error': float(max(np.max(np.abs(single - ref)), np.max(np.abs(stacked - ref))))}
+    print(f"RectBivariateSpline: {report['spline_s_per_frame'] * 1e3:.1f} ms/frame | operator: build {t_build * 1e3:.1f} ms, "
+          f"{report['operator_s_per_frame'] * 1e3:.1f} ms/frame, stacked {report['stack_s_per_frame'] * 1e3:.1f} ms/frame "
+          f"| max |difference| {report['max_error']:.1e}")
+    return report
+
+def compare_grid_tiers(path, clear_outer, clear_inner, Z, tiers=('full', 'quick'), repeats=3):
+    #Format one frame at each grid tier: time per frame, surface RMS, fitted coefficients, and the RMS
+    #difference to the first tier's map sampled at the nearest pixel of each grid point
+    from shared.zernike_utils import get_M_and_C
+    data, circle_coord, ID = measure_h5_circle(path, use_optimizer=True)
+    report = {}
+    for tier in tiers:
+        grid_size = resolve_grid_size(tier)
+        Z_tier = match_zernike_basis(Z, grid_size)  # built once per session in the pipeline, so kept out of the timing
+        format_data_from_avg_circle(data, circle_coord, clear_outer, clear_inner, Z_tier, grid_size=grid_size)
+        tic = time.perf_counter()
+        for _ in range(repeats):
+            surface = format_data_from_avg_circle(data, circle_coord, clear_outer, clear_inner, Z_tier, grid_size=grid_size)[1]
+        seconds = (time.perf_counter() - tic) / repeats
+        coefs = np.asarray(get_M_and_C(surface, Z_tier)[1][2])
+        report[tier] = {'grid_size': grid_size, 's_per_frame': seconds, 'rms': _rms(surface), 'coefs': coefs, 'surface': surface}
+
+    ref = report[tiers[0]]['surface']
+    for tier in tiers:
+        entry = report[tier]
+        nearest = np.rint(np.linspace(0, len(ref) - 1, entry['grid_size'])).astype(int)
+        entry['rms_difference'] = _rms(entry.pop('surface') - ref[np.ix_(nearest, nearest)])
+        print(f"{tier:>6} ({entry['grid_size']}x{entry['grid_size']}): {entry['s_per_frame'] * 1e3:.0f} ms/frame, "
+              f"RMS {entry['rms'] * 1e3:.2f} nm, RMS difference to {tiers[0]} {entry['rms_difference'] * 1e3:.2f} nm")
+    return report
+
+def compare_stack_formatting(files, clear_outer, clear_inner, Z):
+    #Frames formatted one at a time against one format_stack_from_avg_circle call, with the session-averaged pupil
+    frames = [preprocess_frame(read_genraw_data(path))[0] for path in files]
+    circle = np.mean([measure_h5_circle(path, use_optimizer=True)[1] for path in files], axis=0)
+    single, t_single, peak_single = _timed(lambda: np.array([format_data_from_avg_circle(frame, circle, clear_outer, clear_inner, Z)[1] for frame in frames]))
+    (stacked, coefs), t_stack, peak_stack = _timed(format_stack_from_avg_circle, np.stack(frames), circle, clear_outer, clear_inner, Z)
+    report = {'frame_s_per_frame': t_single / len(frames), 'stack_s_per_frame': t_stack / len(frames),
+              'frame_peak_bytes': peak_single, 'stack_peak_bytes': peak_stack,
+              'max_difference': float(np.nanmax(np.abs(stacked - single))), 'coefs_shape': coefs.shape}
+    print(f"{len(frames)} frames: one at a time {report['frame_s_per_frame'] * 1e3:.0f} ms/frame ({peak_single / 1e6:.0f} MB peak) | "
+          f"stacked {report['stack_s_per_frame'] * 1e3:.0f} ms/frame ({peak_stack / 1e6:.0f} MB peak) "
+          f"| max |difference| {report['max_difference']:.1e}")
+    return report
+
+def compare_zernike_fit(surface, Z, repeats=5):
+    #Zernike_decomposition per call against the cached fit operator: first call (factoring) and repeated calls
+    from shared.zernike_utils import Zernike_decomposition
+    M = surface.flatten(), surface
+    clear_fit_operators()
+    ref, t_ref, _ = _timed(lambda: [Zernike_decomposition(Z, M, -1) for _ in range(repeats)])
+    first, t_first, _ = _timed(fit_zernike, Z, M)
+    cached, t_cached, _ = _timed(lambda: [fit_zernike(Z, M) for _ in range(repeats)])
+    report = {'decomposition_s': t_ref / repeats, 'operator_first_s': t_first, 'operator_s': t_cached / repeats,
+              'max_coefficient_difference': float(np.max(np.abs(np.asarray(cached[-1][2]) - np.asarray(ref[-1][2]))))}
+    print(f"Zernike_decomposition: {report['decomposition_s'] * 1e3:.0f} ms | fit operator: first {t_first * 1e3:.0f} ms, "
+          f"then {report['operator_s'] * 1e3:.1f} ms | max coefficient difference {report['max_coefficient_difference']:.1e}")
+    return report
+
+def compare_batch_decomposition(surfaces, Z):
+    #get_M_and_C per surface against one decompose_surfaces call (operators factored inside the timing)
+    from shared.zernike_utils import get_M_and_C
+    clear_fit_operators()
+    ref, t_ref, _ = _timed(lambda: np.array([get_M_and_C(surface, Z)[1][2] for surface in surfaces]))
+    (coefs, rms), t_batch, _ = _timed(decompose_surfaces, surfaces, Z, residual_rms=True)
+    report = {'per_surface_s': t_ref, 'batch_s': t_batch, 'max_coefficient_difference': float(np.nanmax(np.abs(coefs - ref)))}
+    print(f"{len(surfaces)} surfaces: get_M_and_C {t_ref:.2f} s | decompose_surfaces {t_batch:.2f} s (with residual RMS) "
+          f"| max coefficient difference {report['max_coefficient_difference']:.1e}")
+    return report
+
+def compare_surface_presets(surface, Z, config, crop_ca=False):
+    #prepare_surface per preset (as main used to) against one SurfaceProducts serving every preset
+    def per_preset():
+        return {name: prepare_surface(surface - radial_averaged_surface(surface, config) if subtract_radial else surface,
+                                      Z, remove_coef, config, crop_ca=crop_ca)
+                for name, (remove_coef, subtract_radial) in SURFACE_PRESETS.items()}
+    clear_fit_operators()
+    ref, t_ref, _ = _timed(per_preset)
+    clear_fit_operators()
+    products = SurfaceProducts(surface, Z, config)
+    new, t_new, _ = _timed(lambda: {name: products.preset(name, crop_ca) for name in SURFACE_PRESETS})
+    _, t_switch, _ = _timed(lambda: [products.preset(name, crop_ca) for name in SURFACE_PRESETS])
+    report = {'per_preset_s': t_ref, 'products_s': t_new, 'switch_s': t_switch,
+              'max_difference': max(float(np.nanmax(np.abs(new[name] - ref[name]))) for name in SURFACE_PRESETS)}
+    print(f"{len(SURFACE_PRESETS)} presets: prepare_surface each {t_ref:.2f} s | SurfaceProducts {t_new:.2f} s, "
+          f"then {t_switch * 1e3:.2f} ms to switch through them | max difference {report['max_difference']:.1e}")
+    return report
@@ -1,44 +1,269 @@
 import os
+import hashlib
 import numpy as np
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 try:
     # Try relative import (when run as part of package)
-    from .surface_processing import measure_h5_circle, format_data_from_avg_circle
+    from .surface_processing import measure_h5_circle, measure_frame_circle, format_data_from_avg_circle, format_stack_from_avg_circle, read_genraw_data, preprocess_frame, cast_zernike_basis, resolve_grid_size, FULL_GRID_SIZE
+    from .resampling import match_zernike_basis
+    from . import surface_cache
+    from . import zernike_store
+    from .session_archive import is_session_archive, read_archived_surface
+    from .session_index import session_path
 except ImportError:
     # Fall back to absolute import (when run directly)
-    from surface_processing import measure_h5_circle, format_data_from_avg_circle
-
-def load_measurements(folder, clear_outer, clear_inner, Z, ID_crop=1.25):
-    data_holder, coord_holder, ID_holder = [], [], []
-
-    for file in os.listdir(folder):
-        if file.endswith(".h5"):
-            data, circle_coord, ID = measure_h5_circle(os.path.join(folder, file), use_optimizer=True)
-            data_holder.append(data)
-            coord_holder.append(circle_coord)
-            ID_holder.append(ID)
-
-    avg_circle = np.mean(coord_holder, axis=0)
-    wf_maps = [
-        format_data_from_avg_circle(data, avg_circle, clear_outer, clear_inner*ID_crop, Z, normal_tip_tilt_power=True)[1]
-        for data in data_holder
-    ]
+    from surface_processing import measure_h5_circle, measure_frame_circle, format_data_from_avg_circle, format_stack_from_avg_circle, read_genraw_data, preprocess_frame, cast_zernike_basis, resolve_grid_size, FULL_GRID_SIZE
+    from resampling import match_zernike_basis
+    import surface_cache
+    import zernike_store
+    from session_archive import is_session_archive, read_archived_surface
+    from session_index import session_path
+
+STD_FILENAME = 'averaged_surface_std.npy'
+
+# Expected max deviation of the float32 pipeline from float64 on an averaged surface, in um.
+# Checked by benchmarks.compare_precision; dominated by single-precision rounding in the Zernike fit.
+FLOAT32_TOLERANCE_UM = 1e-4
+
+# circle_tolerance (pixels) for callers that reload a session while frames are appended to it (TEC runs).
+# Each appended frame moves the session-averaged pupil, so at the exact default every cached frame map is rejected.
+APPEND_CIRCLE_TOLERANCE_PX = 0.25
+
+# Pupil circles further than this (pixels, any of x / y / r) from the session median are flagged
+OUTLIER_TOLERANCE_PX = 2.0
+
+# Zernike matrix handed to each worker process once, instead of pickling it with every task
+_worker_Z = None
+
+def _init_worker(Z):
+    #Z is a Zernike matrix tuple, or the store path of one so each worker memory-maps the shared pages
+    global _worker_Z
+    _worker_Z = zernike_store.load_basis(Z) if isinstance(Z, str) else Z
+
+def _detect_pupil(path, dtype=None):
+    #Stage 1: pupil detection for a single frame. The frame itself is not returned, it is reloaded in stage 2.
+    data, circle_coord, ID = measure_h5_circle(path, use_optimizer=True, dtype=dtype)
+    return circle_coord, ID
+
+class SessionPupilTracker:
+    """
+    Pupil detection across the frames of one session.
+
+    Frames of a session come from a fixed setup, so each detection is warm-started
+    from the previous frame's circle, and a frame whose validity (NaN) mask matches
+    one already seen reuses that frame's result outright: circle and ID depend only
+    on the mask. flag_outliers finds frames whose pupil strays from the session, which
+    can optionally be left out of the session-averaged circle.
+    """
+    def __init__(self, dtype=None, initial_circle=None):
+        self.dtype = dtype
+        self.previous = None if initial_circle is None else np.asarray(initial_circle, dtype=float)
+        self._seen = {}
+        self.n_detected = 0
+        self.n_reused = 0
+
+    @staticmethod
+    def mask_fingerprint(valid):
+        return hashlib.sha1(np.packbits(valid)).hexdigest() + str(valid.shape)
+
+    def detect(self, path):
+        data, valid = preprocess_frame(read_genraw_data(path, dtype=self.dtype))
+        key = self.mask_fingerprint(valid)
+        if key in self._seen:
+            self.n_reused += 1
+            return self._seen[key]
+        coord, ID = measure_frame_circle(data, valid, method='optimizer', initial_circle=self.previous)
+        self.n_detected += 1
+        self.previous = np.asarray(coord, dtype=float)
+        self._seen[key] = (coord, ID)
+        return coord, ID
+
+    @staticmethod
+    def flag_outliers(files, circles, tolerance=OUTLIER_TOLERANCE_PX):
+        #Indices of frames whose circle deviates from the session median by more than tolerance pixels (with a warning each)
+        circles = np.asarray(circles, dtype=float)
+        deviation = np.max(np.abs(circles - np.median(circles, axis=0)), axis=1)
+        outliers = np.flatnonzero(deviation > tolerance)
+        for i in outliers:
+            print(f"Warning: pupil of {os.path.basename(files[i])} deviates {deviation[i]:.2f} px from the session median")
+        return outliers
+
+def _format_frame(path, avg_circle, clear_outer, clear_inner, Z=None, dtype=None, grid_size=FULL_GRID_SIZE):
+    #Stage 2: resample / fit a single frame using the session-averaged pupil
+    data, valid = preprocess_frame(read_genraw_data(path, dtype=dtype))
+    Z = _worker_Z if Z is None else Z
+    return format_data_from_avg_circle(data, avg_circle, clear_outer, clear_inner, Z, normal_tip_tilt_power=True, dtype=dtype, grid_size=grid_size)[1]
+
+def _format_frame_stacks(paths, avg_circle, clear_outer, clear_inner, Z, dtype=None, grid_size=FULL_GRID_SIZE, batch_size=1):
+    #Serial stage 2 with batch_size > 1: the frames of a session share the crop and resampling geometry, so they
+    #are formatted batch_size at a time through format_stack_from_avg_circle. Yields one map per path.
+    #Holds batch_size raw frames (and their cropped / filled / resampled copies) at once.
+    for start in range(0, len(paths), batch_size):
+        stack = np.stack([preprocess_frame(read_genraw_data(path, dtype=dtype))[0] for path in paths[start:start + batch_size]])
+        yield from format_stack_from_avg_circle(stack, avg_circle, clear_outer, clear_inner, Z, normal_tip_tilt_power=True, dtype=dtype, grid_size=grid_size)[0]
+
+class RunningSurfaceStats:
+    """
+    Welford accumulator for a stack of surface maps.
+
+    Each map is folded into a running mean and sum of squared deviations, so
+    only the current map and two output-sized buffers are held in memory.
+    """
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+        self._delta = None
+
+    def add(self, surface):
+        if self._mean is None:
+            self._mean = np.zeros(surface.shape, dtype=np.result_type(surface.dtype, np.float32))
+            self._m2 = np.zeros_like(self._mean)
+            self._delta = np.empty_like(self._mean)
+        self.count += 1
+        n = self.count
+        np.subtract(surface, self._mean, out=self._delta)
+        self._delta /= n
+        self._mean += self._delta
+        # (x - mean_old) * (x - mean_new) == n * (n - 1) * (delta / n)**2
+        np.square(self._delta, out=self._delta)
+        self._delta *= n * (n - 1)
+        self._m2 += self._delta
+
+    @property
+    def mean(self):
+        return self._mean.copy()
+
+    @property
+    def std(self):
+        #Sample standard deviation per pixel (zero for a single frame)
+        if self.count < 2:
+            return np.zeros_like(self._mean)
+        return np.sqrt(self._m2 / (self.count - 1))
+
+def _process_frames(mapper, files, clear_outer, clear_inner, Z, digest, use_frame_cache, circle_tolerance, dtype=None, warm_start=False, grid_size=FULL_GRID_SIZE, batch_size=1, exclude_outliers=False):
+    #mapper is the builtin map (serial) or a pool's map; Z is None when the workers already hold it.
+    #digest identifies the resampling parameters for the per-frame map cache.
+    #warm_start runs a serial stage 1 through a SessionPupilTracker instead of detecting every frame from scratch;
+    #with a pool, stage 1 stays parallel and warm_start is ignored.
+    #Stage 2 streams one raw frame at a time; serial runs with batch_size > 1 format stacks instead (_format_frame_stacks).
+    entries = [surface_cache.load_frame_entry(path) if use_frame_cache else None for path in files]
+
+    # Stage 1: pupil detection, only for frames without a current cache entry
+    pending = [i for i, entry in enumerate(entries) if entry is None]
+    warm_start = warm_start and mapper is map
+    if warm_start:
+        cached = [entry['circle'] for entry in entries if entry is not None]
+        tracker = SessionPupilTracker(dtype, initial_circle=cached[-1] if cached else None)
+        detections = map(tracker.detect, [files[i] for i in pending])
+    else:
+        detections = mapper(_detect_pupil, [files[i] for i in pending], [dtype] * len(pending))
+    for i, (coord, ID) in zip(pending, detections):
+        entries[i] = {'circle': np.asarray(coord, dtype=float), 'ID': ID}
+        if use_frame_cache:
+            surface_cache.store_frame_entry(files[i], coord, ID)
+    if warm_start and pending:
+        print(f"Pupil detection: {tracker.n_detected} frames detected, {tracker.n_reused} reused from matching masks")
+    # Frames whose pupil strays from the session median are flagged, and with exclude_outliers left out of the session circle
+    circles = [entry['circle'] for entry in entries]
+    outliers = SessionPupilTracker.flag_outliers(files, circles)
+    if exclude_outliers and 0 < len(outliers) < len(circles):
+        print(f"Averaging the pupil circle over {len(circles) - len(outliers)} of {len(circles)} frames")
+        circles = np.delete(circles, outliers, axis=0)
+    avg_circle = np.mean(circles, axis=0)
+
+    # Stage 2: resample / fit, reusing cached maps made with the same parameters and pupil
+    pending = [i for i, entry in enumerate(entries)
+               if not (use_frame_cache and surface_cache.frame_map_is_current(entry, avg_circle, digest, circle_tolerance))]
+    n = len(pending)
+    if mapper is map and batch_size > 1:
+        new_maps = _format_frame_stacks([files[i] for i in pending], avg_circle, clear_outer, clear_inner, Z, dtype, grid_size, batch_size)
+    else:
+        new_maps = mapper(_format_frame, [files[i] for i in pending], [avg_circle] * n, [clear_outer] * n, [clear_inner] * n, [Z] * n, [dtype] * n, [grid_size] * n)
+
+    stats = RunningSurfaceStats()
+    for i, path in enumerate(files):
+        if pending and pending[0] == i:
+            pending.pop(0)
+            wf_map = next(new_maps)
+            if use_frame_cache:
+                surface_cache.store_frame_entry(path, entries[i]['circle'], entries[i]['ID'], wf_map, avg_circle, digest)
+        else:
+            wf_map = surface_cache.load_frame_map(path)
+        stats.add(wf_map)
+    if use_frame_cache:
+        print(f"Processed {n} of {len(files)} frames, {len(files) - n} loaded from the frame cache")
+    return stats
+
+def _run_stages(files, clear_outer, clear_inner, Z, n_workers, use_frame_cache=True, circle_tolerance=0.0, dtype=None, warm_start=False, grid_size=FULL_GRID_SIZE, batch_size=1, exclude_outliers=False):
+    Z = match_zernike_basis(Z, grid_size)  # once per session rather than once per frame
+    if dtype is not None and Z is not None:
+        Z = cast_zernike_basis(Z, dtype)
+    digest = surface_cache.params_digest({'clear_outer': clear_outer, 'clear_inner': clear_inner, 'dtype': np.dtype(dtype).name,
+                                          'grid_size': grid_size}, Z)
+    if n_workers > 1:
+        try:
+            worker_Z = zernike_store.stored_basis_path(Z) or Z
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(worker_Z,)) as pool:
+                return _process_frames(pool.map, files, clear_outer, clear_inner, None, digest, use_frame_cache, circle_tolerance, dtype, warm_start, grid_size, exclude_outliers=exclude_outliers)
+        except (BrokenProcessPool, OSError) as e:
+            print(f"Parallel ingest failed ({e}); falling back to serial processing")
+    return _process_frames(map, files, clear_outer, clear_inner, Z, digest, use_frame_cache, circle_tolerance, dtype, warm_start, grid_size, batch_size, exclude_outliers)
+
+def _processing_params(clear_outer, clear_inner, ID_crop, dtype=None, grid_size=FULL_GRID_SIZE, circle_tolerance=0.0, exclude_outliers=False):
+    #Everything besides the inputs and the Zernike basis that changes the averaged surface
+    return {'clear_outer': clear_outer, 'clear_inner': clear_inner, 'ID_crop': ID_crop, 'dtype': np.dtype(dtype).name,
+            'grid_size': grid_size, 'circle_tolerance': float(circle_tolerance), 'exclude_outliers': bool(exclude_outliers)}
+
+def load_measurements(folder, clear_outer, clear_inner, Z, ID_crop=1.25, n_workers=1, use_cache=True, circle_tolerance=0.0, dtype=None, warm_start=False, grid_size=FULL_GRID_SIZE, batch_size=1, exclude_outliers=False):
+    #n_workers > 1 runs pupil detection and resampling as two process-pool fan-outs.
+    #Files are processed in sorted order so the result does not depend on the pool schedule.
+    #Frames are streamed into a running mean / variance, and the per-pixel std map is saved as a noise estimate.
+    #With use_cache, per-frame circles and maps are kept in a sidecar store so only new or modified frames are
+    #processed. By default a cached map is only reused if the session-averaged pupil is exactly the one it was
+    #made with; circle_tolerance > 0 (pixels) also reuses maps made with a nearby pupil, trading exactness for
+    #speed, and is part of the surface cache key so such surfaces are never served to exact runs.
+    #Appending a frame moves the averaged pupil, so only pupil detection is incremental at the exact default:
+    #reusing the maps (a reload costing about one frame) needs circle_tolerance > 0, e.g. APPEND_CIRCLE_TOLERANCE_PX.
+    #dtype=np.float32 runs the pipeline in single precision; see FLOAT32_TOLERANCE_UM for the expected deviation.
+    #warm_start=True detects pupils session-aware in serial runs (see SessionPupilTracker); n_workers > 1 keeps
+    #stage 1 parallel. Frames whose pupil strays from the session median (OUTLIER_TOLERANCE_PX) are always flagged;
+    #exclude_outliers=True also leaves them out of the averaged circle (by default every frame's circle is averaged).
+    #grid_size (pixels or a GRID_TIERS name such as 'quick') sets the output resolution. Only full-resolution
+    #surfaces are saved as averaged_surface.npy; other tiers live in the surface cache alone.
+    #batch_size > 1 formats serial runs batch_size frames at a time; the default holds one raw frame at a time.
+    grid_size = resolve_grid_size(grid_size)
+    files = [os.path.join(folder, file) for file in sorted(os.listdir(folder)) if file.endswith(".h5")]
+    n_workers = min(n_workers or 1, len(files))
+
+    stats = _run_stages(files, clear_outer, clear_inner*ID_crop, Z, n_workers, use_frame_cache=use_cache, circle_tolerance=circle_tolerance, dtype=dtype, warm_start=warm_start, grid_size=grid_size, batch_size=batch_size, exclude_outliers=exclude_outliers)
     if False:
-        surface = np.flip(np.mean(wf_maps, 0), 1)
+        surface = np.flip(stats.mean, 1)
         #DELTADELTA I CHANGED THE FLIP AXIS FROM 0->1 AFTER LOOKING AT TEC TRAINING DATA
     else:
-        surface = np.mean(wf_maps, 0)
-    
+        surface = stats.mean
+
     if False:
         import matplotlib.pyplot as plt
         plt.imshow(surface)
         plt.show()
 
-    np.save(os.path.join(folder, 'averaged_surface.npy'), surface)
+    std = stats.std
+    if grid_size == FULL_GRID_SIZE:
+        np.save(os.path.join(folder, 'averaged_surface.npy'), surface)
+        np.save(os.path.join(folder, STD_FILENAME), std)
+    if use_cache:
+        params = _processing_params(clear_outer, clear_inner, ID_crop, dtype, grid_size, circle_tolerance, exclude_outliers)
+        key = surface_cache.cache_key(folder, params, Z)
+        surface_cache.store_cached_surface(folder, key, surface, std, params)
     return surface
 
-def load_multiple_surfaces(shared_path, dates, measurements, clear_outer, clear_inner, Z, ID_crop=1.25):
+def load_multiple_surfaces(shared_path, dates, measurements, clear_outer, clear_inner, Z, ID_crop=1.25, n_workers=1, use_cache=True, dtype=None, index=None, grid_size=FULL_GRID_SIZE, circle_tolerance=0.0):
+    #With a session index (session_index.current_session_index), sessions are looked up in the index
+    #instead of the file system, which also resolves sessions stored as archives
     surfaces = []
 
     if isinstance(dates, str):
@@ -48,15 +273,36 @@ def load_multiple_surfaces(shared_path, dates, measurements, clear_outer, clear_
     for num, date in enumerate(dates):
         folder = os.path.join(shared_path, date)
         subfolder = measurements[num] if isinstance(measurements[num], str) else str(measurements[num])
-        subfolder_path = os.path.join(folder, subfolder)
-        if os.path.isdir(subfolder_path):        
-            surface = load_single_surface(subfolder_path, clear_outer=clear_outer, clear_inner=clear_inner, Z=Z, ID_crop=ID_crop)
+        if index is not None:
+            if f"{date}/{subfolder}" not in index['sessions']:
+                continue
+            subfolder_path = session_path(index, date, subfolder)
+        else:
+            subfolder_path = os.path.join(folder, subfolder)
+        if index is not None or os.path.isdir(subfolder_path):
+            surface = load_single_surface(subfolder_path, clear_outer=clear_outer, clear_inner=clear_inner, Z=Z, ID_crop=ID_crop, n_workers=n_workers, use_cache=use_cache, dtype=dtype, grid_size=grid_size, circle_tolerance=circle_tolerance)
             surfaces.append(surface)
     return surfaces
 
-def load_single_surface(subfolder_path, filename='averaged_surface.npy', clear_outer=None, clear_inner=None, Z=None, ID_crop=1.25):
-    if os.path.exists(os.path.join(subfolder_path, filename)):
+def load_single_surface(subfolder_path, filename='averaged_surface.npy', clear_outer=None, clear_inner=None, Z=None, ID_crop=1.25, n_workers=1, use_cache=True, dtype=None, grid_size=FULL_GRID_SIZE, circle_tolerance=0.0):
+    #With use_cache, folders holding .h5 frames are served from the parameter-aware cache and
+    #reprocessed automatically when the frames or parameters change. Folders without frames
+    #(or calls without processing parameters) fall back to the saved averaged surface.
+    #subfolder_path may also be a session archive, in which case only its averaged surface is read.
+    #Saved surfaces are full resolution, so other grid sizes are always processed (or served from the cache).
+    #circle_tolerance is passed on to load_measurements; callers reloading a session that frames are being
+    #appended to pass APPEND_CIRCLE_TOLERANCE_PX so the cached frame maps are reused.
+    grid_size = resolve_grid_size(grid_size)
+    if is_session_archive(subfolder_path):
+        return read_archived_surface(subfolder_path)
+    has_frames = any(file.endswith(".h5") for file in os.listdir(subfolder_path))
+    if use_cache and has_frames and clear_outer is not None:
+        key = surface_cache.cache_key(subfolder_path, _processing_params(clear_outer, clear_inner, ID_crop, dtype, grid_size, circle_tolerance), Z)
+        surface = surface_cache.load_cached_surface(subfolder_path, key)
+        if surface is None:
+            surface = load_measurements(subfolder_path, clear_outer, clear_inner, Z, ID_crop, n_workers=n_workers, use_cache=True, circle_tolerance=circle_tolerance, dtype=dtype, grid_size=grid_size)
+    elif os.path.exists(os.path.join(subfolder_path, filename)) and (grid_size == FULL_GRID_SIZE or clear_outer is None):
         surface = np.load(os.path.join(subfolder_path, filename))
     else:
-        surface = load_measurements(subfolder_path, clear_outer, clear_inner, Z, ID_crop)
-    return surface
\ No newline at end of file
+        surface = load_measurements(subfolder_path, clear_outer, clear_inner, Z, ID_crop, n_workers=n_workers, use_cache=use_cache, circle_tolerance=circle_tolerance, dtype=dtype, grid_size=grid_size)
+    return surface
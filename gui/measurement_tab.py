@@ -67,6 +67,10 @@ class MeasurementTab(QWidget):
         self.instance_spin.setValue(-1)
         ag.addWidget(self.instance_spin, 1, 1)
 
+        self.quick_look_chk = QCheckBox("Quick look (coarse grid, approximate)")
+        self.quick_look_chk.setChecked(False)
+        ag.addWidget(self.quick_look_chk, 2, 0, 1, 2)
+
         root.addWidget(adv_box)
 
         # --- Action buttons ---
@@ -148,6 +152,7 @@ class MeasurementTab(QWidget):
             save_instance=self.instance_spin.value(),
             new_folder=self._new_folder_or_none(),
             number_alignment_iterations=self.align_spin.value(),
+            quick_look=self.quick_look_chk.isChecked(),
         )
         self._worker.progress.connect(self._log)
         self._worker.finished.connect(self._on_measurement_done)
@@ -166,6 +171,7 @@ class MeasurementTab(QWidget):
             save_date=self.date_spin.value(),
             save_instance=self.instance_spin.value(),
             new_folder=self._new_folder_or_none(),
+            quick_look=self.quick_look_chk.isChecked(),
         )
         self._worker.progress.connect(self._log)
         self._worker.finished.connect(self._on_measurement_done)
@@ -180,7 +186,7 @@ class MeasurementTab(QWidget):
         sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
         sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
         from interferometer.config import get_mirror_params
-        from shared.General_zernike_matrix import General_zernike_matrix
+        from interferometer.zernike_store import get_zernike_basis
 
         path, _ = QFileDialog.getOpenFileName(
             self, "Open .npy surface file", "", "NumPy files (*.npy)")
@@ -200,8 +206,8 @@ class MeasurementTab(QWidget):
             config = get_mirror_params(mirror_num)
             OD, ID = config["OD"], config["ID"]
             clear_outer, clear_inner = 0.5 * OD, 0.5 * ID
-            Z = General_zernike_matrix(44, int(clear_outer * 1e6),
-                                       int(clear_inner * 1e6))
+            Z = get_zernike_basis(44, int(clear_outer * 1e6),
+                                  int(clear_inner * 1e6))
             result = {
                 'surface': surface,
                 'config': config,
@@ -67,7 +67,7 @@ class _JumpSlider(QSlider):
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
 
-from interferometer.surface_processing import prepare_surface, radial_averaged_surface
+from interferometer.surface_processing import SurfaceProducts, SURFACE_PRESETS
 from interferometer.plotting_interface import (
     plot_processed_surface, plot_mirror_cs, compare_surfaces,
 )
@@ -75,15 +75,6 @@ from interferometer.plotting_utils import compute_cmap_and_contour
 from .mpl_widget import MplWidget
 
 
-# Pre-defined correction presets (same as main.py)
-COEF_PRESETS = {
-    'uncorrected': [0, 1, 2, 4],
-    'sph corrected': [0, 1, 2, 4],
-    'edge corrected': [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 20, 21, 27, 28, 35, 36, 44],
-    'all modes removed': [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 20, 21, 27, 28, 35, 36, 44],
-}
-
-
 class ResultsTab(QWidget):
     """Display and compare processed mirror surfaces."""
 
@@ -92,6 +83,7 @@ class ResultsTab(QWidget):
         # Two data slots for comparison
         self._data = [None, None]      # list of result dicts (or None)
         self._processed = [None, None] # processed surface arrays
+        self._products = [None, None]  # SurfaceProducts per slot: one fit shared by every preset
         self._compare_active = False   # only show comparison after button press
         self._defocus_amplitude = 0.0  # defocus to add after processing
         self._build_ui()
@@ -106,7 +98,7 @@ class ResultsTab(QWidget):
 
         opts_layout.addWidget(QLabel("Correction:"))
         self.coef_combo = QComboBox()
-        self.coef_combo.addItems(list(COEF_PRESETS.keys()))
+        self.coef_combo.addItems(list(SURFACE_PRESETS.keys()))
         self.coef_combo.currentIndexChanged.connect(self._on_options_changed)
         opts_layout.addWidget(self.coef_combo)
 
@@ -191,6 +183,8 @@ class ResultsTab(QWidget):
     def set_surface(self, result_dict, slot_index):
         """Called by MeasurementTab when a surface is ready."""
         self._data[slot_index] = result_dict
+        self._products[slot_index] = SurfaceProducts(
+            result_dict['surface'], result_dict['Z'], result_dict['config'])
         label_text = (
             f"Slot {'A' if slot_index == 0 else 'B'}: "
             f"M{result_dict['mirror_num']}  —  {result_dict['save_path']}"
@@ -202,26 +196,17 @@ class ResultsTab(QWidget):
         self._refresh()
 
     # --------------------------------------------------- internal
-    def _current_coefs(self):
-        name = self.coef_combo.currentText()
-        return COEF_PRESETS.get(name, [0, 1, 2, 4])
-
     def _process(self, slot_index):
-        """Run prepare_surface for the given slot and cache the result."""
-        data = self._data[slot_index]
-        if data is None:
+        """Select the current preset of the given slot (fitted once per surface)."""
+        products = self._products[slot_index]
+        if products is None:
             self._processed[slot_index] = None
             return
-        coefs = self._current_coefs()
         crop = self.crop_ca_chk.isChecked()
         preset_name = self.coef_combo.currentText()
-        surface = data['surface']
-        if preset_name in ('sph corrected', 'all modes removed'):
-            # Subtract radial average first, then remove Zernike modes
-            surface = surface - radial_averaged_surface(surface, data['config'])
-        processed = prepare_surface(
-            surface, data['Z'], coefs, data['config'], crop_ca=crop)
-        self._processed[slot_index] = processed
+        if preset_name not in SURFACE_PRESETS:
+            preset_name = 'uncorrected'
+        self._processed[slot_index] = products.preset(preset_name, crop_ca=crop)
 
     def _on_options_changed(self, _=None):
         self._refresh()
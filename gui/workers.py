@@ -37,7 +37,8 @@ class MeasurementWorker(QThread):
     progress = pyqtSignal(str)        # status messages for the log
 
     def __init__(self, mirror_num, take_new, save_date, save_instance,
-                 new_folder, number_alignment_iterations, parent=None):
+                 new_folder, number_alignment_iterations, quick_look=False,
+                 parent=None):
         super().__init__(parent)
         self.mirror_num = str(mirror_num)
         self.take_new = take_new
@@ -45,6 +46,7 @@ class MeasurementWorker(QThread):
         self.save_instance = save_instance
         self.new_folder = new_folder
         self.number_alignment_iterations = number_alignment_iterations
+        self.quick_look = quick_look
 
     def run(self):
         try:
@@ -55,7 +57,8 @@ class MeasurementWorker(QThread):
             from interferometer.config import get_mirror_params
             from interferometer.interferometer_utils import take_new_measurement, setup_paths
             from interferometer.data_loader import load_single_surface
-            from shared.General_zernike_matrix import General_zernike_matrix
+            from interferometer.surface_processing import resolve_grid_size
+            from interferometer.zernike_store import get_zernike_basis
 
             config = get_mirror_params(self.mirror_num)
             OD, ID = config["OD"], config["ID"]
@@ -69,10 +72,6 @@ class MeasurementWorker(QThread):
                                          self.save_date, self.save_instance,
                                          self.new_folder)
 
-            self.progress.emit("Generating Zernike matrix...")
-            Z = General_zernike_matrix(44, int(clear_outer * 1e6),
-                                       int(clear_inner * 1e6))
-
             if self.take_new:
                 self.progress.emit(
                     f"Taking new measurement ({self.number_alignment_iterations} "
@@ -88,18 +87,26 @@ class MeasurementWorker(QThread):
                     sys.stdout = old_stdout
                     stream.flush()
 
-            self.progress.emit("Loading surface data...")
+            # Quick look: approximate surface on the coarse grid, with the basis matched to it
+            grid_size = resolve_grid_size('quick' if self.quick_look else 'full')
+            self.progress.emit("Loading Zernike matrix...")
+            Z = get_zernike_basis(44, int(clear_outer * 1e6),
+                                  int(clear_inner * 1e6), grid_size)
+
+            self.progress.emit(f"Loading surface data ({grid_size}x{grid_size})...")
             surface = load_single_surface(
                 save_subfolder,
                 clear_outer=clear_outer,
                 clear_inner=clear_inner,
-                Z=Z)
+                Z=Z,
+                grid_size=grid_size)
 
             result = {
                 'surface': surface,
                 'config': config,
                 'save_path': save_subfolder,
                 'Z': Z,
+                'grid_size': grid_size,
                 'clear_outer': clear_outer,
                 'clear_inner': clear_inner,
                 'mirror_num': self.mirror_num,
@@ -119,12 +126,13 @@ class LoadSurfaceWorker(QThread):
     progress = pyqtSignal(str)
 
     def __init__(self, mirror_num, save_date, save_instance, new_folder=None,
-                 parent=None):
+                 quick_look=False, parent=None):
         super().__init__(parent)
         self.mirror_num = str(mirror_num)
         self.save_date = save_date
         self.save_instance = save_instance
         self.new_folder = new_folder
+        self.quick_look = quick_look
 
     def run(self):
         try:
@@ -135,7 +143,9 @@ class LoadSurfaceWorker(QThread):
             from interferometer.config import get_mirror_params
             from interferometer.interferometer_utils import setup_paths
             from interferometer.data_loader import load_single_surface
-            from shared.General_zernike_matrix import General_zernike_matrix
+            from interferometer.session_index import current_session_index
+            from interferometer.surface_processing import resolve_grid_size
+            from interferometer.zernike_store import get_zernike_basis
 
             config = get_mirror_params(self.mirror_num)
             OD, ID = config["OD"], config["ID"]
@@ -143,26 +153,32 @@ class LoadSurfaceWorker(QThread):
 
             mirror_path = config["base_path"]
             self.progress.emit(f"Loading saved data for Mirror {self.mirror_num}...")
+            index = current_session_index(mirror_path)
+            self.progress.emit(f"Session index: {len(index['sessions'])} sessions.")
             save_subfolder = setup_paths(mirror_path, False,
                                          self.save_date, self.save_instance,
-                                         self.new_folder)
+                                         self.new_folder, index=index)
 
-            self.progress.emit("Generating Zernike matrix...")
-            Z = General_zernike_matrix(44, int(clear_outer * 1e6),
-                                       int(clear_inner * 1e6))
+            # Quick look: approximate surface on the coarse grid, with the basis matched to it
+            grid_size = resolve_grid_size('quick' if self.quick_look else 'full')
+            self.progress.emit("Loading Zernike matrix...")
+            Z = get_zernike_basis(44, int(clear_outer * 1e6),
+                                  int(clear_inner * 1e6), grid_size)
 
-            self.progress.emit("Loading surface data...")
+            self.progress.emit(f"Loading surface data ({grid_size}x{grid_size})...")
             surface = load_single_surface(
                 save_subfolder,
                 clear_outer=clear_outer,
                 clear_inner=clear_inner,
-                Z=Z)
+                Z=Z,
+                grid_size=grid_size)
 
             result = {
                 'surface': surface,
                 'config': config,
                 'save_path': save_subfolder,
                 'Z': Z,
+                'grid_size': grid_size,
                 'clear_outer': clear_outer,
                 'clear_inner': clear_inner,
                 'mirror_num': self.mirror_num,
@@ -24,18 +24,22 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.
 
 try:
     # Try relative import (when run as part of package)
-    from .surface_processing import import_4D_map_auto, import_cropped_4D_map, measure_h5_circle, format_data_from_avg_circle, prepare_surface
+    from .surface_processing import import_4D_map_auto, import_cropped_4D_map, measure_h5_circle, format_stack_from_avg_circle, prepare_surface
     from .config import get_mirror_params
     from .data_loader import load_single_surface
+    from .session_archive import SESSION_ARCHIVE_EXT
+    from .session_index import list_dates, list_instances, session_path
     from .plotting_interface import plot_processed_surface, plot_psf_from_surface, plot_mirror_cs
+    from .zernike_store import get_zernike_basis
 except ImportError:
     # Fall back to absolute import (when run directly)
-    from surface_processing import import_4D_map_auto, import_cropped_4D_map, measure_h5_circle, format_data_from_avg_circle, prepare_surface
+    from surface_processing import import_4D_map_auto, import_cropped_4D_map, measure_h5_circle, format_stack_from_avg_circle, prepare_surface
     from config import get_mirror_params
     from data_loader import load_single_surface
+    from session_archive import SESSION_ARCHIVE_EXT
+    from session_index import list_dates, list_instances, session_path
     from plotting_interface import plot_processed_surface, plot_psf_from_surface, plot_mirror_cs
-
-from shared.General_zernike_matrix import General_zernike_matrix
+    from zernike_store import get_zernike_basis
 
 try:
     from LFASTfiber.libs.libNewport import smc100
@@ -152,18 +156,20 @@ def load_interferometer_maps(array_of_paths, Z, clear_aperture_outer, clear_aper
             coord_holder = []
             wf_maps = []
             wf_maps = []
+            detector_stats = {}
             for file in os.listdir(path):
                 if file.endswith(".h5"):
-                    data, circle_coord = measure_h5_circle(path + file)
+                    data, circle_coord, ID = measure_h5_circle(path + file, stats=detector_stats)
                     data_holder.append(data)
                     coord_holder.append(circle_coord)
-
-            for data in data_holder:
-                if remove_coef == [0, 1, 2, 4]:
-                    wf_maps.append(format_data_from_avg_circle(data, circle_coord, Z, normal_tip_tilt_power=True)[1])
-                else:
-                    wf_maps.append(format_data_from_avg_circle(data, circle_coord, Z, normal_tip_tilt_power=False,
-                                                               remove_coef=remove_coef)[1])
+            if detector_stats:
+                print(f"Pupil detection: {detector_stats['hough_calls']} HoughCircles calls over {detector_stats['frames']} frames")
+
+            # Every frame is formatted with the averaged pupil, as one stack
+            wf_maps = format_stack_from_avg_circle(np.stack(data_holder), np.mean(coord_holder, 0),
+                                                   clear_aperture_outer, clear_aperture_inner, Z,
+                                                   normal_tip_tilt_power=remove_coef == [0, 1, 2, 4],
+                                                   remove_coef=remove_coef)[0]
             output_ref = np.flip(np.mean(wf_maps, 0), 0)
 
         else:
@@ -270,7 +276,7 @@ def measure_and_process_surface(mirror_num="10", take_new=True, save_date=-1,
     
     # Create Zernike matrix
     if Z is None:
-        Z = General_zernike_matrix(44, int(clear_outer * 1e6), int(clear_inner * 1e6))
+        Z = get_zernike_basis(44, int(clear_outer * 1e6), int(clear_inner * 1e6))
     
     # Take new measurement if requested
     if take_new:
@@ -322,8 +328,12 @@ def take_new_measurement(save_subfolder, number_alignment_iterations=3):
     run_measurement(save_subfolder, s, s_gain=0.5, number_alignment_iterations=number_alignment_iterations)
     s.close()
 
-def setup_paths(mirror_path, take_new, save_date, save_instance, new_folder=None):
-    """Handle logic for save/load folder paths."""
+def setup_paths(mirror_path, take_new, save_date, save_instance, new_folder=None, index=None):
+    """Handle logic for save/load folder paths.
+
+    When loading, an index from session_index.current_session_index can be passed
+    to resolve the date and instance without listing the data folders.
+    """
     if take_new or len(os.listdir(mirror_path)) == 0:
         folder = datetime.datetime.now().strftime('%Y%m%d')
         if new_folder is not None:
@@ -335,6 +345,16 @@ def setup_paths(mirror_path, take_new, save_date, save_instance, new_folder=None
         save_subfolder = save_path + str(measurement_number) + '/'
         os.makedirs(save_subfolder, exist_ok=True)
 
+    elif index is not None:
+        folder_list = [f for f in list_dates(index) if f.isnumeric()]
+        folder = folder_list[save_date] if isinstance(save_date, int) else save_date
+        if new_folder is not None:
+            folder = folder + '_' + new_folder
+
+        subfolder_list = [f for f in list_instances(index, folder) if f.isnumeric()]
+        instance = subfolder_list[save_instance] if isinstance(save_instance, int) else save_instance
+        save_subfolder = session_path(index, folder, instance)
+
     else:
         folder_list = sorted([f for f in os.listdir(mirror_path) if f.isnumeric()])
         folder = folder_list[save_date] if isinstance(save_date, int) else save_date
@@ -343,8 +363,12 @@ def setup_paths(mirror_path, take_new, save_date, save_instance, new_folder=None
 
         save_path = os.path.join(mirror_path, folder)
 
-        subfolder_list = sorted([f for f in os.listdir(save_path) if f.isnumeric()])
+        # Measurement instances are numbered folders, or session archives of them
+        instances = {f[:-len(SESSION_ARCHIVE_EXT)] if f.endswith(SESSION_ARCHIVE_EXT) else f for f in os.listdir(save_path)}
+        subfolder_list = sorted([f for f in instances if f.isnumeric()])
         instance = subfolder_list[save_instance] if isinstance(save_instance, int) else save_instance
         save_subfolder = os.path.join(save_path, instance)
+        if not os.path.isdir(save_subfolder) and os.path.isfile(save_subfolder + SESSION_ARCHIVE_EXT):
+            save_subfolder = save_subfolder + SESSION_ARCHIVE_EXT
 
     return save_subfolder
\ No newline at end of file
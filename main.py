@@ -13,9 +13,9 @@ from interferometer import config
 from config import get_mirror_params
 from interferometer_utils import take_new_measurement, setup_paths
 from data_loader import load_measurements, load_multiple_surfaces, load_single_surface
-from surface_processing import prepare_surface, radial_averaged_surface
-from shared.General_zernike_matrix import General_zernike_matrix
-from shared.zernike_utils import get_M_and_C, remove_modes
+from session_index import current_session_index, list_dates, list_instances
+from surface_processing import prepare_surface, SurfaceProducts, SURFACE_PRESETS
+from zernike_store import get_zernike_basis
 from plotting_interface import plot_processed_surface, plot_psf_from_surface, plot_mirror_cs, plot_surfaces
 try:
     from LFASTfiber.libs.libNewport import smc100
@@ -39,7 +39,7 @@ def main(mirror_num="10", take_new=True, save_date = -1, save_instance = -1, new
     save_subfolder = setup_paths(mirror_path, take_new, save_date, save_instance, new_folder)
 
 
-    Z = General_zernike_matrix(44, int(clear_outer * 1e6), int(clear_inner * 1e6))
+    Z = get_zernike_basis(44, int(clear_outer * 1e6), int(clear_inner * 1e6))
 
     if True:
     
@@ -47,19 +47,10 @@ def main(mirror_num="10", take_new=True, save_date = -1, save_instance = -1, new
             take_new_measurement(save_subfolder, number_alignment_iterations=7)
         if True:
             surface = load_single_surface(save_subfolder, clear_outer=clear_outer, clear_inner=clear_inner, Z=Z)
-            updated_surface = surface.copy()
-
-            coefs = [[0,1,2,4], [0,1,2,4], [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 20, 21, 27, 28, 35, 36, 44], [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 20, 21, 27, 28, 35, 36, 44]]
-            coef_names = ['uncorrected', 'sph corrected', 'edge corrected','all modes removed']
-            coef_dict = dict(zip([tuple(c) for c in coefs],coef_names))
-
-            for coefs_tuple, name in coef_dict.items():
-                crop_ca=False
-                remove_coef = list(coefs_tuple)
-                if name in ("sph corrected", "all modes removed"):
-                    updated_surface = prepare_surface(surface - radial_averaged_surface(surface,config), Z, remove_coef, config, crop_ca=crop_ca)
-                else:
-                    updated_surface = prepare_surface(surface, Z, remove_coef, config, crop_ca = crop_ca)
+            products = SurfaceProducts(surface, Z, config)  # one fit and one radial average for every preset
+
+            for name in SURFACE_PRESETS:
+                updated_surface = products.preset(name, crop_ca=False)
                 plot_processed_surface(updated_surface, Z, f"N{mirror_num} ({new_folder})", config)
                 plot_psf_from_surface(updated_surface, Z, f"N{mirror_num}" +' (' + name + ')', config)
                 plot_mirror_cs(mirror_num, [updated_surface], [datetime.datetime.now().strftime('%Y%m%d')])
@@ -67,10 +58,10 @@ def main(mirror_num="10", take_new=True, save_date = -1, save_instance = -1, new
         else:
             remove_coef = [0,1,2,4]
 
-            subdirs = [d for d in os.listdir(mirror_path) if os.path.isdir(os.path.join(mirror_path, d))]
-            dates = subdirs[-2:]
-            measurements = [0,0]  # Indices of measurements to load from each date
-            surfaces = load_multiple_surfaces(mirror_path, dates, measurements, clear_outer, clear_inner, Z, ID_crop=1.25)
+            index = current_session_index(mirror_path)
+            dates = list_dates(index)[-2:]
+            measurements = [list_instances(index, date)[0] for date in dates]  # First measurement from each date
+            surfaces = load_multiple_surfaces(mirror_path, dates, measurements, clear_outer, clear_inner, Z, ID_crop=1.25, index=index)
             
             cropped_surfaces = [prepare_surface(surface, Z, remove_coef, config, crop_ca = False) for surface in surfaces]
             plot_mirror_cs(mirror_num, cropped_surfaces, dates)
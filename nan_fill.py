@@ -0,0 +1,125 @@
+"""
+Fill engines for the NaN holes of a cropped 4D frame before spline resampling.
+
+The filled values only support the resampling spline near the pupil edge and
+the central obscuration; they are masked out again afterwards.  The local
+methods therefore only work on the NaN pixels and a thin border of valid data
+around them:
+
+    'nearest'                 value of the nearest valid pixel
+    'normalized_convolution'  Gaussian-weighted average of nearby valid pixels
+    'biharmonic'              smooth (biharmonic) continuation across a band of
+                              BIHARMONIC_BAND pixels around the valid data
+
+Pixels beyond the reach of the smooth methods fall back to 'nearest'.
+'bisplrep' is the original global smoothing-spline fit over every valid pixel,
+kept for comparison.
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy import interpolate
+from scipy.ndimage import distance_transform_edt, gaussian_filter, binary_dilation
+from scipy.sparse.linalg import spsolve
+
+FILL_METHODS = ('nearest', 'normalized_convolution', 'biharmonic', 'bisplrep')
+DEFAULT_FILL_METHOD = 'biharmonic'
+
+CONVOLUTION_SIGMA = 2.0  # Gaussian width of the normalized convolution, in pixels
+MIN_WEIGHT = 1e-3        # normalized convolution weights below this are left to 'nearest'
+BIHARMONIC_BAND = 6      # width of the biharmonic band around the valid data, in pixels
+
+def fill_nearest(data, holes=None):
+    #Replace each NaN by the nearest valid pixel
+    holes = np.isnan(data) if holes is None else holes
+    filled = data.copy()
+    if holes.any():
+        indices = distance_transform_edt(holes, return_distances=False, return_indices=True)
+        filled[holes] = data[indices[0][holes], indices[1][holes]]
+    return filled
+
+def fill_normalized_convolution(data, sigma=CONVOLUTION_SIGMA, min_weight=MIN_WEIGHT):
+    holes = np.isnan(data)
+    weights = (~holes).astype(float)
+    values = np.where(holes, 0.0, data)
+    numerator = gaussian_filter(values, sigma, mode='constant')
+    denominator = gaussian_filter(weights, sigma, mode='constant')
+
+    filled = fill_nearest(data, holes)
+    reached = holes & (denominator > min_weight)
+    filled[reached] = numerator[reached] / denominator[reached]
+    return filled
+
+def _laplacian_rows(shape, rows):
+    #Sparse 5-point Laplacian for the given flat pixel indices (neighbors outside the grid are dropped)
+    n_rows, n_cols = shape
+    r, c = np.divmod(rows, n_cols)
+    entries_i, entries_j, entries_v = [np.arange(len(rows))], [rows], [np.zeros(len(rows))]
+    for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        inside = (r + dr >= 0) & (r + dr < n_rows) & (c + dc >= 0) & (c + dc < n_cols)
+        i = np.flatnonzero(inside)
+        entries_i += [i, i]
+        entries_j += [(r[i] + dr) * n_cols + c[i] + dc, rows[i]]
+        entries_v += [-np.ones(len(i)), np.ones(len(i))]
+    return sparse.csr_matrix((np.concatenate(entries_v), (np.concatenate(entries_i), np.concatenate(entries_j))),
+                             shape=(len(rows), n_rows * n_cols))
+
+def fill_biharmonic(data, band=BIHARMONIC_BAND):
+    """
+    Biharmonic fill of the NaN pixels within `band` pixels of valid data.
+
+    Minimizes the squared discrete Laplacian over the band, with the valid data (and
+    a nearest-pixel fill beyond the band) held fixed, so the continuation matches
+    the surface value and slope at the hole edges.
+    """
+    holes = np.isnan(data)
+    filled = fill_nearest(data, holes)
+    if not holes.any():
+        return filled
+    near_data = binary_dilation(~holes, iterations=band)
+    unknown = holes & near_data
+    if not unknown.any():
+        return filled
+
+    rows = np.flatnonzero(binary_dilation(unknown))
+    L = _laplacian_rows(data.shape, rows).tocsc()
+    unknown_flat = np.flatnonzero(unknown)
+    known_flat = np.flatnonzero(~unknown)
+    A = L[:, unknown_flat]
+    rhs = -(L[:, known_flat] @ filled.ravel()[known_flat])
+    solution = spsolve((A.T @ A).tocsc(), A.T @ rhs)
+    filled.ravel()[unknown_flat] = solution
+    return filled
+
+def fill_bisplrep(data, xs, ys):
+    #Original global fill: smoothing spline through every valid pixel, evaluated on the (xs, ys) grid.
+    #bisplev returns its grid indexed [x, y]; it is applied as-is, exactly as the pipeline always has.
+    valid = ~np.isnan(data)
+    coord = np.where(valid)
+    tck = interpolate.bisplrep(xs[coord[1]], ys[coord[0]], data[valid])
+    filled = data.copy()
+    filled[~valid] = interpolate.bisplev(xs, ys, tck)[~valid]
+    return filled
+
+def fill_nans(data, method=DEFAULT_FILL_METHOD, xs=None, ys=None):
+    """
+    Return a copy of a cropped frame with its NaN holes filled.
+
+    Parameters
+    ----------
+    data : ndarray
+        Cropped frame, NaN where there is no valid data
+    method : str
+        One of FILL_METHODS
+    xs, ys : ndarray or None
+        Column / row coordinates of the frame, only used by 'bisplrep'
+    """
+    if method == 'nearest':
+        return fill_nearest(data)
+    if method == 'normalized_convolution':
+        return fill_normalized_convolution(data)
+    if method == 'biharmonic':
+        return fill_biharmonic(data)
+    if method == 'bisplrep':
+        return fill_bisplrep(data, xs, ys)
+    raise ValueError(f"Unknown fill method '{method}', expected one of {FILL_METHODS}")
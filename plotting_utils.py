@@ -3,7 +3,12 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import matplotlib.gridspec as gridspec
 from hcipy import make_pupil_grid, Field, radial_profile
-from mirror_control.shared.zernike_utils import return_zernike_name, remove_modes
+from mirror_control.shared.zernike_utils import return_zernike_name
+
+try:
+    from .zernike_fit import synthesize_modes, remove_zernike_modes
+except ImportError:
+    from zernike_fit import synthesize_modes, remove_zernike_modes
 
 
 
@@ -132,13 +137,13 @@ def plot_mirror_and_cs(title,output_ref,include_reference = None,Z=None,C=None,O
         try:
             for coef in include_reference:
                 name = return_zernike_name(coef)
-                term = (Z[1].transpose(2,0,1)[coef])*C[2][coef]*1000
+                term = synthesize_modes(Z, C[2], [coef])*1000
                 vals_term = Field(term.ravel(),grid)
                 cs = radial_profile(vals_term,0.005)
                 axs[0].plot(cs[0],cs[1],'--',label=name)
         except:
             if coef < len(C[2]):
-                term = (Z[1].transpose(2,0,1)[coef])*C[2][coef+1]*1000
+                term = synthesize_modes(Z, C[2][1:], [coef])*1000
                 vals_term = Field(term.ravel(),grid)
                 cs = radial_profile(vals_term,0.005)
                 axs[0].plot(cs[0],cs[1],'--',label=name)
@@ -198,12 +203,12 @@ def plot_many_mirror_cs(title,output_ref_set,name_set,include_reference = None,Z
         try:
             for coef in include_reference:
                 name = return_zernike_name(coef)
-                term = (Z[1].transpose(2,0,1)[coef])*C[2][coef]*1000
+                term = synthesize_modes(Z, C[2], [coef])*1000
                 vals_term = Field(term.ravel(),grid)
                 cs = radial_profile(vals_term,0.005)
                 axs.plot(cs[0],cs[1],'--',return_zernike_name(coef))
         except:
-            term = (Z[1].transpose(2,0,1)[include_reference])*C[2][include_reference]*1000
+            term = synthesize_modes(Z, C[2], [include_reference])*1000
             vals_term = Field(term.ravel(),grid)
             cs = radial_profile(vals_term,0.005)
             axs.plot(cs[0],cs[1],'--',return_zernike_name(include_reference))
@@ -413,7 +418,7 @@ def create_4d_plot(M,C,Z,OD):
     coef_normal = [0,1,2,4]
     coef_correctable = [0,1,2,3,4,5,6,9,10,14,15,20]
 
-    surface_normal = remove_modes(M,C,Z,coef_normal)
+    surface_normal = remove_zernike_modes(Z, M[1], C[2], coef_normal)
 
     fig = plt.figure()
     gs0 = gridspec.GridSpec(3,2)
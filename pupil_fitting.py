@@ -0,0 +1,283 @@
+"""
+Fast pupil fitting for 4D interferometer frames.
+
+The pupil is found from the outer edge of the valid-data mask: the first and
+last valid pixel of every row and column are fitted with an algebraic
+least-squares circle, outliers are rejected, and the result is optionally
+polished with a few Gauss-Newton steps on the geometric distance.  Returns
+(x, y, r) in pixels, in the same convention as define_pupil_using_optimization
+and cv.HoughCircles.
+
+IntegralPupilMerit is a fast backend for the optimizer-based pupil definition,
+define_pupil_pyramid runs the Hough or optimizer search coarse-to-fine on a
+downsampled validity mask, and define_pupil_hough_parallel runs the Hough blur
+scales concurrently.
+"""
+
+import numpy as np
+import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+from scipy.optimize import minimize
+
+def pupil_edge_points(valid):
+    """
+    Outer edge of a boolean validity mask, sampled along rows and columns.
+
+    Points lie half a pixel outside the outermost valid pixel centers, i.e. on the
+    boundary between valid and invalid pixels, so a circle through them matches the
+    ``distance < r`` convention of the pupil merit function. The central obscuration
+    never produces points because only the outermost pixels of each line are used.
+    """
+    rows = np.flatnonzero(valid.any(axis=1))
+    cols = np.flatnonzero(valid.any(axis=0))
+    valid_rows = valid[rows]
+    valid_cols = valid[:, cols]
+    left = np.argmax(valid_rows, axis=1)
+    right = valid.shape[1] - 1 - np.argmax(valid_rows[:, ::-1], axis=1)
+    top = np.argmax(valid_cols, axis=0)
+    bottom = valid.shape[0] - 1 - np.argmax(valid_cols[::-1], axis=0)
+
+    x = np.concatenate([left - 0.5, right + 0.5, cols, cols]).astype(float)
+    y = np.concatenate([rows, rows, top - 0.5, bottom + 0.5]).astype(float)
+    return x, y
+
+def fit_circle_algebraic(x, y):
+    #Kasa fit: least squares on x^2 + y^2 + D*x + E*y + F = 0, centered for conditioning
+    x0, y0 = np.mean(x), np.mean(y)
+    u, v = x - x0, y - y0
+    A = np.column_stack([u, v, np.ones_like(u)])
+    sol = np.linalg.lstsq(A, u**2 + v**2, rcond=None)[0]
+    a, b = sol[0] / 2, sol[1] / 2
+    r = np.sqrt(sol[2] + a**2 + b**2)
+    return np.array([a + x0, b + y0, r])
+
+def refine_circle_geometric(x, y, xyr, iterations=5, tol=1e-4):
+    #Gauss-Newton on the orthogonal distances of the points to the circle
+    xyr = np.array(xyr, dtype=float)
+    for _ in range(iterations):
+        dx, dy = x - xyr[0], y - xyr[1]
+        dist = np.hypot(dx, dy)
+        dist[dist == 0] = np.finfo(float).eps
+        J = np.column_stack([-dx / dist, -dy / dist, -np.ones_like(dist)])
+        step = np.linalg.lstsq(J, -(dist - xyr[2]), rcond=None)[0]
+        xyr += step
+        if np.max(np.abs(step)) < tol:
+            break
+    return xyr
+
+def define_pupil_analytic(data_image, refine=True, outlier_sigma=3.0, max_rejections=3):
+    """
+    Fit the pupil of a frame from the edge of its valid data.
+
+    Parameters
+    ----------
+    data_image : ndarray
+        Preprocessed frame with NaN outside the measured pupil
+    refine : bool
+        Polish the algebraic fit with a geometric (orthogonal distance) fit
+    outlier_sigma : float
+        Edge points further than this many robust sigmas from the circle are dropped
+        (stray valid pixels outside the pupil, user crops)
+    max_rejections : int
+        Number of fit / reject rounds
+
+    Returns
+    -------
+    xyr : ndarray
+        (x_center, y_center, radius) in pixels
+    """
+    valid = ~np.isnan(data_image)
+    x, y = pupil_edge_points(valid)
+    if len(x) < 3:
+        raise ValueError("Not enough valid data to fit a pupil")
+
+    xyr = fit_circle_algebraic(x, y)
+    for _ in range(max_rejections):
+        residual = np.abs(np.hypot(x - xyr[0], y - xyr[1]) - xyr[2])
+        sigma = 1.4826 * np.median(residual)
+        keep = residual <= max(outlier_sigma * sigma, 1.0)
+        if keep.all():
+            break
+        x, y = x[keep], y[keep]
+        xyr = fit_circle_algebraic(x, y)
+
+    if refine:
+        xyr = refine_circle_geometric(x, y, xyr)
+    return xyr
+
+class IntegralPupilMerit:
+    """
+    Drop-in replacement for continuous_pupil_merit_function on a binary threshold image.
+
+    Row-wise cumulative sums of thresh_image are computed once; a candidate circle is
+    then scored by summing the chord of every row it covers, so each evaluation costs
+    O(radius) instead of several full-image passes. Values match the full-image merit
+    (up to pixels lying exactly on the circle).
+
+    Usage: ``minimize(IntegralPupilMerit(thresh_image), xyr, method='Nelder-Mead')``
+    """
+
+    def __init__(self, thresh_image, inside_pupil_weight=1, outside_pupil_weight=1):
+        thresh = np.asarray(thresh_image)  # float or boolean; summed in float64 without a converted copy
+        self.shape = thresh.shape
+        self.inside_pupil_weight = inside_pupil_weight
+        self.outside_pupil_weight = outside_pupil_weight
+        # row_sums[j, k] = sum(thresh[j, :k])
+        self.row_sums = np.zeros((self.shape[0], self.shape[1] + 1))
+        np.cumsum(thresh, axis=1, dtype=float, out=self.row_sums[:, 1:])
+        self.max_value = float(np.max(thresh))
+        self.total_spots = np.sum(self.row_sums[:, -1])
+        self.total_spaces = thresh.size * self.max_value - self.total_spots
+
+    def inside_counts(self, xyr):
+        #(pixels, spots) strictly inside the circle, pixel centers at integer coordinates
+        x, y, r = xyr
+        rows = np.arange(max(int(np.ceil(y - r)), 0), min(int(np.floor(y + r)), self.shape[0] - 1) + 1)
+        half_chord_sq = r**2 - (rows - y)**2
+        rows, half_chord = rows[half_chord_sq > 0], np.sqrt(half_chord_sq[half_chord_sq > 0])
+        lo = np.clip(np.floor(x - half_chord).astype(int) + 1, 0, self.shape[1])
+        hi = np.clip(np.ceil(x + half_chord).astype(int), 0, self.shape[1])
+        hi = np.maximum(hi, lo)
+        area = np.sum(hi - lo)
+        spots = np.sum(self.row_sums[rows, hi] - self.row_sums[rows, lo])
+        return area, spots
+
+    def __call__(self, xyr):
+        area, spots_inside = self.inside_counts(xyr)
+        spots_outside = self.total_spots - spots_inside
+        spaces_inside = area * self.max_value - spots_inside
+        spaces_outside = self.total_spaces - spaces_inside
+
+        good_pupil = spots_inside**self.inside_pupil_weight + spaces_outside
+        bad_pupil = spots_outside**self.outside_pupil_weight + spaces_inside
+        return (bad_pupil - good_pupil) / (self.total_spots + self.total_spaces)
+
+PYRAMID_FACTORS = (8, 2, 1)
+PYRAMID_XATOL = 0.25  # simplex tolerance on the coarse levels, in pixels of that level
+FINAL_XATOL = 0.05    # simplex tolerance at full resolution, in pixels
+
+def downsample_mask(valid, factor):
+    #Fraction of valid pixels in each factor x factor block (trailing partial blocks are dropped)
+    if factor == 1:
+        return valid
+    h, w = (valid.shape[0] // factor) * factor, (valid.shape[1] // factor) * factor
+    # INTER_AREA with an integer factor is an exact block mean, and much faster than a numpy reduction
+    return cv.resize(np.asarray(valid[:h, :w], dtype=np.float32), (w // factor, h // factor), interpolation=cv.INTER_AREA)
+
+def _rescale_circle(xyr, factor_from, factor_to):
+    #Block k at downsampling factor f is centered on full-resolution pixel f*k + (f-1)/2
+    x, y, r = xyr
+    x = (factor_from * x + (factor_from - 1) / 2 - (factor_to - 1) / 2) / factor_to
+    y = (factor_from * y + (factor_from - 1) / 2 - (factor_to - 1) / 2) / factor_to
+    return np.array([x, y, r * factor_from / factor_to])
+
+def _hough_coarse(fraction, radius_guess, max_fudge=10):
+    img = cv.medianBlur((255 * fraction).astype('uint8'), 3)
+    for fudge in range(1, max_fudge):
+        circle = cv.HoughCircles(img, cv.HOUGH_GRADIENT, 1, 10000, param1=20, param2=15,
+                                 minRadius=max(int(np.floor(radius_guess)) - fudge, 1),
+                                 maxRadius=int(np.ceil(radius_guess)) + fudge)
+        if circle is not None:
+            return np.asarray(circle[0][0], dtype=float)
+    return None
+
+def define_pupil_pyramid(data_image, coarse='optimizer', factors=PYRAMID_FACTORS, window=1.0, radius_guess=None):
+    """
+    Coarse-to-fine pupil search on a pyramid of validity masks.
+
+    The pupil is first located on the most downsampled mask, with the Hough transform
+    (coarse='hough') or Nelder-Mead on IntegralPupilMerit from the usual
+    (shape/2, shape/4) guess (coarse='optimizer'). Each finer level then runs a short
+    Nelder-Mead on its own mask, starting from the previous estimate with a simplex of
+    `window` pixels, so the full-resolution level only polishes a sub-pixel estimate.
+
+    Parameters
+    ----------
+    data_image : ndarray
+        Preprocessed frame with NaN outside the measured pupil
+    coarse : str
+        'hough' or 'optimizer', the detector used on the coarsest level
+    factors : sequence of int
+        Downsampling factors from coarse to fine; should end with 1
+    window : float
+        Initial simplex size at each refinement level, in pixels of that level
+    radius_guess : float or None
+        Expected pupil radius in full-resolution pixels, used by the Hough search.
+        Default: half the extent of the valid data.
+
+    Returns
+    -------
+    xyr : ndarray
+        (x_center, y_center, radius) in full-resolution pixels
+    """
+    valid = ~np.isnan(data_image)
+    factors = list(factors)
+    xyr = None
+
+    if coarse == 'hough':
+        if radius_guess is None:
+            rows = np.flatnonzero(valid.any(axis=1))
+            radius_guess = (rows[-1] - rows[0]) / 2
+        xyr = _hough_coarse(downsample_mask(valid, factors[0]), radius_guess / factors[0])
+    elif coarse != 'optimizer':
+        raise ValueError(f"Unknown coarse detector '{coarse}', expected 'hough' or 'optimizer'")
+
+    if xyr is None:
+        fraction = downsample_mask(valid, factors[0])
+        guess = [int(fraction.shape[0] / 2), int(fraction.shape[1] / 2), int(np.max(fraction.shape) / 4)]
+        xyr = minimize(IntegralPupilMerit(fraction), guess, method='Nelder-Mead',
+                       options={'xatol': PYRAMID_XATOL, 'fatol': np.inf}).x
+
+    for previous, factor in zip(factors[:-1], factors[1:]):
+        xyr = _rescale_circle(xyr, previous, factor)
+        simplex = np.vstack([xyr, xyr + [window, 0, 0], xyr + [0, window, 0], xyr + [0, 0, window]])
+        merit = IntegralPupilMerit(downsample_mask(valid, factor))
+        # The merit is piecewise constant, so convergence is judged on the simplex size only
+        xatol = FINAL_XATOL if factor == factors[-1] else PYRAMID_XATOL
+        xyr = minimize(merit, xyr, method='Nelder-Mead', options={'initial_simplex': simplex, 'xatol': xatol, 'fatol': np.inf}).x
+
+    return _rescale_circle(xyr, factors[-1], 1)
+
+HOUGH_KSIZES = (61, 81, 101)
+HOUGH_FIRST_MARGIN = 1   # first radius band around OD/2 (pixels), the one the retrying search starts with
+HOUGH_RADIUS_MARGIN = 8  # widest band around OD/2 (pixels), the one the retrying search accepts; OD is measured from the valid data
+
+def _hough_at_scale(img, ksize, OD, radius_margin, first_margin=HOUGH_FIRST_MARGIN):
+    #Search the narrow band first, then the whole plausible band once; returns (circle or None, calls made)
+    blurred = cv.medianBlur(img, ksize)
+    margins = (first_margin, radius_margin) if first_margin < radius_margin else (radius_margin,)
+    for n_calls, margin in enumerate(margins, 1):
+        circle = cv.HoughCircles(blurred, cv.HOUGH_GRADIENT, 1, int(OD), param1=20, param2=15,
+                                 minRadius=int(np.floor(OD/2) - margin), maxRadius=int(np.ceil(OD/2) + margin))
+        if circle is not None:
+            return circle[0][0], n_calls
+    return None, n_calls
+
+def define_pupil_hough_parallel(img, OD, ksizes=HOUGH_KSIZES, radius_margin=HOUGH_RADIUS_MARGIN):
+    """
+    Hough pupil detection with the blur scales run concurrently.
+
+    Each scale is median blurred once and searched in the same narrow radius band the
+    retrying search starts with; if that finds nothing, the whole band it would accept,
+    OD/2 +- radius_margin, is searched in a single further call instead of widening the
+    band one pixel per retry. OpenCV releases the GIL, so the scales run in parallel
+    threads. A circle found only in the wide band can come out a few pixels smaller
+    than with the retrying search, which only trims more of the noisy edge.
+
+    Parameters
+    ----------
+    img : ndarray
+        uint8 image from surface_processing.hough_image
+    OD : float
+        Expected pupil diameter in pixels
+
+    Returns
+    -------
+    circles : list
+        (x, y, r) for each scale that found a circle; empty if none did
+    n_calls : int
+        Number of cv.HoughCircles calls made (one or two per scale)
+    """
+    with ThreadPoolExecutor(max_workers=len(ksizes)) as pool:
+        found = list(pool.map(lambda ksize: _hough_at_scale(img, ksize, OD, radius_margin), ksizes))
+    return [circle for circle, _ in found if circle is not None], sum(n_calls for _, n_calls in found)
@@ -0,0 +1,125 @@
+"""
+Precomputed resampling of cropped frames onto the square output grid.
+
+The importers resample each cropped frame with an interpolating bicubic spline
+(RectBivariateSpline, s=0).  That spline is linear in the data and separable,
+so resampling is ``Wy @ frame @ Wx.T`` with two fixed 1D weight matrices that
+depend only on the crop size and the two grids.  The weights of an
+interpolating cubic decay geometrically away from each sample, so entries
+below WEIGHT_TOLERANCE are dropped and the matrices are stored sparse (~40
+non-zeros per output row, independent of the crop size).  Operators are
+cached per geometry, so every frame of a session - or a whole stack at once -
+is resampled with two sparse products and no spline fit.
+
+match_zernike_basis brings a Zernike basis onto the same grid when the
+pipeline runs at a grid size other than the one the basis was built for
+(e.g. the quick-look tier).
+"""
+
+from functools import lru_cache
+import numpy as np
+import scipy.sparse as sparse
+from scipy import interpolate
+from scipy.ndimage import map_coordinates, distance_transform_edt
+
+WEIGHT_TOLERANCE = 1e-12
+MATCHED_BASIS_CACHE_SIZE = 4
+
+# (id(Z[1]), grid_size) -> (Z[1], matched basis); the source array is held so its id stays valid
+_matched_bases = {}
+
+def spline_weights(source, target, tol=WEIGHT_TOLERANCE):
+    #Sparse (len(target), len(source)) matrix evaluating the not-a-knot interpolating cubic through source at target
+    weights = interpolate.make_interp_spline(source, np.eye(len(source)), k=3)(target)
+    weights[np.abs(weights) < tol] = 0
+    return sparse.csr_matrix(weights)
+
+class ResamplingOperator:
+    """
+    Separable linear operator from a (n_rows, n_cols) crop to a (grid_size, grid_size) grid.
+
+    Matches ``interpolate.RectBivariateSpline(ys, xs, frame)(yi, xi)`` to ~1e-12 of the data
+    range, where ys / xs span [-source_half_width, source_half_width] with one sample per
+    row / column and yi = xi = linspace(-output_half_width, output_half_width, grid_size).
+    """
+
+    def __init__(self, n_rows, n_cols, source_half_width, grid_size, output_half_width):
+        ys = np.linspace(-source_half_width, source_half_width, n_rows)
+        xs = np.linspace(-source_half_width, source_half_width, n_cols)
+        xi = np.linspace(-output_half_width, output_half_width, grid_size)
+        self.source_shape = (n_rows, n_cols)
+        self.grid_size = grid_size
+        self.Wy = spline_weights(ys, xi)
+        self.Wx = spline_weights(xs, xi)
+        self._single = None
+
+    def weights(self, dtype):
+        #(Wy, Wx) in dtype; the float32 copies are made on first use
+        if np.dtype(dtype) != np.float32:
+            return self.Wy, self.Wx
+        if self._single is None:
+            self._single = (self.Wy.astype(np.float32), self.Wx.astype(np.float32))
+        return self._single
+
+    def apply(self, frames, dtype=None):
+        """
+        Resample one frame (n_rows, n_cols) or a stack (N, n_rows, n_cols).
+
+        Frames must not contain NaN (fill holes first). Returns (grid_size, grid_size)
+        or (N, grid_size, grid_size) in float64, or in float32 with dtype=np.float32.
+        """
+        dtype = np.float32 if dtype is not None and np.dtype(dtype) == np.float32 else np.float64
+        frames = np.asarray(frames, dtype=dtype)
+        if frames.ndim == 3:
+            # Looping keeps both products in the fast path; folding the stack into wider products
+            # needs two extra transposed copies and was measured slower
+            return np.stack([self.apply(frame, dtype) for frame in frames])
+        Wy, Wx = self.weights(dtype)
+        # Sparse @ dense with the dense operand C-contiguous is the fast path in scipy.sparse
+        cols_done = Wx @ np.ascontiguousarray(frames.T)  # (grid x, n_rows)
+        return Wy @ np.ascontiguousarray(cols_done.T)
+
+@lru_cache(maxsize=16)
+def resampling_operator(n_rows, n_cols, source_half_width, grid_size, output_half_width):
+    #Cached ResamplingOperator; all frames cropped with the same circle share one
+    return ResamplingOperator(n_rows, n_cols, float(source_half_width), grid_size, float(output_half_width))
+
+def resample_zernike_basis(Z, grid_size):
+    """
+    Zernike matrix tuple resampled onto a (grid_size, grid_size) grid spanning the same aperture.
+
+    Each mode is interpolated bilinearly from a copy whose NaN region (outside the aperture)
+    is filled with the nearest valid pixel, so output pixels at the aperture edge stay defined.
+    Output pixels with no valid source pixel among their four neighbors are NaN again. The
+    flat matrix is a view of the 3D one, as in the source basis.
+    """
+    Z1 = np.asarray(Z[1])
+    u = np.linspace(0, Z1.shape[0] - 1, grid_size)
+    rows, cols = np.meshgrid(u, u, indexing='ij')
+    coords = np.array([rows.ravel(), cols.ravel()])
+
+    holes = np.isnan(Z1[..., 0])
+    outside = map_coordinates((~holes).astype(float), coords, order=1) == 0
+    nearest = tuple(i[holes] for i in distance_transform_edt(holes, return_distances=False, return_indices=True))
+
+    Z1_out = np.empty((grid_size, grid_size, Z1.shape[2]), dtype=Z1.dtype)
+    Z0_out = Z1_out.reshape(grid_size * grid_size, Z1.shape[2])
+    for k in range(Z1.shape[2]):
+        mode = Z1[..., k].copy()
+        mode[holes] = mode[nearest]
+        Z0_out[:, k] = map_coordinates(mode, coords, order=1)
+    Z0_out[outside] = np.nan
+    return (Z0_out, Z1_out) + tuple(Z[2:])
+
+def match_zernike_basis(Z, grid_size):
+    #Z unchanged if it is already on grid_size, otherwise a cached resampled copy
+    if Z is None or Z[1].shape[0] == grid_size:
+        return Z
+    key = (id(Z[1]), grid_size)
+    entry = _matched_bases.get(key)
+    if entry is None or entry[0] is not Z[1]:
+        if len(_matched_bases) >= MATCHED_BASIS_CACHE_SIZE:
+            _matched_bases.pop(next(iter(_matched_bases)))
+        entry = (Z[1], resample_zernike_basis(Z, grid_size))
+        _matched_bases[key] = entry
+    return entry[1]
@@ -0,0 +1,191 @@
+"""
+Single-file archives for measurement sessions.
+
+A session folder (raw 4D .h5 frames plus processed products) is packed into one
+chunked, gzip-compressed HDF5 file next to the folder, e.g. ``M10/20240815/0``
+becomes ``M10/20240815/0.session.h5``.  Layout::
+
+    /frames/<name>     raw genraw array of each frame, as saved by the 4D software
+    /circles           (N, 3) detected pupil (x, y, r) per frame, in frame order
+    /ID                (N,) inner diameter estimate per frame
+    /surface           averaged surface
+    /surface_std       per-pixel standard deviation across frames
+    /coefficients      Zernike coefficients of the averaged surface
+
+Processing parameters are stored as JSON in the ``params`` root attribute.
+SessionArchive opens the file lazily, so any single product can be read without
+touching the others.
+"""
+
+import os
+import sys
+import json
+import datetime
+import h5py
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from . import surface_cache
+    from .surface_processing import read_genraw_data, measure_h5_circle
+    from .zernike_fit import decompose_surfaces
+    from .resampling import match_zernike_basis
+except ImportError:
+    import surface_cache
+    from surface_processing import read_genraw_data, measure_h5_circle
+    from zernike_fit import decompose_surfaces
+    from resampling import match_zernike_basis
+
+SESSION_ARCHIVE_EXT = '.session.h5'
+COMPRESSION = 'gzip'
+COMPRESSION_LEVEL = 4
+CHUNK_EDGE = 256
+
+def archive_path_for(folder):
+    return os.path.normpath(folder) + SESSION_ARCHIVE_EXT
+
+def is_session_archive(path):
+    return str(path).endswith(SESSION_ARCHIVE_EXT) and os.path.isfile(path)
+
+def _chunks(shape):
+    return tuple(min(n, CHUNK_EDGE) for n in shape)
+
+def _write_array(group, name, data):
+    data = np.asarray(data)
+    if data.ndim == 0 or data.size < 2:
+        return group.create_dataset(name, data=data)
+    return group.create_dataset(name, data=data, chunks=_chunks(data.shape), compression=COMPRESSION,
+                                compression_opts=COMPRESSION_LEVEL, shuffle=True)
+
+def write_session_archive(folder, clear_outer, clear_inner, Z, ID_crop=1.25, archive_path=None, overwrite=False):
+    """
+    Pack a measurement folder into a single session archive.
+
+    Processed products come from the surface / frame caches when available, so
+    archiving an already loaded session does not reprocess it.
+
+    Parameters
+    ----------
+    folder : str
+        Measurement folder containing the .h5 frames
+    clear_outer, clear_inner, Z, ID_crop
+        Processing parameters, as for data_loader.load_measurements
+    archive_path : str or None
+        Output file. Default: the folder path with SESSION_ARCHIVE_EXT appended.
+    overwrite : bool
+        Replace an existing archive
+
+    Returns
+    -------
+    archive_path : str
+    """
+    try:
+        from .data_loader import load_measurements, _processing_params
+    except ImportError:
+        from data_loader import load_measurements, _processing_params
+
+    if archive_path is None:
+        archive_path = archive_path_for(folder)
+    if os.path.exists(archive_path) and not overwrite:
+        raise FileExistsError(f"Session archive already exists: {archive_path}")
+
+    names = sorted(file for file in os.listdir(folder) if file.endswith(".h5"))
+    files = [os.path.join(folder, name) for name in names]
+
+    params = _processing_params(clear_outer, clear_inner, ID_crop)
+    key = surface_cache.cache_key(folder, params, Z)
+    cached = surface_cache.load_cached_surface(folder, key, with_std=True)
+    if cached is None:
+        load_measurements(folder, clear_outer, clear_inner, Z, ID_crop)
+        cached = surface_cache.load_cached_surface(folder, key, with_std=True)
+    surface, surface_std = cached
+
+    circles, IDs = [], []
+    for path in files:
+        entry = surface_cache.load_frame_entry(path)
+        if entry is None:
+            data, circle, ID = measure_h5_circle(path, use_optimizer=True)
+            entry = {'circle': circle, 'ID': ID}
+        circles.append(np.asarray(entry['circle'], dtype=float))
+        IDs.append(entry['ID'])
+
+    tmp_path = archive_path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['params'] = json.dumps(params)
+        f.attrs['source_folder'] = os.path.abspath(folder)
+        f.attrs['created'] = datetime.datetime.now().isoformat(timespec='seconds')
+        f.attrs['frame_names'] = json.dumps(names)
+
+        frames = f.create_group('frames')
+        for name, path in zip(names, files):
+            _write_array(frames, name, read_genraw_data(path))
+
+        _write_array(f, 'circles', np.reshape(circles, (-1, 3)))
+        _write_array(f, 'ID', np.asarray(IDs, dtype=float))
+        _write_array(f, 'surface', surface)
+        if surface_std is not None:
+            _write_array(f, 'surface_std', surface_std)
+        if Z is not None:
+            _write_array(f, 'coefficients', decompose_surfaces(surface, match_zernike_basis(Z, surface.shape[0]))[0])
+    os.replace(tmp_path, archive_path)
+    return archive_path
+
+class SessionArchive:
+    """
+    Lazy reader for a session archive.
+
+    Products are returned as h5py datasets, so slicing (e.g. ``archive.frame(0)[100:200]``)
+    only decompresses the chunks that are needed. Use as a context manager or call close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = h5py.File(path, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def params(self):
+        return json.loads(self._file.attrs['params'])
+
+    @property
+    def frame_names(self):
+        return json.loads(self._file.attrs['frame_names'])
+
+    def frame(self, index):
+        #Raw genraw dataset by position or file name
+        name = self.frame_names[index] if isinstance(index, (int, np.integer)) else index
+        return self._file['frames'][name]
+
+    @property
+    def circles(self):
+        return self._file['circles']
+
+    @property
+    def ID(self):
+        return self._file['ID']
+
+    @property
+    def surface(self):
+        return self._file['surface']
+
+    @property
+    def surface_std(self):
+        return self._file['surface_std'] if 'surface_std' in self._file else None
+
+    @property
+    def coefficients(self):
+        return self._file['coefficients'] if 'coefficients' in self._file else None
+
+def read_archived_surface(path):
+    #Read only the averaged surface from a session archive
+    with SessionArchive(path) as archive:
+        return archive.surface[()]
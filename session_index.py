@@ -0,0 +1,194 @@
+"""
+Metadata index of the measurement sessions stored for a mirror.
+
+The scanner walks ``<base_path>/<date>/<instance>/*.h5`` and records, for each
+frame, only what can be read without loading data: the genraw dataset shape,
+dtype and attributes plus the file size and timestamp.  Session archives
+(``<instance>.session.h5``) are indexed from their attributes.  The result is
+written to ``session_index.json`` in base_path; rescans reuse entries whose
+size and mtime are unchanged, so keeping the index current costs one stat per
+file.  The index also records the mtime of every directory it scanned, so
+current_session_index can tell whether a saved index is still current (no
+session or frame added, removed or renamed) with one stat per directory and
+only rescans when it is not.
+"""
+
+import os
+import json
+import datetime
+import h5py
+import numpy as np
+
+try:
+    from .config import get_mirror_params
+    from .surface_processing import GENRAW_PATH
+    from .session_archive import SESSION_ARCHIVE_EXT
+except ImportError:
+    from config import get_mirror_params
+    from surface_processing import GENRAW_PATH
+    from session_archive import SESSION_ARCHIVE_EXT
+
+INDEX_FILENAME = 'session_index.json'
+INDEX_VERSION = 1
+
+def _json_safe(value):
+    #Convert h5py attribute values to something json can store; large arrays are summarized
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        if value.size <= 16:
+            return [_json_safe(v) for v in value.ravel()]
+        return f"<array {value.dtype} {list(value.shape)}>"
+    return value
+
+def _read_frame_metadata(path):
+    with h5py.File(path, 'r') as f:
+        dset = f[GENRAW_PATH]
+        meta = {
+            'shape': list(dset.shape),
+            'dtype': dset.dtype.str,
+            'attrs': {key: _json_safe(val) for key, val in dset.attrs.items()},
+        }
+        if 'measurement0' in f:
+            meta['measurement_attrs'] = {key: _json_safe(val) for key, val in f['measurement0'].attrs.items()}
+    return meta
+
+def _read_archive_metadata(path):
+    with h5py.File(path, 'r') as f:
+        return {'frame_names': json.loads(f.attrs['frame_names']), 'params': json.loads(f.attrs['params'])}
+
+def _file_entry(path, previous):
+    #Reuse the previous entry if the file is unchanged, otherwise read its metadata
+    st = os.stat(path)
+    if previous is not None and previous['size'] == st.st_size and previous['mtime_ns'] == st.st_mtime_ns:
+        return previous
+    entry = {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'timestamp': datetime.datetime.fromtimestamp(st.st_mtime).isoformat(timespec='seconds'),
+    }
+    try:
+        entry.update(_read_archive_metadata(path) if path.endswith(SESSION_ARCHIVE_EXT) else _read_frame_metadata(path))
+    except (OSError, KeyError, ValueError) as e:
+        entry['error'] = str(e)
+    return entry
+
+def _visible_dirs(path):
+    return sorted(d.name for d in os.scandir(path) if d.is_dir() and not d.name.startswith('.'))
+
+def build_session_index(base_path, write=True):
+    """
+    Scan a mirror's data folder and return (and optionally save) its session index.
+
+    Returns
+    -------
+    index : dict
+        {'version', 'base_path', 'updated', 'sessions'}, where sessions maps
+        "<date>/<instance>" to {'date', 'instance', 'archive', 'has_average', 'frames'}
+        and frames maps file names to their metadata.
+    """
+    previous = load_session_index(base_path) or {}
+    previous_sessions = previous.get('sessions', {})
+    sessions = {}
+    directories = {}  # date and session folders -> mtime; base_path itself changes whenever the index is saved
+
+    for date in _visible_dirs(base_path):
+        date_path = os.path.join(base_path, date)
+        directories[date] = os.stat(date_path).st_mtime_ns
+        for instance in _visible_dirs(date_path):
+            key = f"{date}/{instance}"
+            old_frames = previous_sessions.get(key, {}).get('frames', {})
+            instance_path = os.path.join(date_path, instance)
+            directories[key] = os.stat(instance_path).st_mtime_ns
+            files = sorted(f for f in os.listdir(instance_path) if f.endswith('.h5'))
+            sessions[key] = {
+                'date': date, 'instance': instance, 'archive': False,
+                'has_average': os.path.exists(os.path.join(instance_path, 'averaged_surface.npy')),
+                'frames': {f: _file_entry(os.path.join(instance_path, f), old_frames.get(f)) for f in files},
+            }
+        for archive in sorted(f for f in os.listdir(date_path) if f.endswith(SESSION_ARCHIVE_EXT)):
+            instance = archive[:-len(SESSION_ARCHIVE_EXT)]
+            key = f"{date}/{instance}"
+            if key in sessions:
+                continue  # the unpacked folder takes precedence
+            old_entry = previous_sessions.get(key, {}).get('frames', {}).get(archive)
+            sessions[key] = {
+                'date': date, 'instance': instance, 'archive': True, 'has_average': True,
+                'frames': {archive: _file_entry(os.path.join(date_path, archive), old_entry)},
+            }
+
+    index = {
+        'version': INDEX_VERSION,
+        'base_path': os.path.abspath(base_path),
+        'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+        'sessions': sessions,
+        'directories': directories,
+    }
+    if write:
+        path = os.path.join(base_path, INDEX_FILENAME)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass  # read-only data directories still get an in-memory index
+    return index
+
+def scan_mirror(mirror_num, write=True):
+    #Build the session index for a mirror number using its configured base_path
+    return build_session_index(get_mirror_params(str(mirror_num))["base_path"], write=write)
+
+def load_session_index(base_path):
+    #Return the saved index for base_path, or None if missing or from another index version
+    try:
+        with open(os.path.join(base_path, INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('version') == INDEX_VERSION else None
+
+def index_is_current(index, base_path):
+    """
+    True if no directory scanned for the index has changed since it was built.
+
+    Adding, removing or renaming a frame or session changes the mtime of its directory,
+    and the date folders are compared by listing base_path, so this costs one stat per
+    directory instead of one per file. Frames rewritten in place under the same name
+    are not detected.
+    """
+    directories = index.get('directories')
+    if directories is None or index.get('base_path') != os.path.abspath(base_path):
+        return False
+    try:
+        if set(_visible_dirs(base_path)) != {path for path in directories if '/' not in path}:
+            return False
+        return all(os.stat(os.path.join(base_path, path)).st_mtime_ns == mtime_ns for path, mtime_ns in directories.items())
+    except OSError:
+        return False
+
+def current_session_index(base_path, write=True):
+    #Saved index for base_path if it is still current, otherwise a rescan (which reuses unchanged entries)
+    index = load_session_index(base_path)
+    if index is not None and index_is_current(index, base_path):
+        return index
+    return build_session_index(base_path, write=write)
+
+def list_dates(index):
+    return sorted({session['date'] for session in index['sessions'].values()})
+
+def list_instances(index, date):
+    return sorted(session['instance'] for session in index['sessions'].values() if session['date'] == date)
+
+def session_path(index, date, instance):
+    #Folder (or archive file) for a session listed in the index
+    session = index['sessions'][f"{date}/{instance}"]
+    path = os.path.join(index['base_path'], date, instance)
+    return path + SESSION_ARCHIVE_EXT if session['archive'] else path
+
+def frame_count(index, date, instance):
+    session = index['sessions'][f"{date}/{instance}"]
+    if session['archive']:
+        return len(next(iter(session['frames'].values())).get('frame_names', []))
+    return len(session['frames'])
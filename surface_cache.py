@@ -0,0 +1,204 @@
+"""
+Parameter-aware caches for averaged surfaces and per-frame intermediates.
+
+Each measurement folder gets a hidden ``.surface_cache`` directory holding one
+averaged surface (and its std map) per processing variant.  Entries are keyed by
+a fingerprint of the .h5 inputs (names, sizes, mtimes) together with the
+processing parameters, so changing either one misses the cache instead of
+returning a stale surface.  An ``index.json`` tracks entry sizes and last use
+for LRU eviction.
+"""
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+CACHE_DIRNAME = '.surface_cache'
+INDEX_FILENAME = 'index.json'
+CACHE_VERSION = 2  # bump when the processing pipeline changes in a way that alters results
+
+MAX_ENTRIES = 8
+MAX_BYTES = 256 * 1024**2
+
+def input_fingerprint(folder, extension='.h5'):
+    #(name, size, mtime) for every input file, in a stable order
+    entries = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(extension):
+                st = entry.stat()
+                entries.append([entry.name, st.st_size, st.st_mtime_ns])
+    return sorted(entries)
+
+def basis_fingerprint(Z):
+    #Cheap identifier for a Zernike matrix: shape plus a hash of a strided sample of its values
+    if Z is None:
+        return None
+    Z_flat = np.asarray(Z[0])
+    sample = np.ascontiguousarray(Z_flat.reshape(-1)[::1009])
+    return [list(Z_flat.shape), hashlib.sha1(sample.tobytes()).hexdigest()]
+
+def cache_key(folder, params, Z=None):
+    """
+    Build the cache key for a measurement folder.
+
+    Parameters
+    ----------
+    folder : str
+        Measurement folder containing the .h5 frames
+    params : dict
+        JSON-serializable processing parameters (clear apertures, ID crop, ...)
+    Z : tuple or None
+        Zernike matrix used for the fit
+    """
+    payload = {
+        'version': CACHE_VERSION,
+        'inputs': input_fingerprint(folder),
+        'params': params,
+        'basis': basis_fingerprint(Z),
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=float).encode()).hexdigest()[:20]
+
+def _cache_dir(folder):
+    return os.path.join(folder, CACHE_DIRNAME)
+
+def _read_index(folder):
+    try:
+        with open(os.path.join(_cache_dir(folder), INDEX_FILENAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_index(folder, index):
+    path = os.path.join(_cache_dir(folder), INDEX_FILENAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, path)
+
+def _entry_paths(folder, key):
+    base = os.path.join(_cache_dir(folder), key)
+    return base + '.npy', base + '_std.npy'
+
+def load_cached_surface(folder, key, with_std=False):
+    #Return the cached surface (or (surface, std)) for key, or None on a miss
+    surface_path, std_path = _entry_paths(folder, key)
+    if not os.path.exists(surface_path):
+        return None
+    surface = np.load(surface_path)
+
+    index = _read_index(folder)
+    if key in index:
+        index[key]['last_access'] = time.time()
+        try:
+            _write_index(folder, index)
+        except OSError:
+            pass  # read-only data directories still get cache hits
+
+    if with_std:
+        std = np.load(std_path) if os.path.exists(std_path) else None
+        return surface, std
+    return surface
+
+def store_cached_surface(folder, key, surface, std=None, params=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+    #Save a processed surface under key and evict least recently used variants beyond the limits
+    os.makedirs(_cache_dir(folder), exist_ok=True)
+    surface_path, std_path = _entry_paths(folder, key)
+    np.save(surface_path, surface)
+    nbytes = os.path.getsize(surface_path)
+    if std is not None:
+        np.save(std_path, std)
+        nbytes += os.path.getsize(std_path)
+
+    index = _read_index(folder)
+    index[key] = {'params': params, 'bytes': nbytes, 'last_access': time.time()}
+    _evict(folder, index, max_entries, max_bytes)
+    _write_index(folder, index)
+
+def _evict(folder, index, max_entries, max_bytes):
+    by_age = sorted(index, key=lambda k: index[k]['last_access'])
+    total = sum(entry['bytes'] for entry in index.values())
+    # Always keep the most recent entry, even if it alone exceeds max_bytes
+    while len(by_age) > 1 and (len(by_age) > max_entries or total > max_bytes):
+        key = by_age.pop(0)
+        total -= index.pop(key)['bytes']
+        for path in _entry_paths(folder, key):
+            if os.path.exists(path):
+                os.remove(path)
+
+def clear_cache(folder):
+    #Remove every cached variant for a measurement folder
+    index = _read_index(folder)
+    for key in list(index):
+        for path in _entry_paths(folder, key):
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.isdir(_cache_dir(folder)):
+        _write_index(folder, {})
+
+# ---------------------------------------------------------------------------
+# Per-frame sidecar store
+#
+# Pupil detection results and resampled maps for individual frames are kept in
+# ``.frame_cache/<frame>.npz`` next to the frames, so a reload after new frames
+# arrive only processes the new (or modified) files.
+
+FRAME_CACHE_DIRNAME = '.frame_cache'
+
+def frame_fingerprint(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def params_digest(params, Z=None):
+    #Identifier for the parameters a resampled frame map depends on
+    payload = {'version': CACHE_VERSION, 'params': params, 'basis': basis_fingerprint(Z)}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=float).encode()).hexdigest()[:20]
+
+def _frame_entry_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, FRAME_CACHE_DIRNAME, os.path.splitext(name)[0] + '.npz')
+
+def load_frame_entry(path):
+    """
+    Return the cached metadata for a frame file, or None if missing or stale.
+
+    The entry is a dict with 'circle', 'ID' and, if a map was cached, 'map_circle'
+    and 'map_digest'. The map itself is read separately with load_frame_map.
+    """
+    entry_path = _frame_entry_path(path)
+    if not os.path.exists(entry_path):
+        return None
+    try:
+        with np.load(entry_path) as entry:
+            if not np.array_equal(entry['fingerprint'], frame_fingerprint(path)):
+                return None
+            meta = {'circle': entry['circle'], 'ID': float(entry['ID'])}
+            if 'map' in entry.files:
+                meta['map_circle'] = entry['map_circle']
+                meta['map_digest'] = str(entry['map_digest'])
+    except (OSError, ValueError, KeyError):
+        return None
+    return meta
+
+def load_frame_map(path):
+    with np.load(_frame_entry_path(path)) as entry:
+        return entry['map']
+
+def store_frame_entry(path, circle, ID, wf_map=None, map_circle=None, map_digest=None):
+    #Write (or overwrite) the sidecar entry for a frame file
+    entry_path = _frame_entry_path(path)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    arrays = {'fingerprint': frame_fingerprint(path), 'circle': np.asarray(circle, dtype=float), 'ID': np.asarray(ID, dtype=float)}
+    if wf_map is not None:
+        arrays.update(map=wf_map, map_circle=np.asarray(map_circle, dtype=float), map_digest=np.asarray(map_digest))
+    tmp_path = entry_path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, entry_path)
+
+def frame_map_is_current(meta, circle, digest, circle_tolerance=0.0):
+    #True if a cached map was made with the same parameters and (within tolerance, in pixels) the same pupil
+    if meta is None or 'map_digest' not in meta or meta['map_digest'] != digest:
+        return False
+    return np.max(np.abs(np.asarray(meta['map_circle']) - np.asarray(circle))) <= circle_tolerance
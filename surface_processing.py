@@ -1,6 +1,7 @@
 import numpy as np
 import sys
 import os
+from functools import lru_cache
 import h5py
 import cv2 as cv
 import matplotlib.pyplot as plt
@@ -15,32 +16,259 @@ from hcipy import make_pupil_grid, radial_profile, Field
 # Add the parent directory to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from shared.zernike_utils import get_M_and_C, remove_modes, Zernike_decomposition
+try:
+    from .resampling import resampling_operator, match_zernike_basis
+    from .zernike_fit import fit_zernike, fit_operator, basis_valid_rows, remove_zernike_modes, TIP_TILT_POWER_MODES
+    from .nan_fill import fill_nans, DEFAULT_FILL_METHOD
+    from .pupil_fitting import define_pupil_analytic, IntegralPupilMerit, define_pupil_pyramid, define_pupil_hough_parallel, HOUGH_KSIZES, HOUGH_RADIUS_MARGIN
+except ImportError:
+    from resampling import resampling_operator, match_zernike_basis
+    from zernike_fit import fit_zernike, fit_operator, basis_valid_rows, remove_zernike_modes, TIP_TILT_POWER_MODES
+    from nan_fill import fill_nans, DEFAULT_FILL_METHOD
+    from pupil_fitting import define_pupil_analytic, IntegralPupilMerit, define_pupil_pyramid, define_pupil_hough_parallel, HOUGH_KSIZES, HOUGH_RADIUS_MARGIN
+
+GENRAW_PATH = 'measurement0/genraw/data'
+PUPIL_METHODS = ('hough', 'hough_parallel', 'optimizer', 'analytic')
+WARM_START_WINDOW = 3.0  # initial simplex size (pixels) when the optimizer starts from a known circle
+WAVES_TO_UM = 632.8 / 1000  # HeNe wavelength
+
+# Output grid resolutions. 'full' is used for every archival product (saved averaged surfaces, reports);
+# 'quick' gives an approximate surface and coefficients for live previews at a fraction of the cost.
+FULL_GRID_SIZE = 500
+QUICK_LOOK_GRID_SIZE = 128
+GRID_TIERS = {'full': FULL_GRID_SIZE, 'quick': QUICK_LOOK_GRID_SIZE}
+
+# Correction presets: name -> (Zernike modes removed, subtract the radial average first)
+EDGE_CORRECTION_MODES = [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 20, 21, 27, 28, 35, 36, 44]
+SURFACE_PRESETS = {
+    'uncorrected': (list(TIP_TILT_POWER_MODES), False),
+    'sph corrected': (list(TIP_TILT_POWER_MODES), True),
+    'edge corrected': (EDGE_CORRECTION_MODES, False),
+    'all modes removed': (EDGE_CORRECTION_MODES, True),
+}
+
+def resolve_grid_size(grid_size):
+    #Grid size in pixels from a tier name in GRID_TIERS or an explicit size
+    if isinstance(grid_size, str):
+        if grid_size not in GRID_TIERS:
+            raise ValueError(f"Unknown grid tier '{grid_size}', expected one of {tuple(GRID_TIERS)}")
+        return GRID_TIERS[grid_size]
+    return int(grid_size)
+
+def read_genraw_data(filename, dtype=None, out=None, use_mmap=True):
+    """
+    Read the raw 4D measurement array from an h5 file without intermediate copies.
+
+    Contiguous, uncompressed datasets are memory-mapped copy-on-write, so callers can
+    modify the array in place without touching the file. Chunked or compressed datasets
+    (or a dtype conversion) are read straight into a preallocated buffer.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the 4D .h5 file
+    dtype : numpy dtype or None
+        Output dtype (e.g. np.float32). None keeps the on-disk dtype.
+    out : ndarray or None
+        Optional preallocated buffer with the dataset shape, reused across frames
+    use_mmap : bool
+        Allow memory-mapping when the dataset layout permits it
+    """
+    with h5py.File(filename, 'r') as f:
+        dset = f[GENRAW_PATH]
+        shape = dset.shape
+        disk_dtype = dset.dtype
+        target_dtype = disk_dtype if dtype is None else np.dtype(dtype)
+
+        offset = None
+        if use_mmap and out is None and target_dtype == disk_dtype and dset.chunks is None and dset.compression is None:
+            offset = dset.id.get_offset()  # None if the dataset has no storage allocated
+
+        if offset is None:
+            if out is None:
+                out = np.empty(shape, dtype=target_dtype)
+            elif out.shape != shape:
+                raise ValueError(f"Buffer shape {out.shape} does not match dataset shape {shape}")
+            dset.read_direct(out)
+            return out
+
+    return np.memmap(filename, dtype=disk_dtype, mode='c', offset=offset, shape=shape)
+
+def cast_zernike_basis(Z, dtype):
+    #Zernike matrix tuple with its arrays in the given precision (no copy if already there)
+    Z0, Z1 = Z[0], Z[1]
+    same_buffer = (Z0.size == Z1.size and Z0.flags.c_contiguous and Z1.flags.c_contiguous
+                   and Z0.__array_interface__['data'][0] == Z1.__array_interface__['data'][0])
+    Z0 = np.asarray(Z0, dtype=dtype)
+    # Keep the 3D matrix a view of the flat one when it was one, instead of casting twice
+    Z1 = Z0.reshape(Z1.shape) if same_buffer else np.asarray(Z1, dtype=dtype)
+    return (Z0, Z1) + tuple(Z[2:])
+
+@lru_cache(maxsize=32)
+def aperture_mask(grid_size, half_width, outer_radius, inner_radius):
+    """
+    Boolean mask of the pixels outside an annular clear aperture.
+
+    The grid spans [-half_width, half_width] with grid_size samples per axis, the same
+    grid the importers resample onto. Masks are cached per geometry and returned
+    read-only, so apply them with ``surface[mask] = np.nan``.
+    """
+    xi = np.linspace(-half_width, half_width, grid_size)
+    r = np.sqrt(xi[np.newaxis, :]**2 + xi[:, np.newaxis]**2)
+    mask = (r > outer_radius) | (r < inner_radius)
+    mask.flags.writeable = False
+    return mask
+
+def square_crop_slices(shape):
+    #Centered slices that crop a frame to a square aspect ratio
+    asymmetry = max(shape) - min(shape)
+    start = asymmetry // 2
+    if shape[0] > shape[1]:
+        return slice(start, start + shape[1]), slice(None)
+    return slice(None), slice(start, start + shape[0])
+
+def preprocess_frame(data, crop_square=True, min_invalid_count=0, block_rows=64, report_memory=False):
+    """
+    Clean a raw 4D frame in place: invalid sentinel -> NaN, waves -> um, square crop.
+
+    The sentinel is the frame maximum, as written by the 4D software. All steps are
+    applied block-by-block over rows of the cropped region, so no full-frame
+    temporaries are created and the discarded border is never touched.
+
+    Parameters
+    ----------
+    data : ndarray
+        Raw float frame (e.g. from read_genraw_data). Modified in place.
+    crop_square : bool
+        Crop to a centered square before processing
+    min_invalid_count : int
+        Only replace the sentinel if more than this many pixels carry it
+        (unmasked frames have no sentinel, so their maximum is real data)
+    block_rows : int
+        Number of rows processed per block
+    report_memory : bool
+        Print the peak memory allocated while preprocessing this frame
+
+    Returns
+    -------
+    data : ndarray
+        View of the (cropped) frame in um
+    valid : ndarray of bool
+        True where the frame holds a measurement
+    """
+    if report_memory:
+        import tracemalloc
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+    invalid = np.nanmax(data)
+    if crop_square:
+        data = data[square_crop_slices(data.shape)]
+    valid = np.empty(data.shape, dtype=bool)
+
+    replace_invalid = True
+    if min_invalid_count > 0:
+        invalid_count = 0
+        for start in range(0, data.shape[0], block_rows):
+            invalid_count += np.count_nonzero(np.equal(data[start:start + block_rows], invalid, out=valid[start:start + block_rows]))
+        replace_invalid = invalid_count > min_invalid_count
+
+    for start in range(0, data.shape[0], block_rows):
+        block = data[start:start + block_rows]
+        block_valid = valid[start:start + block_rows]
+        if replace_invalid:
+            np.equal(block, invalid, out=block_valid)
+            np.copyto(block, np.nan, where=block_valid)  # remove invalid values
+        np.multiply(block, WAVES_TO_UM, out=block)  # convert from waves to um
+        np.isnan(block, out=block_valid)
+        np.logical_not(block_valid, out=block_valid)
+
+    if report_memory:
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        if started_here:
+            tracemalloc.stop()
+        print(f"Preprocessed {data.shape[0]}x{data.shape[1]} frame, peak memory {peak / 1e6:.2f} MB")
+
+    return data, valid
+
+@lru_cache(maxsize=8)
+def clear_aperture_pupil(grid_size, OD):
+    #Read-only mask of the 3" - 15" clear aperture on a grid spanning the mirror OD
+    X, Y = np.meshgrid(np.linspace(-OD/2, OD/2, grid_size),
+                        np.linspace(-OD/2, OD/2, grid_size))
+    r = np.sqrt(X**2 + Y**2)
+    pupil = (r > 3*25.4e-3) & (r < 15*25.4e-3)
+    pupil.flags.writeable = False
+    return pupil
 
 def prepare_surface(surface, Z, remove_coef, config, crop_ca = True):
-    M, C = get_M_and_C(surface, Z)
+    M = surface.flatten(), surface
+    C = fit_zernike(Z, M)  # factored once per mask, shared by every preset
 
     OD = config["OD"]
 
-    updated_surface = remove_modes(M, C, Z, remove_coef)
+    updated_surface = remove_zernike_modes(Z, surface, C[2], remove_coef)
 
     if crop_ca:
-        X, Y = np.meshgrid(np.linspace(-OD/2, OD/2, surface.shape[0]),
-                            np.linspace(-OD/2, OD/2, surface.shape[0]))
-        r = np.sqrt(X**2 + Y**2)
-        pupil = (r > 3*25.4e-3) & (r < 15*25.4e-3)
-        updated_surface[~pupil] = np.nan
+        updated_surface[~clear_aperture_pupil(surface.shape[0], OD)] = np.nan
 
     return updated_surface
 
+class SurfaceProducts:
+    """
+    Every correction preset of one surface, from one Zernike fit.
+
+    The presets (SURFACE_PRESETS) differ only in which modes are removed and in whether
+    the radial average is subtracted first. The surface is fitted once, the radial
+    average is computed once (and its residual fitted once, with the same cached fit
+    operator), and each product is then a single mode reconstruction. Everything is
+    computed on first use and kept, so switching presets only costs the reconstruction.
+    """
+
+    def __init__(self, surface, Z, config):
+        self.surface = surface
+        self.Z = Z
+        self.config = config
+        self._coefficients = {}
+        self._radial_average = None
+        self._products = {}
+
+    @property
+    def radial_average(self):
+        if self._radial_average is None:
+            self._radial_average = radial_averaged_surface(self.surface, self.config)
+        return self._radial_average
+
+    def base_surface(self, subtract_radial=False):
+        return self.surface - self.radial_average if subtract_radial else self.surface
+
+    def coefficients(self, subtract_radial=False):
+        #Zernike coefficients of the surface (or of the surface minus its radial average)
+        if subtract_radial not in self._coefficients:
+            base = self.base_surface(subtract_radial)
+            self._coefficients[subtract_radial] = fit_zernike(self.Z, (base.ravel(), base))[2]
+        return self._coefficients[subtract_radial]
+
+    def product(self, remove_coef, subtract_radial=False, crop_ca=False):
+        #Same result as prepare_surface(surface [- radial average], Z, remove_coef, config, crop_ca)
+        key = (tuple(remove_coef), subtract_radial, crop_ca)
+        if key not in self._products:
+            product = remove_zernike_modes(self.Z, self.base_surface(subtract_radial), self.coefficients(subtract_radial), remove_coef)
+            if crop_ca:
+                product[~clear_aperture_pupil(product.shape[0], self.config["OD"])] = np.nan
+            self._products[key] = product
+        return self._products[key]
+
+    def preset(self, name, crop_ca=False):
+        remove_coef, subtract_radial = SURFACE_PRESETS[name]
+        return self.product(remove_coef, subtract_radial, crop_ca)
+
 def import_4D_map(filename,Z): #import measured surface from 4D h5 file. input is (filename, Zernike matrix)
     
-    f = h5py.File(filename,'r')
-    data = np.array(list(f['measurement0']['genraw']['data']))
-    
-    invalid = np.nanmax(data)
-    data[data == invalid] = np.nan #remove invalid values
-    data = data*(632.8/1000) #convert from waves to nm
+    data, valid = preprocess_frame(read_genraw_data(filename), crop_square=False) #remove invalid values, convert from waves to um
     
     def select_callback(eclick, erelease): #callback function for cropping the mirror from background
         """
@@ -105,47 +333,32 @@ def import_4D_map(filename,Z): #import measured surface from 4D h5 file. input i
     Z_int = interpolate.RectBivariateSpline(ys,xs,zs_cropped_copy)
     
     xi = yi = np.linspace(-381000,381000,500)
-    X,Y = np.meshgrid(xi,yi)
     
-    zi = Z_int(Y,X,grid = False)  #truncate to clear aperture radius
+    zi = Z_int(yi,xi)  #truncate to clear aperture radius
     
-    test = np.sqrt(X**2 + Y**2)                         #
-    inds = np.where((test > 381000) | (test < 63500))   #
-    coords = list(zip(inds[0],inds[1]))                 #remove data points outside of clear aperture
-    for j,m in enumerate(coords):                       #
-        zi[coords[j][0]][coords[j][1]] = np.nan         #
+    zi[aperture_mask(500, 381000, 381000, 63500)] = np.nan #remove data points outside of clear aperture
         
     M = zi.flatten(),zi
     
-    C = Zernike_decomposition(Z, M, -1) #Zernike fit
-    
-    Piston = (Z[1].transpose(2,0,1)[0])*C[2][0] #
-    TiltY = (Z[1].transpose(2,0,1)[1])*C[2][1]  #remove piston, tip/tilt, and power
-    TiltX = (Z[1].transpose(2,0,1)[2])*C[2][2]  #
-    Power = (Z[1].transpose(2,0,1)[4])*C[2][4]  #
+    C = fit_zernike(Z, M) #Zernike fit
     
-    Surf = M[1] - Piston - TiltX - TiltY - Power ##remove piston, tip/tilt, and power
+    Surf = remove_zernike_modes(Z, M[1], C[2], TIP_TILT_POWER_MODES) #remove piston, tip/tilt, and power
        
     return Surf.flatten(),Surf #return 1D flattened surface and 2D surface
 
     
-def import_4D_map_auto(filename,Z,normal_tip_tilt_power=True,remove_coef = []):
+def import_4D_map_auto(filename,Z,normal_tip_tilt_power=True,remove_coef = [], grid_size=FULL_GRID_SIZE):
+    #grid_size is the output resolution in pixels or a GRID_TIERS name; Z is resampled to match if needed
+    grid_size = resolve_grid_size(grid_size)
+    Z = match_zernike_basis(Z, grid_size)
 
     #Mirror radius in um
     pixel_ID = 1.5*25.4*1e3  #original value: 63500 . Changed from 1000 on 8/15/2024
     pixel_OD = 15*25.4*1e3 #original value: 381000. Changed from 381000 on 8/15/2024
     
-    f = h5py.File(filename,'r')
-    data = np.array(list(f['measurement0']['genraw']['data']))
-
-    invalid = np.nanmax(data)
-    
-    masked_at_interferometer = len(data[data==invalid]) > 50        
-    
-    if masked_at_interferometer:    
-        data[data == invalid] = np.nan #remove invalid values
-    
-    data = data*(632.8/1000) #convert from waves to um
+    #remove invalid values (only if the frame was masked at the interferometer), convert from waves to um
+    data, valid = preprocess_frame(read_genraw_data(filename), crop_square=False, min_invalid_count=50)
+    masked_at_interferometer = not valid.all()
     
     scale = 255*(data - np.nanmin(data))/np.nanmax((data - np.nanmin(data)))    #
     scale[np.isnan(scale)] = 255                                                #Convert data array to color scale image of vals 1-255
@@ -182,68 +395,35 @@ def import_4D_map_auto(filename,Z,normal_tip_tilt_power=True,remove_coef = []):
     #The really annoying thing about it though is that this shouldn't be hard-coded - it changes with subtense
     #It'd be better for the user to just establish the mirror size
     #Comments from warrenbfoster, 10/18/2024. Profanity omitted.
-    xs = np.linspace(-387500,387500,len(zs_cropped[0]))
-    ys = np.linspace(-387500,387500,len(zs_cropped.transpose()[0]))
-   
-    Z_int = interpolate.RectBivariateSpline(ys,xs,zs_cropped_copy)
-    
-    xi = yi = np.linspace(-381000,381000,500)
-    X,Y = np.meshgrid(xi,yi)
-    
-    zi = Z_int(Y,X,grid = False)  #truncate to clear aperture radius
+    zi = resampling_operator(*zs_cropped_copy.shape, 387500, grid_size, 381000).apply(zs_cropped_copy)  #truncate to clear aperture radius
     
-    test = np.sqrt(X**2 + Y**2)                         #
-    inds = np.where((test > pixel_OD) | (test < pixel_ID))   #
-    coords = list(zip(inds[0],inds[1]))                 #remove data points outside of clear aperture
-    for j,m in enumerate(coords):                       #
-        zi[coords[j][0]][coords[j][1]] = np.nan         #
-        if False: #plot intermediate steps to figure out wtf this step is doing
-            if j % 1000 == 0:
-                plt.imshow(zi)
-                plt.show()
+    zi[aperture_mask(grid_size, 381000, pixel_OD, pixel_ID)] = np.nan #remove data points outside of clear aperture
         
     M = zi.flatten(),zi
     
-    C = Zernike_decomposition(Z, M, -1) #Zernike fit
-
-    f.close()
+    C = fit_zernike(Z, M) #Zernike fit
     
     if normal_tip_tilt_power:
-        Piston = (Z[1].transpose(2,0,1)[0])*C[2][0] #
-        TiltY = (Z[1].transpose(2,0,1)[1])*C[2][1]  #remove piston, tip/tilt, and power
-        TiltX = (Z[1].transpose(2,0,1)[2])*C[2][2]  #
-        Power = (Z[1].transpose(2,0,1)[4])*C[2][4]  #
-        
-        Surf = M[1] - Piston - TiltX - TiltY - Power ##remove piston, tip/tilt, and power
+        Surf = remove_zernike_modes(Z, M[1], C[2], TIP_TILT_POWER_MODES) #remove piston, tip/tilt, and power
     elif len(remove_coef)>0:
-        Surf = remove_modes(M,C,Z,remove_coef)
+        Surf = remove_zernike_modes(Z, M[1], C[2], remove_coef)
     else:
         print('Strange things are afoot')
     return Surf.flatten(),Surf #return 1D flattened surface and 2D surface    
 
-def import_cropped_4D_map(filename, Z, normal_tip_tilt_power=True, remove_coef=[]):
+def import_cropped_4D_map(filename, Z, normal_tip_tilt_power=True, remove_coef=[], grid_size=FULL_GRID_SIZE):
     #Revision of Nick's import_4D_map_auto, but using the assumption that the user has
     #set an analysis mask that crops out the mirror outside the clear aperture.
     #This only works for coated mirrors where this distinction is obvious.
+    grid_size = resolve_grid_size(grid_size)
+    Z = match_zernike_basis(Z, grid_size)
 
     clear_aperture_radius = 15.2 * 25.4 * 1e3  # Mirror radius that is not covered by TEC
     pixel_OD = 14.95 * 25.4 * 1e3 # Coated mirror radius
     pixel_ID = 1.8 * 25.4 * 1e3 #Coated ID
 
-    f = h5py.File(filename, 'r')
-    data = np.array(list(f['measurement0']['genraw']['data']))
-
-    invalid = np.nanmax(data)
-
-    data[data == invalid] = np.nan  # remove invalid values
-    data = data * (632.8 / 1000)  # convert from waves to um
-
-    asymmetry = np.max(data.shape)-np.min(data.shape)
-    index = np.argmax(data.shape)
-    if index == 0:
-        data = data[int(np.floor(asymmetry/2)):-int(np.floor(asymmetry/2)),:]
-    else:
-        data = data[:,int(np.floor(asymmetry / 2)):-int(np.ceil(asymmetry / 2))]
+    # remove invalid values, convert from waves to um, crop to a square aspect ratio
+    data, valid = preprocess_frame(read_genraw_data(filename))
 
     scale = 255 * (data - np.nanmin(data)) / np.nanmax((data - np.nanmin(data)))  #
     scale[np.isnan(scale)] = 255  # Convert data array to color scale image of vals 1-255
@@ -289,65 +469,48 @@ def import_cropped_4D_map(filename, Z, normal_tip_tilt_power=True, remove_coef=[
     zs_cropped_copy = zs_cropped.copy()
     zs_cropped_copy[np.isnan(zs_cropped_copy)] = 0
 
-    #Define grid that the measurement is using
-    xs = np.linspace(-clear_aperture_radius, clear_aperture_radius, len(zs_cropped[0]))
-    ys = np.linspace(-clear_aperture_radius, clear_aperture_radius, len(zs_cropped.transpose()[0]))
-
-    Z_int = interpolate.RectBivariateSpline(ys, xs, zs_cropped_copy)
-
-    #Interpolate measurement onto a 500x500 grid
-    xi = yi = np.linspace(-clear_aperture_radius, clear_aperture_radius, 500)
-    X, Y = np.meshgrid(xi, yi)
+    #Interpolate measurement onto the output grid
+    zi = resampling_operator(*zs_cropped_copy.shape, clear_aperture_radius, grid_size, clear_aperture_radius).apply(zs_cropped_copy)  # truncate to clear aperture radius
 
-    zi = Z_int(Y, X, grid=False)  # truncate to clear aperture radius
-
-    test = np.sqrt(X ** 2 + Y ** 2)  #
-    inds = np.where((test > pixel_OD) | (test < pixel_ID))  #
-    coords = list(zip(inds[0], inds[1]))  # remove data points outside of clear aperture
-    for j, m in enumerate(coords):  #
-        zi[coords[j][0]][coords[j][1]] = np.nan  #
+    zi[aperture_mask(grid_size, clear_aperture_radius, pixel_OD, pixel_ID)] = np.nan  # remove data points outside of clear aperture
 
     M = zi.flatten(), zi
-    C = Zernike_decomposition(Z, M, -1)  # Zernike fit
-    f.close()
+    C = fit_zernike(Z, M)  # Zernike fit
 
     if normal_tip_tilt_power:
-        Piston = (Z[1].transpose(2, 0, 1)[0]) * C[2][0]  #
-        TiltY = (Z[1].transpose(2, 0, 1)[1]) * C[2][1]  # remove piston, tip/tilt, and power
-        TiltX = (Z[1].transpose(2, 0, 1)[2]) * C[2][2]  #
-        Power = (Z[1].transpose(2, 0, 1)[4]) * C[2][4]  #
-
-        Surf = M[1] - Piston - TiltX - TiltY - Power  ##remove piston, tip/tilt, and power
+        Surf = remove_zernike_modes(Z, M[1], C[2], TIP_TILT_POWER_MODES)  # remove piston, tip/tilt, and power
     elif len(remove_coef) > 0:
-        Surf = remove_modes(M, C, Z, remove_coef)
+        Surf = remove_zernike_modes(Z, M[1], C[2], remove_coef)
     else:
         print('Strange things are afoot')
     return Surf.flatten(), Surf  # return 1D flattened surface and 2D surface
 
 
-def measure_h5_circle(filename, use_optimizer=False):
+def measure_h5_circle(filename, use_optimizer=False, dtype=None, method=None, pyramid=False, initial_circle=None, stats=None):
     #Fix the problems with different pupil definitions between measurement sets causing junk difference data during averaging
     #Only import the file and guess at the pupil coordinates
     #In another function, apply the average coordinates to every measurement
+    #method selects the pupil detector: 'hough' (default), 'optimizer' (Nelder-Mead, same as
+    #use_optimizer=True), 'analytic' (edge-point circle fit, see pupil_fitting) or 'hough_parallel'
+    #(the three Hough blur scales in parallel threads, at most two radius bands per scale)
+    #pyramid=True runs the hough / optimizer search coarse-to-fine (pupil_fitting.define_pupil_pyramid)
+    #stats, if given, is a dict accumulating the detector work (see measure_frame_circle)
+
+    # remove invalid values, convert from waves to um, crop image to a square aspect ratio
+    data, valid = preprocess_frame(read_genraw_data(filename, dtype=dtype))
+    circle_coord, ID = measure_frame_circle(data, valid, use_optimizer, method, pyramid, initial_circle, stats)
+    return data, circle_coord, ID
 
-    f = h5py.File(filename, 'r')
-    data = np.array(list(f['measurement0']['genraw']['data']))
-    f.close()
-
-    invalid = np.nanmax(data)
-
-    data[data == invalid] = np.nan  # remove invalid values
-    data = data * (632.8 / 1000)  # convert from waves to um
-
-    #Crop image to a square aspect ratio
-    asymmetry = np.max(data.shape)-np.min(data.shape)
-    index = np.argmax(data.shape)
-    if index == 0:
-        data = data[int(np.floor(asymmetry/2)):-int(np.floor(asymmetry/2)),:]
-    else:
-        data = data[:,int(np.floor(asymmetry / 2)):-int(np.ceil(asymmetry / 2))]
+def measure_frame_circle(data, valid, use_optimizer=False, method=None, pyramid=False, initial_circle=None, stats=None):
+    #Pupil circle and ID estimate of a preprocessed frame (see measure_h5_circle)
+    #initial_circle (a circle previously returned by this function) warm-starts the optimizer method
+    #stats, if given, is a dict in which 'frames' and 'hough_calls' (cv.HoughCircles calls) are accumulated
+    if method is None:
+        method = 'optimizer' if use_optimizer else 'hough'
+    if method not in PUPIL_METHODS:
+        raise ValueError(f"Unknown pupil method '{method}', expected one of {PUPIL_METHODS}")
 
-    valid_coords = np.where(~np.isnan(data))
+    valid_coords = np.nonzero(valid)
     com_x = np.mean(valid_coords[1], axis=0)
     com_y = np.mean(valid_coords[0], axis=0)
     cs_x = data[:,int(com_x)]
@@ -364,27 +527,29 @@ def measure_h5_circle(filename, use_optimizer=False):
     ID = np.mean(ID_xy)
 
     circle_holder = []
-
-    if use_optimizer:
+    n_calls = 0
+
+    if method == 'optimizer' and initial_circle is not None:
+        x0, y0, r0 = initial_circle
+        circle_holder.append(define_pupil_using_optimization(data, initial_circle=[x0, y0, r0 + 1]))  # undo the edge trim below
+    elif pyramid and method in ('hough', 'optimizer'):
+        circle_holder.append(define_pupil_pyramid(data, coarse=method, radius_guess=OD/2))
+    elif method == 'optimizer':
         xyr = define_pupil_using_optimization(data)
         circle_holder.append(xyr)
+    elif method == 'analytic':
+        circle_holder.append(define_pupil_analytic(data))
+    elif method == 'hough_parallel':
+        circle_holder, n_calls = define_pupil_hough_parallel(hough_image(data), OD)
     else:
-        scale = 255 * (data - np.nanmin(data)) / np.nanmax((data - np.nanmin(data)))  #
-        scale[np.isnan(scale)] = 255  # Convert data array to color scale image of vals 1-255
-        scale[scale == 0] = 1  #
-
-        for ksize in [61,81,101]:
-            img = scale.astype('uint8')  # convert data type to uint8 for Hough Gradient function
-            img = cv.medianBlur(img, ksize)  # median blurring function to help with detection
-            fudge = 1
-            circle = None
-            while circle is None:
-                circle = cv.HoughCircles(img, cv.HOUGH_GRADIENT, 1, int(OD),# Find mirror disc in data array
-                                      param1=20, param2=15, minRadius=int(np.floor(OD/2)-fudge),
-                                      maxRadius=int(np.ceil(OD/2)+fudge))  # Output in (x_center,y_center,radius)
-                fudge = fudge + 1
-            if fudge < 10:
-                circle_holder.append(circle[0][0])
+        circle_holder, n_calls = define_pupil_hough(hough_image(data), OD)
+
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + 1
+        stats['hough_calls'] = stats.get('hough_calls', 0) + n_calls
+    if len(circle_holder) == 0:
+        # The retrying search would not accept a circle outside this band either
+        raise ValueError(f"No pupil circle found within OD/2 +- {HOUGH_RADIUS_MARGIN} px with the '{method}' detector")
 
     #Plot to see if the circle detection is working
     x = np.median(circle_holder,0)[0]
@@ -392,7 +557,33 @@ def measure_h5_circle(filename, use_optimizer=False):
     r = np.min(circle_holder,0)[2]-1  # Trim smaller edge to remove noisy data, because user has already done this
     circle_coord = [x,y,r]
 
-    return data, circle_coord, ID
+    return circle_coord, ID
+
+def hough_image(data):
+    #uint8 image for the Hough detectors: data scaled to 1-255, invalid pixels at 255
+    scale = 255 * (data - np.nanmin(data)) / np.nanmax((data - np.nanmin(data)))  #
+    scale[np.isnan(scale)] = 255  # Convert data array to color scale image of vals 1-255
+    scale[scale == 0] = 1  #
+    return scale.astype('uint8')  # convert data type to uint8 for Hough Gradient function
+
+def define_pupil_hough(img, OD):
+    #Blur at three kernel sizes and widen the radius band one pixel per retry until a circle is found.
+    #Returns the accepted circles and the number of cv.HoughCircles calls made.
+    circle_holder = []
+    n_calls = 0
+    for ksize in HOUGH_KSIZES:
+        blurred = cv.medianBlur(img, ksize)  # median blurring function to help with detection
+        fudge = 1
+        circle = None
+        while circle is None:
+            circle = cv.HoughCircles(blurred, cv.HOUGH_GRADIENT, 1, int(OD),# Find mirror disc in data array
+                                  param1=20, param2=15, minRadius=int(np.floor(OD/2)-fudge),
+                                  maxRadius=int(np.ceil(OD/2)+fudge))  # Output in (x_center,y_center,radius)
+            n_calls += 1
+            fudge = fudge + 1
+        if fudge < 10:
+            circle_holder.append(circle[0][0])
+    return circle_holder, n_calls
 
 def continuous_pupil_merit_function(xyr, thresh_image, inside_pupil_weight=1, outside_pupil_weight = 1):
     negative_image = np.subtract(thresh_image.astype(float), np.max(thresh_image.astype(float)))*-1
@@ -420,46 +611,106 @@ def continuous_pupil_merit_function(xyr, thresh_image, inside_pupil_weight=1, ou
 
     return merit
 
-def define_pupil_using_optimization(data_image):
+def define_pupil_using_optimization(data_image, merit='integral', initial_circle=None, window=WARM_START_WINDOW):
+    #merit='integral' scores candidates with the O(perimeter) IntegralPupilMerit,
+    #merit='full' with the original continuous_pupil_merit_function
+    #initial_circle starts the search from a known (x, y, r) with a simplex of `window` pixels
+    #instead of the generic (shape/2, shape/4) guess
     thresh_image = data_image.copy()
     thresh_image[~np.isnan(thresh_image)] = 1
     thresh_image[np.isnan(thresh_image)] = 0
-    xyr = [int(thresh_image.shape[0]/2), int(thresh_image.shape[1]/2), int(np.max(thresh_image.shape)/4)]
-    res = minimize(continuous_pupil_merit_function, xyr, args=thresh_image, method='Nelder-Mead')
+    options = None
+    if initial_circle is None:
+        xyr = [int(thresh_image.shape[0]/2), int(thresh_image.shape[1]/2), int(np.max(thresh_image.shape)/4)]
+    else:
+        xyr = np.asarray(initial_circle, dtype=float)
+        options = {'initial_simplex': np.vstack([xyr, xyr + [window, 0, 0], xyr + [0, window, 0], xyr + [0, 0, window]])}
+    if merit == 'integral':
+        res = minimize(IntegralPupilMerit(thresh_image), xyr, method='Nelder-Mead', options=options)
+    elif merit == 'full':
+        res = minimize(continuous_pupil_merit_function, xyr, args=thresh_image, method='Nelder-Mead', options=options)
+    else:
+        raise ValueError(f"Unknown merit backend '{merit}', expected 'integral' or 'full'")
     return res.x
 
 
+@lru_cache(maxsize=8)
+def center_distance_grid(shape, x, y, radius):
+    """
+    Distance from (x, y) of every pixel in the bounding box of a circle.
+
+    Returns (slices, grid): the slices select the box from a frame of the given shape,
+    grid holds the distances of its pixels. Cached per circle and read-only, so all
+    frames of a session share one grid.
+    """
+    rows = np.arange(max(int(np.floor(y - radius)), 0), min(int(np.ceil(y + radius)) + 1, shape[0]))
+    cols = np.arange(max(int(np.floor(x - radius)), 0), min(int(np.ceil(x + radius)) + 1, shape[1]))
+    grid = np.sqrt((cols[np.newaxis, :] - x) ** 2 + (rows[:, np.newaxis] - y) ** 2)
+    grid.flags.writeable = False
+    return (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)), grid
+
+def ID_threshold_distance(data, circle_coord, ID_threshold=0.99):
+    #Radius (pixels) below which define_ID blanks the data: the ID_threshold quantile of the distances
+    #of invalid pixels within half the pupil radius. ID_threshold may be a sequence, for sweeping.
+    x, y, r = (float(v) for v in circle_coord)
+    box, distance_from_center = center_distance_grid(data.shape, x, y, r/2)
+    invalid_ID = np.isnan(data[box]) & (distance_from_center < (r/2)) & (distance_from_center > 0)
+    invalid_distances = distance_from_center[invalid_ID]
+    kth = (len(invalid_distances) * np.asarray(ID_threshold)).astype(int)
+    return np.partition(invalid_distances, kth)[kth]
+
 def define_ID(data, circle_coord, ID_threshold=0.99):
     #Address inconsistent measurements near ID by cropping out the noisy region
+    threshold_distance = ID_threshold_distance(data, circle_coord, ID_threshold)
+    x, y, r = (float(v) for v in circle_coord)
+    box, distance_from_center = center_distance_grid(data.shape, x, y, r/2)
+    data_copy = data.copy()
+    data_copy[box][distance_from_center < threshold_distance] = np.nan
+    return data_copy
 
+def crop_to_avg_circle(data, circle_coord):
+    #Square crop around a pupil circle on the last two axes, for one frame or an (N, H, W) stack
     x = circle_coord[0]
     y = circle_coord[1]
     r = circle_coord[2]
 
-    xi = np.arange(0, data.shape[1])
-    yi = np.arange(0, data.shape[0])
-    X, Y = np.meshgrid(xi, yi)
-    distance_from_center = np.sqrt((X - x) ** 2 + (Y - y) ** 2)
-    invalid_data = np.isnan(data)
-    pix_within_aperture = distance_from_center < (r/2)
-    invalid_ID = invalid_data * pix_within_aperture
-    invalid_distances = distance_from_center * invalid_ID
-    sorted_invalid_distances = np.sort(invalid_distances[np.nonzero(invalid_distances)].ravel())
-    threshold_distance = sorted_invalid_distances[int(len(sorted_invalid_distances) * ID_threshold)]
-    data_copy = data.copy()
-    data_copy[distance_from_center < threshold_distance] = np.nan
-    return data_copy
+    x1 = np.floor(x-r)
+    x2 = np.ceil(x+r)
+    y1 = np.floor(y-r)
+    y2 = np.ceil(y+r)
+
+    data_crop = data[..., int(y1):int(y2), int(x1):int(x2)]
+
+    if data_crop.shape[-2]<data_crop.shape[-1]:
+        data_crop = data_crop[..., :, 1:]
+    elif data_crop.shape[-2]>data_crop.shape[-1]:
+        data_crop = data_crop[..., 1:, :]
+    return data_crop
+
+def default_zernike_basis(caller, clear_aperture_outer, clear_aperture_inner, grid_size):
+    #Stored 44-mode basis for the clear aperture, used when a caller is given Z=None
+    print(f"Warning: No Z matrix provided to {caller}; using the stored basis for this aperture")
+    try:
+        from .zernike_store import get_zernike_basis
+    except ImportError:
+        from zernike_store import get_zernike_basis
+    return get_zernike_basis(44, int(clear_aperture_outer*1e6), int(clear_aperture_inner*1e6), grid_size)
 
-def format_data_from_avg_circle(data,circle_coord, clear_aperture_outer, clear_aperture_inner, Z, normal_tip_tilt_power=True, remove_coef=[]):
+def format_data_from_avg_circle(data,circle_coord, clear_aperture_outer, clear_aperture_inner, Z, normal_tip_tilt_power=True, remove_coef=[], dtype=None, fill_method=DEFAULT_FILL_METHOD, grid_size=FULL_GRID_SIZE):
     #Apply averaged circle measurements from a measurement set to the data
     #This doesn't fix inconsistent user crops, but should clean up the difference data.
+    #dtype=np.float32 carries the resampling, masking and Zernike fit in single precision
+    #fill_method selects how NaN holes are filled before resampling (see nan_fill.FILL_METHODS;
+    #'bisplrep' is the original global spline fit)
+    #grid_size is the output resolution in pixels or a GRID_TIERS name; Z is resampled to match if needed
 
     #clear_aperture_inner = 0
+    grid_size = resolve_grid_size(grid_size)
     if Z is None:
-        print("Warning: No Z matrix provided to format_data_from_avg_circle")
-        print("Importing Z now; this will take much longer than necessary")
-        from shared.General_zernike_matrix import General_zernike_matrix
-        Z = General_zernike_matrix(500, clear_aperture_outer*2, 500)
+        Z = default_zernike_basis('format_data_from_avg_circle', clear_aperture_outer, clear_aperture_inner, grid_size)
+    Z = match_zernike_basis(Z, grid_size)
+    if dtype is not None:
+        Z = cast_zernike_basis(Z, dtype)
 
     set_nans_to_zero = False
 
@@ -470,21 +721,7 @@ def format_data_from_avg_circle(data,circle_coord, clear_aperture_outer, clear_a
     if clear_aperture_inner > 1e-6:
         data = define_ID(data, circle_coord)
 
-    x = circle_coord[0]
-    y = circle_coord[1]
-    r = circle_coord[2]
-
-    x1 = np.floor(x-r)
-    x2 = np.ceil(x+r)
-    y1 = np.floor(y-r)
-    y2 = np.ceil(y+r)
-
-    data_crop = data[int(y1):int(y2), int(x1):int(x2)]
-
-    if data_crop.shape[0]<data_crop.shape[1]:
-        data_crop = data_crop[:,1:]
-    elif data_crop.shape[0]>data_crop.shape[1]:
-        data_crop = data_crop[1:,:]
+    data_crop = crop_to_avg_circle(data, circle_coord)
 
     if False:
         plt.imshow(data_crop)
@@ -496,50 +733,88 @@ def format_data_from_avg_circle(data,circle_coord, clear_aperture_outer, clear_a
     xs = np.linspace(-clear_aperture_radius, clear_aperture_radius, len(zs_cropped[0]))
     ys = np.linspace(-clear_aperture_radius, clear_aperture_radius, len(zs_cropped.transpose()[0]))
 
-    #Interpolate measurement onto a 500x500 grid
-    xi = yi = np.linspace(-clear_aperture_radius, clear_aperture_radius, 500)
-    X, Y = np.meshgrid(xi, yi)
-
-
     zs_cropped_copy = zs_cropped.copy()
 
     if set_nans_to_zero:
         # Old method for interpolated set. Using a method that doesn't tolerate nans, so sets all nan values to 0. This creates fake splines and bad fits around the ID/OD.
         zs_cropped_copy[np.isnan(zs_cropped_copy)] = 0
     else:
-        # New system: use fancy new interpolation that only interpolates over a defined set of nonnan pixels. Use this as interpolation set.
-        coord = np.where(~np.isnan(data_crop))
-        tck, fp, ier, msg = interpolate.bisplrep(xs[coord[1]], ys[coord[0]], data_crop[~np.isnan(data_crop)],
-                                                 full_output=1)
-        zs_filled = interpolate.bisplev(xs, ys, tck)
-        zs_flip = np.flip(zs_filled, axis=0) #This interpolation is creating a parity change, apparently, so fix it
-        zs_cropped_copy[np.isnan(zs_cropped_copy)] = zs_flip[np.isnan(zs_cropped_copy)]
-
-    Z_int = interpolate.RectBivariateSpline(ys, xs, zs_cropped_copy)
-    zi = Z_int(Y, X, grid=False)  # truncate to clear aperture radius
-
-    test = np.sqrt(X ** 2 + Y ** 2)  #
-    inds = np.where((test > pixel_OD) | (test < pixel_ID))  #
-    coords = list(zip(inds[0], inds[1]))  # remove data points outside of clear aperture
-    for j, m in enumerate(coords):  #
-        zi[coords[j][0]][coords[j][1]] = np.nan  #
+        # Fill the NaN holes from the surrounding valid data so the resampling spline behaves at the OD / ID edges
+        zs_cropped_copy = np.flip(fill_nans(data_crop, fill_method, xs, ys), axis=0)
+
+    #Interpolate measurement onto the output grid (cached operator shared by every frame with this crop size)
+    zi = resampling_operator(*zs_cropped_copy.shape, clear_aperture_radius, grid_size, clear_aperture_radius).apply(zs_cropped_copy, dtype)  # truncate to clear aperture radius
+
+    zi[aperture_mask(grid_size, clear_aperture_radius, pixel_OD, pixel_ID)] = np.nan  # remove data points outside of clear aperture
 
     M = zi.flatten(), zi
-    C = Zernike_decomposition(Z, M, -1)  # Zernike fit
+    C = fit_zernike(Z, M)  # Zernike fit
 
     if normal_tip_tilt_power:
-        Piston = (Z[1].transpose(2, 0, 1)[0]) * C[2][0]  #
-        TiltY = (Z[1].transpose(2, 0, 1)[1]) * C[2][1]  # remove piston, tip/tilt, and power
-        TiltX = (Z[1].transpose(2, 0, 1)[2]) * C[2][2]  #
-        Power = (Z[1].transpose(2, 0, 1)[4]) * C[2][4]  #
-
-        Surf = M[1] - Piston - TiltX - TiltY - Power  ##remove piston, tip/tilt, and power
+        Surf = remove_zernike_modes(Z, M[1], C[2], TIP_TILT_POWER_MODES)  # remove piston, tip/tilt, and power
     elif len(remove_coef) > 0:
-        Surf = remove_modes(M, C, Z, remove_coef)
+        Surf = remove_zernike_modes(Z, M[1], C[2], remove_coef)
     else:
         print('Strange things are afoot')
     return Surf.flatten(), Surf  # return 1D flattened surface and 2D surface
 
+def format_stack_from_avg_circle(stack, circle_coord, clear_aperture_outer, clear_aperture_inner, Z, normal_tip_tilt_power=True, remove_coef=[], dtype=None, fill_method=DEFAULT_FILL_METHOD, grid_size=FULL_GRID_SIZE):
+    """
+    Batch version of format_data_from_avg_circle for frames that share one pupil circle.
+
+    The crop, resampling and aperture mask are identical for every frame, so the stack is
+    cropped with one slice, resampled with one cached operator, masked with one broadcast
+    and fitted with one cached least-squares operator (fit_zernike) applied to all frames at once. Only the ID crop
+    and the hole fill, which depend on each frame's own invalid pixels, run per frame.
+
+    Parameters
+    ----------
+    stack : ndarray
+        (N, H, W) preprocessed frames (see preprocess_frame)
+    circle_coord : sequence
+        Session-averaged pupil circle (x, y, r) in pixels
+    clear_aperture_outer, clear_aperture_inner, Z, normal_tip_tilt_power, remove_coef, dtype, fill_method, grid_size
+        As in format_data_from_avg_circle
+
+    Returns
+    -------
+    surfaces : ndarray
+        (N, grid_size, grid_size) maps with the selected modes removed, NaN outside the clear aperture
+    coefs : ndarray
+        (N, n_modes) Zernike coefficients of each map before mode removal
+    """
+    grid_size = resolve_grid_size(grid_size)
+    if Z is None:
+        Z = default_zernike_basis('format_stack_from_avg_circle', clear_aperture_outer, clear_aperture_inner, grid_size)
+    Z = match_zernike_basis(Z, grid_size)
+    if dtype is not None:
+        Z = cast_zernike_basis(Z, dtype)
+    clear_aperture_radius = clear_aperture_outer
+
+    if clear_aperture_inner > 1e-6:
+        stack = np.stack([define_ID(frame, circle_coord) for frame in stack])
+    data_crop = crop_to_avg_circle(stack, circle_coord)
+
+    xs = np.linspace(-clear_aperture_radius, clear_aperture_radius, data_crop.shape[-1])
+    ys = np.linspace(-clear_aperture_radius, clear_aperture_radius, data_crop.shape[-2])
+    filled = np.stack([fill_nans(frame, fill_method, xs, ys) for frame in data_crop])[:, ::-1]  # parity flip
+
+    zi = resampling_operator(*filled.shape[1:], clear_aperture_radius, grid_size, clear_aperture_radius).apply(filled, dtype)
+    outside = aperture_mask(grid_size, clear_aperture_radius, clear_aperture_outer, clear_aperture_inner)
+    zi[:, outside] = np.nan
+
+    # Every filled map shares the aperture mask, so all frames are fitted with one product
+    coefs = fit_operator(Z, ~outside.ravel() & basis_valid_rows(Z)).coefficients(zi)
+
+    if normal_tip_tilt_power:
+        modes = TIP_TILT_POWER_MODES  # piston, tip/tilt, and power
+    elif len(remove_coef) > 0:
+        modes = remove_coef
+    else:
+        print('Strange things are afoot')
+        modes = []
+    return remove_zernike_modes(Z, zi, coefs, modes, out=zi), coefs
+
 def initial_crop(img,ksize):
     #Obsolete - realized this was dumb. Could be used to simplify automated import
     img = cv.medianBlur(img, ksize)  # median blurring function to help with detection
@@ -0,0 +1,67 @@
+"""
+Shared fixtures for the interferometer tests.
+
+The tests import the package as ``interferometer``, so run them from its checkout
+next to the ``shared`` package (e.g. ``python -m pytest interferometer/tests``).
+Everything else is synthetic: small Chebyshev bases stand in for the Zernike
+matrix and frames are written with h5py, so no measurement data or hardware
+libraries are needed. The GUI worker tests skip when PyQt5 is not installed.
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+SENTINEL = 3.4e38  # invalid-pixel value written by the 4D software
+
+def synthetic_basis(grid_size, n_modes, inner=0.0):
+    """
+    Zernike-like matrix tuple (flat, 3D) on a grid spanning [-1, 1].
+
+    Modes are products of Chebyshev polynomials T_i(x) T_j(y) in order of total
+    degree, NaN outside the annulus inner < r <= 1 like General_zernike_matrix.
+    """
+    x = np.linspace(-1, 1, grid_size)
+    X, Y = np.meshgrid(x, x)
+    R = np.hypot(X, Y)
+    orders = [(i, degree - i) for degree in range(n_modes) for i in range(degree + 1)][:n_modes]
+    max_degree = max(max(order) for order in orders)
+    Tx = np.polynomial.chebyshev.chebvander(X, max_degree)
+    Ty = np.polynomial.chebyshev.chebvander(Y, max_degree)
+    Z1 = np.stack([Tx[..., i] * Ty[..., j] for i, j in orders], axis=-1)
+    Z1[(R > 1) | (R < inner)] = np.nan
+    return Z1.reshape(grid_size * grid_size, n_modes), Z1
+
+def write_frame(path, shape=(480, 520), center=(262, 238), radius=176, inner_radius=20, seed=0):
+    #Synthetic 4D frame: smooth surface plus noise, sentinel outside the annular pupil
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    distance = np.hypot(xx - center[0], yy - center[1])
+    data = (0.3 * ((xx - center[0]) / radius)**2 + 0.05 * rng.standard_normal(shape)).astype(np.float32)
+    data[(distance > radius) | (distance < inner_radius)] = SENTINEL
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('measurement0/genraw/data', data=data)
+        f['measurement0/genraw/data'].attrs['wavelength'] = 632.8
+    return str(path)
+
+def pupil_frame(shape=(256, 256), center=(130.3, 121.7), radius=80.4, inner_radius=10.0, seed=0):
+    #Preprocessed-style frame in um: NaN outside an annular pupil of known geometry
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    distance = np.hypot(xx - center[0], yy - center[1])
+    data = 0.3 * ((xx - center[0]) / radius)**2 + 0.01 * rng.standard_normal(shape)
+    data[(distance >= radius) | (distance < inner_radius)] = np.nan
+    return data
+
+@pytest.fixture
+def basis():
+    return synthetic_basis(64, 15)
+
+@pytest.fixture
+def session_folder(tmp_path):
+    #Three frames of one session, the pupil shifted by a pixel in the second
+    folder = tmp_path / 'session'
+    folder.mkdir()
+    for i in range(3):
+        write_frame(folder / f'{i}.h5', center=(262 + i % 2, 238), seed=i)
+    return str(folder)
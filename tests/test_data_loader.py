@@ -0,0 +1,157 @@
+import importlib
+import inspect
+import os
+import numpy as np
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+from interferometer.surface_processing import (read_genraw_data, preprocess_frame, format_data_from_avg_circle,
+                                               format_stack_from_avg_circle, measure_h5_circle, QUICK_LOOK_GRID_SIZE,
+                                               FULL_GRID_SIZE)
+from interferometer.zernike_store import STORE_DIR_ENV, basis_name, save_basis, load_basis
+
+from conftest import synthetic_basis, write_frame
+
+data_loader = importlib.import_module('interferometer.data_loader')
+
+CLEAR_OUTER, CLEAR_INNER, ID_CROP = 0.381, 0.032, 1.25
+
+@pytest.fixture(scope='module')
+def quick_basis():
+    return synthetic_basis(QUICK_LOOK_GRID_SIZE, 44)
+
+@pytest.fixture
+def basis_store(tmp_path, monkeypatch, quick_basis):
+    #Store holding the 44-mode quick-look basis the loader falls back to for Z=None
+    store = tmp_path / 'bases'
+    store.mkdir()
+    monkeypatch.setenv(STORE_DIR_ENV, str(store))
+    name = basis_name(44, int(CLEAR_OUTER * 1e6), int(CLEAR_INNER * ID_CROP * 1e6), QUICK_LOOK_GRID_SIZE)
+    save_basis(str(store / (name + '.json')), quick_basis)
+    return load_basis(str(store / (name + '.json')))
+
+def test_running_stats_match_numpy():
+    rng = np.random.default_rng(0)
+    stack = rng.normal(size=(6, 8, 9)) + 100.0
+    stack[2, 1, 1] = np.nan  # a NaN in any frame stays NaN in both outputs, as with np.mean / np.std
+    stats = data_loader.RunningSurfaceStats()
+    for surface in stack:
+        stats.add(surface)
+    assert stats.count == 6
+    np.testing.assert_allclose(stats.mean, np.mean(stack, axis=0), rtol=0, atol=1e-12, equal_nan=True)
+    np.testing.assert_allclose(stats.std, np.std(stack, axis=0, ddof=1), rtol=0, atol=1e-12, equal_nan=True)
+
+def test_running_stats_single_frame():
+    surface = np.arange(12.0).reshape(3, 4)
+    surface[0, 0] = np.nan
+    stats = data_loader.RunningSurfaceStats()
+    stats.add(surface)
+    np.testing.assert_array_equal(stats.mean, surface)
+    np.testing.assert_array_equal(stats.std, np.zeros_like(surface))
+
+def test_full_grid_saves_mean_and_std(session_folder, basis, monkeypatch):
+    maps = []
+    original = data_loader._format_frame
+    monkeypatch.setattr(data_loader, '_format_frame', lambda *args: maps.append(original(*args)) or maps[-1])
+    surface = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, basis, use_cache=False)
+    assert surface.shape == (FULL_GRID_SIZE, FULL_GRID_SIZE) and len(maps) == 3
+    saved = np.load(os.path.join(session_folder, 'averaged_surface.npy'))
+    std = np.load(os.path.join(session_folder, data_loader.STD_FILENAME))
+    assert np.nanmax(std) > 0
+    np.testing.assert_array_equal(saved, surface)
+    np.testing.assert_allclose(saved, np.mean(maps, axis=0), atol=1e-12, equal_nan=True)
+    np.testing.assert_allclose(std, np.std(maps, axis=0, ddof=1), atol=1e-12, equal_nan=True)
+
+def test_load_measurements_without_basis(session_folder, basis_store):
+    surface = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, None, use_cache=False, grid_size='quick')
+    assert surface.shape == (QUICK_LOOK_GRID_SIZE, QUICK_LOOK_GRID_SIZE)
+    assert np.isfinite(surface).sum() > 0.5 * surface.size
+    explicit = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, basis_store, use_cache=False, grid_size='quick')
+    np.testing.assert_array_equal(surface, explicit)
+    assert not os.path.exists(os.path.join(session_folder, 'averaged_surface.npy'))  # quick-look surfaces are not saved
+
+def test_load_single_surface_without_basis(session_folder, basis_store):
+    surface = data_loader.load_single_surface(session_folder, clear_outer=CLEAR_OUTER, clear_inner=CLEAR_INNER, grid_size='quick')
+    assert surface.shape == (QUICK_LOOK_GRID_SIZE, QUICK_LOOK_GRID_SIZE)
+    cached = data_loader.load_single_surface(session_folder, clear_outer=CLEAR_OUTER, clear_inner=CLEAR_INNER, grid_size='quick')
+    np.testing.assert_array_equal(surface, cached)
+
+def test_stack_formatting_matches_frames(session_folder, quick_basis):
+    files = sorted(os.path.join(session_folder, f) for f in os.listdir(session_folder))
+    frames = [preprocess_frame(read_genraw_data(path))[0] for path in files]
+    circle = np.mean([measure_h5_circle(path, method='analytic')[1] for path in files], axis=0)
+    inner = CLEAR_INNER * ID_CROP
+    surfaces, coefs = format_stack_from_avg_circle(np.stack(frames), circle, CLEAR_OUTER, inner, quick_basis, grid_size='quick')
+    assert coefs.shape == (len(files), 44)
+    for frame, stacked in zip(frames, surfaces):
+        single = format_data_from_avg_circle(frame, circle, CLEAR_OUTER, inner, quick_basis, grid_size='quick')[1]
+        np.testing.assert_allclose(stacked, single, atol=1e-12, equal_nan=True)
+
+def test_parallel_matches_serial(session_folder, quick_basis, capsys):
+    serial = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick')
+    parallel = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, n_workers=2, use_cache=False, grid_size='quick')
+    assert "falling back" not in capsys.readouterr().out
+    np.testing.assert_allclose(parallel, serial, atol=1e-12, equal_nan=True)
+
+def test_broken_pool_falls_back_to_serial(session_folder, quick_basis, monkeypatch, capsys):
+    class BrokenPool:
+        def __init__(self, *args, **kwargs):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def map(self, *args):
+            raise BrokenProcessPool("worker died")
+    serial = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick')
+    monkeypatch.setattr(data_loader, 'ProcessPoolExecutor', BrokenPool)
+    fallback = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, n_workers=2, use_cache=False, grid_size='quick')
+    assert "falling back to serial processing" in capsys.readouterr().out
+    np.testing.assert_array_equal(fallback, serial)
+
+def test_stack_batching_is_opt_in_and_agrees(session_folder, quick_basis, monkeypatch):
+    assert inspect.signature(data_loader.load_measurements).parameters['batch_size'].default == 1
+    streamed = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick')
+    batches = []
+    original = data_loader.format_stack_from_avg_circle
+    monkeypatch.setattr(data_loader, 'format_stack_from_avg_circle', lambda stack, *args, **kwargs: batches.append(len(stack)) or original(stack, *args, **kwargs))
+    stacked = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick', batch_size=2)
+    assert batches == [2, 1]
+    np.testing.assert_allclose(stacked, streamed, atol=1e-12, equal_nan=True)
+
+@pytest.mark.parametrize('circle_tolerance, reprocessed', [(0.0, 4), (data_loader.APPEND_CIRCLE_TOLERANCE_PX, 1)])
+def test_appended_frame_reuses_cached_maps_within_tolerance(session_folder, quick_basis, monkeypatch, circle_tolerance, reprocessed):
+    data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, circle_tolerance=circle_tolerance, grid_size='quick')
+    write_frame(os.path.join(session_folder, '3.h5'), center=(263, 238), seed=3)  # moves the averaged pupil by ~0.2 px
+    formatted = []
+    original = data_loader._format_frame
+    monkeypatch.setattr(data_loader, '_format_frame', lambda path, *args: formatted.append(path) or original(path, *args))
+    data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, circle_tolerance=circle_tolerance, grid_size='quick')
+    assert len(formatted) == reprocessed
+
+def test_warm_start_is_opt_in_and_agrees(session_folder, quick_basis):
+    assert inspect.signature(data_loader.load_measurements).parameters['warm_start'].default is False
+    cold = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick')
+    warm = data_loader.load_measurements(session_folder, CLEAR_OUTER, CLEAR_INNER, quick_basis, use_cache=False, grid_size='quick', warm_start=True)
+    np.testing.assert_allclose(warm, cold, atol=1e-6, equal_nan=True)
+
+def test_outlier_exclusion_is_opt_in(monkeypatch):
+    files = ['a.h5', 'b.h5', 'c.h5', 'd.h5']
+    circles = {'a.h5': (100.0, 100.0, 50.0), 'b.h5': (100.5, 100.0, 50.0), 'c.h5': (100.0, 100.5, 50.0), 'd.h5': (130.0, 100.0, 50.0)}
+    used = []
+    monkeypatch.setattr(data_loader, '_detect_pupil', lambda path, dtype=None: (circles[path], 10.0))
+
+    def fake_frame(path, avg_circle, *args, **kwargs):
+        used.append(avg_circle)
+        return np.zeros((4, 4))
+    monkeypatch.setattr(data_loader, '_format_frame', fake_frame)
+
+    stats = data_loader._process_frames(map, files, CLEAR_OUTER, CLEAR_INNER, None, 'digest', False, 0.0)
+    assert stats.count == len(files)
+    np.testing.assert_allclose(used[0], np.mean([circles[f] for f in files], axis=0))
+    used.clear()
+    stats = data_loader._process_frames(map, files, CLEAR_OUTER, CLEAR_INNER, None, 'digest', False, 0.0, exclude_outliers=True)
+    assert stats.count == len(files)  # the outlier frame is still averaged, with the session pupil
+    np.testing.assert_allclose(used[0], np.mean([circles[f] for f in files[:3]], axis=0))
+    assert data_loader._processing_params(CLEAR_OUTER, CLEAR_INNER, ID_CROP)['exclude_outliers'] is False
+    assert list(data_loader.SessionPupilTracker.flag_outliers(files, [circles[f] for f in files])) == [3]
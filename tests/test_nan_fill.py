@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from interferometer.nan_fill import fill_nans, fill_biharmonic, FILL_METHODS, BIHARMONIC_BAND
+
+def plane_with_holes(size=60, hole_radius=4):
+    y, x = np.mgrid[:size, :size].astype(float)
+    data = 0.02 * x - 0.03 * y + 1.0
+    holes = np.hypot(x - size / 2, y - size / 2) < hole_radius
+    data[holes] = np.nan
+    return data, holes
+
+@pytest.mark.parametrize('method', FILL_METHODS)
+def test_fill_leaves_valid_pixels_and_no_nans(method):
+    data, holes = plane_with_holes()
+    data[:3, :3] = np.nan  # a corner hole at the border as well
+    holes = np.isnan(data)
+    axis = np.linspace(-1, 1, data.shape[0])
+    filled = fill_nans(data, method, axis, axis)
+    assert not np.isnan(filled).any()
+    np.testing.assert_array_equal(filled[~holes], data[~holes])
+    assert np.isnan(data).sum() == holes.sum()  # input untouched
+
+def test_nearest_uses_valid_values():
+    data, holes = plane_with_holes()
+    filled = fill_nans(data, 'nearest')
+    assert np.isin(filled[holes], data[~holes]).all()
+
+def test_biharmonic_continues_a_plane():
+    data, holes = plane_with_holes(hole_radius=BIHARMONIC_BAND - 2)  # the whole hole lies within the band
+    y, x = np.mgrid[:data.shape[0], :data.shape[1]].astype(float)
+    np.testing.assert_allclose(fill_biharmonic(data)[holes], (0.02 * x - 0.03 * y + 1.0)[holes], atol=1e-8)
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        fill_nans(np.zeros((4, 4)), 'spline')
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from interferometer.pupil_fitting import (define_pupil_analytic, IntegralPupilMerit, define_pupil_pyramid,
+                                          define_pupil_hough_parallel, downsample_mask, HOUGH_KSIZES)
+from interferometer.surface_processing import (continuous_pupil_merit_function, define_pupil_using_optimization,
+                                               define_pupil_hough, hough_image, measure_frame_circle, define_ID,
+                                               ID_threshold_distance)
+
+from conftest import pupil_frame
+
+CENTER, RADIUS = (130.3, 121.7), 80.4
+
+@pytest.fixture(scope='module')
+def frame():
+    return pupil_frame(center=CENTER, radius=RADIUS)
+
+def test_analytic_recovers_circle(frame):
+    x, y, r = define_pupil_analytic(frame)
+    assert abs(x - CENTER[0]) < 0.5 and abs(y - CENTER[1]) < 0.5 and abs(r - RADIUS) < 0.5
+
+def test_analytic_ignores_stray_pixels(frame):
+    stray = frame.copy()
+    stray[5, 5] = 1.0
+    np.testing.assert_allclose(define_pupil_analytic(stray), define_pupil_analytic(frame), atol=0.1)
+
+def test_integral_merit_matches_full_merit(frame):
+    thresh = (~np.isnan(frame)).astype(float)
+    merit = IntegralPupilMerit(thresh)
+    for xyr in [(130.3, 121.7, 80.4), (120.25, 128.5, 70.3), (140.1, 110.6, 95.7)]:
+        assert merit(xyr) == pytest.approx(continuous_pupil_merit_function(xyr, thresh), abs=1e-12)
+
+def test_optimizer_backends_agree(frame):
+    integral = define_pupil_using_optimization(frame)
+    assert np.max(np.abs(integral - [*CENTER, RADIUS])) < 1.0
+    np.testing.assert_allclose(integral, define_pupil_using_optimization(frame, merit='full'), atol=0.5)
+
+def test_pyramid_matches_analytic(frame):
+    np.testing.assert_allclose(define_pupil_pyramid(frame, coarse='optimizer'), define_pupil_analytic(frame), atol=1.0)
+
+def test_downsample_mask_fraction():
+    valid = np.zeros((10, 9), dtype=bool)
+    valid[:4, :4] = True
+    fraction = downsample_mask(valid, 4)
+    assert fraction.shape == (2, 2)
+    assert fraction[0, 0] == 1.0 and fraction[1, 1] == 0.0
+
+def test_parallel_hough_matches_serial(frame):
+    valid = ~np.isnan(frame)
+    rows = np.flatnonzero(valid.any(axis=1))
+    img = hough_image(frame)
+    serial, _ = define_pupil_hough(img, rows[-1] - rows[0])
+    parallel, n_calls = define_pupil_hough_parallel(img, rows[-1] - rows[0])
+    assert len(parallel) == len(HOUGH_KSIZES)
+    assert len(HOUGH_KSIZES) <= n_calls <= 2 * len(HOUGH_KSIZES)
+    np.testing.assert_allclose(np.median(parallel, 0)[:2], np.median(serial, 0)[:2], atol=1.0)
+
+def test_measure_frame_circle_counts_hough_calls(frame):
+    stats = {}
+    for method, tolerance in (('hough_parallel', 3.0), ('analytic', 0.5)):  # Hough centers are integer-ish and blurred
+        circle, ID = measure_frame_circle(frame, ~np.isnan(frame), method=method, stats=stats)
+        assert np.max(np.abs(np.asarray(circle) - [CENTER[0], CENTER[1], RADIUS - 1])) < tolerance
+    assert stats['frames'] == 2
+    assert len(HOUGH_KSIZES) <= stats['hough_calls'] <= 2 * len(HOUGH_KSIZES)
+
+def test_hough_without_circle_raises():
+    noise = np.random.default_rng(0).normal(size=(240, 240))
+    noise[:4] = np.nan
+    with pytest.raises(ValueError):
+        measure_frame_circle(noise, ~np.isnan(noise), method='hough_parallel')
+
+def test_unknown_method(frame):
+    with pytest.raises(ValueError):
+        measure_frame_circle(frame, ~np.isnan(frame), method='ransac')
+
+def full_sort_define_ID(data, circle_coord, ID_threshold=0.99):
+    #Baseline define_ID: distances over the whole frame, fully sorted
+    x, y, r = circle_coord
+    X, Y = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+    distance_from_center = np.sqrt((X - x) ** 2 + (Y - y) ** 2)
+    invalid_distances = distance_from_center * (np.isnan(data) * (distance_from_center < (r/2)))
+    sorted_invalid_distances = np.sort(invalid_distances[np.nonzero(invalid_distances)].ravel())
+    threshold_distance = sorted_invalid_distances[int(len(sorted_invalid_distances) * ID_threshold)]
+    data_copy = data.copy()
+    data_copy[distance_from_center < threshold_distance] = np.nan
+    return data_copy, threshold_distance
+
+@pytest.mark.parametrize('circle', [(130.3, 121.7, 80.4), (130.0, 122.0, 80.0), (30.5, 40.2, 80.4)])
+@pytest.mark.parametrize('ID_threshold', [0.5, 0.9, 0.99])
+def test_define_ID_matches_full_sort(frame, circle, ID_threshold):
+    data = frame.copy()
+    rng = np.random.default_rng(1)
+    data[rng.random(data.shape) < 0.02] = np.nan  # scattered dropouts around the ID
+    expected, threshold = full_sort_define_ID(data, circle, ID_threshold)
+    assert ID_threshold_distance(data, circle, ID_threshold) == threshold
+    np.testing.assert_array_equal(define_ID(data, circle, ID_threshold), expected)
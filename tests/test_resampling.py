@@ -0,0 +1,59 @@
+import numpy as np
+from scipy import interpolate
+
+from interferometer.resampling import ResamplingOperator, resampling_operator, resample_zernike_basis, match_zernike_basis
+
+from conftest import synthetic_basis
+
+def smooth_frame(n_rows, n_cols, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:n_rows, :n_cols] / max(n_rows, n_cols)
+    return np.sin(3 * x + rng.normal()) * np.cos(2 * y) + 0.01 * rng.normal(size=(n_rows, n_cols))
+
+def test_operator_matches_spline():
+    frame = smooth_frame(41, 37)
+    operator = ResamplingOperator(41, 37, 2.0, 30, 1.8)
+    ys, xs = np.linspace(-2.0, 2.0, 41), np.linspace(-2.0, 2.0, 37)
+    xi = np.linspace(-1.8, 1.8, 30)
+    expected = interpolate.RectBivariateSpline(ys, xs, frame)(xi, xi)
+    np.testing.assert_allclose(operator.apply(frame), expected, atol=1e-10 * np.ptp(frame))
+
+def test_stack_matches_frames():
+    stack = np.stack([smooth_frame(25, 25, seed=i) for i in range(3)])
+    operator = resampling_operator(25, 25, 1.0, 16, 1.0)
+    result = operator.apply(stack)
+    assert result.shape == (3, 16, 16)
+    for frame, resampled in zip(stack, result):
+        np.testing.assert_array_equal(resampled, operator.apply(frame))
+
+def test_float32_frames_stay_single_precision():
+    frame = smooth_frame(41, 37)
+    operator = ResamplingOperator(41, 37, 2.0, 30, 1.8)
+    single = operator.apply(frame, np.float32)
+    assert single.dtype == np.float32
+    assert operator.apply(frame.astype(np.float32)).dtype == np.float64  # float64 unless asked
+    np.testing.assert_allclose(single, operator.apply(frame), atol=1e-6 * np.ptp(frame))
+
+def test_operator_cached_per_geometry():
+    assert resampling_operator(20, 20, 1.0, 10, 1.0) is resampling_operator(20, 20, 1, 10, 1)
+
+def test_resampled_basis_layout_and_values():
+    Z = synthetic_basis(64, 6)
+    Z0, Z1 = resample_zernike_basis(Z, 32)
+    assert Z1.shape == (32, 32, 6) and Z0.shape == (32 * 32, 6)
+    assert np.shares_memory(Z0, Z1)
+    reference = synthetic_basis(32, 6)[1]
+    inside = ~np.isnan(reference[..., 0])
+    assert np.all(np.isfinite(Z1[inside]))
+    x = np.linspace(-1, 1, 32)
+    interior = np.hypot(x[np.newaxis, :], x[:, np.newaxis]) < 0.9  # edge pixels come from the nearest-filled copy
+    np.testing.assert_allclose(Z1[interior], reference[interior], atol=0.01)
+    corners = np.zeros((32, 32), dtype=bool)
+    corners[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+    assert np.all(np.isnan(Z1[corners]))
+
+def test_match_zernike_basis_passthrough_and_cache():
+    Z = synthetic_basis(32, 3)
+    assert match_zernike_basis(Z, 32) is Z
+    assert match_zernike_basis(None, 16) is None
+    assert match_zernike_basis(Z, 16) is match_zernike_basis(Z, 16)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import numpy as np
+
+from interferometer import surface_cache
+from interferometer.data_loader import load_single_surface, STD_FILENAME
+from interferometer.interferometer_utils import setup_paths
+from interferometer.resampling import match_zernike_basis
+from interferometer.session_archive import write_session_archive, SessionArchive, is_session_archive, SESSION_ARCHIVE_EXT
+from interferometer.surface_processing import read_genraw_data
+from interferometer.zernike_fit import decompose_surfaces
+
+from conftest import write_frame
+
+CLEAR_OUTER, CLEAR_INNER = 0.381, 0.032
+
+def test_archive_round_trip(tmp_path, basis):
+    folder = tmp_path / '20250101' / '0'
+    folder.mkdir(parents=True)
+    for i in range(3):
+        write_frame(folder / f'{i}.h5', center=(262 + i % 2, 238), seed=i)
+    folder = str(folder)
+
+    path = write_session_archive(folder, CLEAR_OUTER, CLEAR_INNER, basis)
+    assert path == folder + SESSION_ARCHIVE_EXT and is_session_archive(path)
+    surface = np.load(os.path.join(folder, 'averaged_surface.npy'))
+    std = np.load(os.path.join(folder, STD_FILENAME))
+    raw = read_genraw_data(os.path.join(folder, '1.h5'))
+    circles = [surface_cache.load_frame_entry(os.path.join(folder, f'{i}.h5'))['circle'] for i in range(3)]
+
+    with SessionArchive(path) as archive:
+        assert archive.frame_names == ['0.h5', '1.h5', '2.h5']
+        assert archive.params['clear_outer'] == CLEAR_OUTER
+        np.testing.assert_array_equal(archive.frame(1)[()], raw)
+        np.testing.assert_array_equal(archive.frame('1.h5')[10:20], raw[10:20])
+        np.testing.assert_array_equal(archive.circles[()], circles)
+        assert archive.ID.shape == (3,)
+        np.testing.assert_array_equal(archive.surface[()], surface)
+        np.testing.assert_array_equal(archive.surface_std[()], std)
+        np.testing.assert_allclose(archive.coefficients[()], decompose_surfaces(surface, match_zernike_basis(basis, surface.shape[0]))[0])
+
+    # Once the folder is gone, the archive stands in for it
+    shutil.rmtree(folder)
+    np.testing.assert_array_equal(load_single_surface(path, clear_outer=CLEAR_OUTER, clear_inner=CLEAR_INNER, Z=basis), surface)
+    assert setup_paths(str(tmp_path), False, -1, -1) == path
+    assert setup_paths(str(tmp_path), False, '20250101', '0') == path
@@ -0,0 +1,64 @@
+import os
+import time
+import pytest
+
+from interferometer import session_index
+from interferometer.session_index import (build_session_index, load_session_index, current_session_index, index_is_current,
+                                          list_dates, list_instances, session_path, frame_count)
+
+from conftest import write_frame
+
+@pytest.fixture
+def mirror_path(tmp_path):
+    for date, instance, n_frames in [('20250101', '0', 2), ('20250101', '1', 1), ('20250102', '0', 3)]:
+        folder = tmp_path / date / instance
+        folder.mkdir(parents=True)
+        for i in range(n_frames):
+            write_frame(folder / f'{i}.h5', shape=(40, 48), center=(24, 20), radius=15, inner_radius=2, seed=i)
+    return str(tmp_path)
+
+def test_index_lists_sessions(mirror_path):
+    index = build_session_index(mirror_path)
+    assert list_dates(index) == ['20250101', '20250102']
+    assert list_instances(index, '20250101') == ['0', '1']
+    assert frame_count(index, '20250102', '0') == 3
+    assert session_path(index, '20250102', '0') == os.path.join(os.path.abspath(mirror_path), '20250102', '0')
+    frame = index['sessions']['20250101/0']['frames']['0.h5']
+    assert frame['shape'] == [40, 48]
+    assert load_session_index(mirror_path)['sessions'] == index['sessions']
+
+def test_saved_index_is_reused_while_current(mirror_path, monkeypatch):
+    build_session_index(mirror_path)
+    assert index_is_current(load_session_index(mirror_path), mirror_path)
+
+    def no_rescan(*args, **kwargs):
+        raise AssertionError("current index was rescanned")
+    monkeypatch.setattr(session_index, 'build_session_index', no_rescan)
+    assert list_dates(current_session_index(mirror_path)) == ['20250101', '20250102']
+
+@pytest.mark.parametrize('change', ['frame', 'session', 'date'])
+def test_changes_trigger_a_rescan(mirror_path, change):
+    build_session_index(mirror_path)
+    time.sleep(0.01)
+    if change == 'frame':
+        write_frame(os.path.join(mirror_path, '20250101', '1', '5.h5'), shape=(40, 48), center=(24, 20), radius=15)
+    elif change == 'session':
+        os.makedirs(os.path.join(mirror_path, '20250102', '1'))
+    else:
+        os.makedirs(os.path.join(mirror_path, '20250103', '0'))
+    assert not index_is_current(load_session_index(mirror_path), mirror_path)
+    index = current_session_index(mirror_path)
+    assert index_is_current(index, mirror_path)
+    if change == 'frame':
+        assert frame_count(index, '20250101', '1') == 2
+    else:
+        assert len(index['sessions']) == 4
+
+def test_rescan_reads_only_new_frames(mirror_path, monkeypatch):
+    build_session_index(mirror_path)
+    write_frame(os.path.join(mirror_path, '20250102', '0', '9.h5'), shape=(40, 48), center=(24, 20), radius=15)
+    read = []
+    original = session_index._read_frame_metadata
+    monkeypatch.setattr(session_index, '_read_frame_metadata', lambda path: read.append(path) or original(path))
+    build_session_index(mirror_path)
+    assert [os.path.basename(path) for path in read] == ['9.h5']
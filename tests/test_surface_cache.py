@@ -0,0 +1,60 @@
+import os
+import numpy as np
+
+from interferometer import surface_cache
+from interferometer.data_loader import _processing_params
+
+from conftest import write_frame, synthetic_basis
+
+PARAMS = {'clear_outer': 0.381, 'clear_inner': 0.04}
+
+def test_key_depends_on_params_inputs_and_basis(session_folder):
+    key = surface_cache.cache_key(session_folder, PARAMS)
+    assert key == surface_cache.cache_key(session_folder, dict(PARAMS))
+    assert key != surface_cache.cache_key(session_folder, {**PARAMS, 'clear_inner': 0.05})
+    assert key != surface_cache.cache_key(session_folder, PARAMS, synthetic_basis(16, 3))
+    write_frame(os.path.join(session_folder, '9.h5'), seed=9)
+    assert key != surface_cache.cache_key(session_folder, PARAMS)
+
+def test_circle_tolerance_is_part_of_the_key(session_folder):
+    exact = _processing_params(0.381, 0.032, 1.25)
+    reused = _processing_params(0.381, 0.032, 1.25, circle_tolerance=0.5)
+    assert exact['circle_tolerance'] == 0.0
+    assert surface_cache.cache_key(session_folder, exact) != surface_cache.cache_key(session_folder, reused)
+
+def test_store_and_load_surface(tmp_path):
+    surface, std = np.arange(16.0).reshape(4, 4), np.ones((4, 4))
+    surface_cache.store_cached_surface(str(tmp_path), 'abc', surface, std, PARAMS)
+    np.testing.assert_array_equal(surface_cache.load_cached_surface(str(tmp_path), 'abc'), surface)
+    cached, cached_std = surface_cache.load_cached_surface(str(tmp_path), 'abc', with_std=True)
+    np.testing.assert_array_equal(cached_std, std)
+    assert surface_cache.load_cached_surface(str(tmp_path), 'missing') is None
+
+def test_lru_eviction(tmp_path):
+    for i in range(3):
+        surface_cache.store_cached_surface(str(tmp_path), f'key{i}', np.full((2, 2), i), max_entries=2)
+    assert surface_cache.load_cached_surface(str(tmp_path), 'key0') is None
+    assert surface_cache.load_cached_surface(str(tmp_path), 'key2') is not None
+    surface_cache.clear_cache(str(tmp_path))
+    assert surface_cache.load_cached_surface(str(tmp_path), 'key2') is None
+
+def test_frame_entry_round_trip_and_staleness(tmp_path):
+    path = write_frame(tmp_path / 'frame.h5')
+    wf_map = np.random.default_rng(0).normal(size=(8, 8))
+    surface_cache.store_frame_entry(path, [1.0, 2.0, 3.0], 4.0, wf_map, [1.0, 2.0, 3.0], 'digest')
+    entry = surface_cache.load_frame_entry(path)
+    np.testing.assert_array_equal(entry['circle'], [1.0, 2.0, 3.0])
+    assert entry['ID'] == 4.0 and entry['map_digest'] == 'digest'
+    np.testing.assert_array_equal(surface_cache.load_frame_map(path), wf_map)
+
+    write_frame(path, seed=1)  # rewritten frame: the fingerprint no longer matches
+    os.utime(path, ns=(0, 0))
+    assert surface_cache.load_frame_entry(path) is None
+
+def test_frame_map_reuse_is_exact_by_default():
+    entry = {'map_circle': np.array([100.0, 100.0, 50.0]), 'map_digest': 'd'}
+    assert surface_cache.frame_map_is_current(entry, [100.0, 100.0, 50.0], 'd')
+    assert not surface_cache.frame_map_is_current(entry, [100.2, 100.0, 50.0], 'd')
+    assert surface_cache.frame_map_is_current(entry, [100.2, 100.0, 50.0], 'd', circle_tolerance=0.5)
+    assert not surface_cache.frame_map_is_current(entry, [100.0, 100.0, 50.0], 'other')
+    assert not surface_cache.frame_map_is_current(None, [100.0, 100.0, 50.0], 'd')
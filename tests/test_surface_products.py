@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from interferometer.surface_processing import SurfaceProducts, SURFACE_PRESETS, prepare_surface, radial_averaged_surface
+
+from conftest import synthetic_basis
+
+CONFIG = {'OD': 32 * 25.4e-3, 'ID': 3 * 25.4e-3}
+
+@pytest.fixture(scope='module')
+def surface_and_basis():
+    Z = synthetic_basis(96, 45)  # the edge-correction presets use modes up to 44
+    rng = np.random.default_rng(0)
+    surface = np.einsum('ijk,k->ij', Z[1], rng.normal(size=45) * 0.1) + 0.01 * rng.normal(size=(96, 96))
+    return surface, Z
+
+@pytest.mark.parametrize('name', list(SURFACE_PRESETS))
+@pytest.mark.parametrize('crop_ca', [False, True])
+def test_presets_match_prepare_surface(surface_and_basis, name, crop_ca):
+    surface, Z = surface_and_basis
+    remove_coef, subtract_radial = SURFACE_PRESETS[name]
+    base = surface - radial_averaged_surface(surface, CONFIG) if subtract_radial else surface
+    expected = prepare_surface(base, Z, remove_coef, CONFIG, crop_ca=crop_ca)
+    np.testing.assert_allclose(SurfaceProducts(surface, Z, CONFIG).preset(name, crop_ca), expected, atol=1e-12, equal_nan=True)
+
+def test_products_fit_once_and_are_cached(surface_and_basis):
+    surface, Z = surface_and_basis
+    products = SurfaceProducts(surface, Z, CONFIG)
+    first = {name: products.preset(name) for name in SURFACE_PRESETS}
+    assert set(products._coefficients) == {False, True}  # one fit per base surface
+    for name in SURFACE_PRESETS:
+        assert products.preset(name) is first[name]
@@ -0,0 +1,76 @@
+import importlib
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt5')
+from PyQt5.QtCore import QCoreApplication
+
+from interferometer.gui.workers import MeasurementWorker, LoadSurfaceWorker
+from interferometer.surface_processing import FULL_GRID_SIZE, QUICK_LOOK_GRID_SIZE
+
+@pytest.fixture(scope='module')
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    #Replace everything a worker touches outside itself; returns a log of the calls
+    calls = {'measurements': 0, 'bases': [], 'loads': [], 'indexes': 0}
+    config = importlib.import_module('interferometer.config')
+    utils = importlib.import_module('interferometer.interferometer_utils')
+    loader = importlib.import_module('interferometer.data_loader')
+    store = importlib.import_module('interferometer.zernike_store')
+    index = importlib.import_module('interferometer.session_index')
+
+    monkeypatch.setattr(config, 'get_mirror_params', lambda num: {'OD': 0.8128, 'ID': 0.0762, 'base_path': str(tmp_path)})
+    monkeypatch.setattr(utils, 'setup_paths', lambda *args, **kwargs: str(tmp_path / 'session'))
+
+    def take_new_measurement(save_subfolder, number_alignment_iterations=7):
+        calls['measurements'] += 1
+    monkeypatch.setattr(utils, 'take_new_measurement', take_new_measurement)
+
+    def get_zernike_basis(n_modes, outer, inner, grid_size=FULL_GRID_SIZE, directory=None):
+        calls['bases'].append(grid_size)
+        return ('basis', grid_size)
+    monkeypatch.setattr(store, 'get_zernike_basis', get_zernike_basis)
+
+    def load_single_surface(path, **kwargs):
+        calls['loads'].append(kwargs)
+        return np.zeros((kwargs['grid_size'],) * 2)
+    monkeypatch.setattr(loader, 'load_single_surface', load_single_surface)
+
+    def current_session_index(path):
+        calls['indexes'] += 1
+        return {'sessions': {}}
+    monkeypatch.setattr(index, 'current_session_index', current_session_index)
+    return calls
+
+def run_worker(worker):
+    results, errors = [], []
+    worker.finished.connect(results.append)
+    worker.error.connect(errors.append)
+    worker.run()
+    assert errors == []
+    assert len(results) == 1
+    return results[0]
+
+@pytest.mark.parametrize('quick_look, grid_size', [(False, FULL_GRID_SIZE), (True, QUICK_LOOK_GRID_SIZE)])
+def test_measurement_worker(app, pipeline, quick_look, grid_size):
+    worker = MeasurementWorker(22, True, -1, -1, None, 3, quick_look=quick_look)
+    result = run_worker(worker)
+    assert pipeline['measurements'] == 1
+    assert pipeline['bases'] == [grid_size]
+    assert pipeline['loads'][0]['grid_size'] == grid_size
+    assert result['grid_size'] == grid_size and result['Z'] == ('basis', grid_size)
+    assert result['surface'].shape == (grid_size, grid_size)
+
+def test_measurement_worker_defaults_to_full_grid(app, pipeline):
+    assert MeasurementWorker(22, False, -1, -1, None, 3).quick_look is False
+
+@pytest.mark.parametrize('quick_look, grid_size', [(False, FULL_GRID_SIZE), (True, QUICK_LOOK_GRID_SIZE)])
+def test_load_surface_worker(app, pipeline, quick_look, grid_size):
+    worker = LoadSurfaceWorker(22, -1, -1, quick_look=quick_look)
+    result = run_worker(worker)
+    assert pipeline['indexes'] == 1 and pipeline['measurements'] == 0
+    assert pipeline['bases'] == [grid_size]
+    assert result['grid_size'] == grid_size and result['surface'].shape == (grid_size, grid_size)
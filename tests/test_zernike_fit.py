@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from interferometer import zernike_fit
+from interferometer.zernike_fit import (fit_operator, fit_zernike, decompose_surfaces, remove_zernike_modes,
+                         synthesize_modes, mode_synthesizer, basis_valid_rows, clear_fit_operators)
+
+def lstsq_coefficients(Z, surface):
+    valid = ~np.isnan(surface.ravel()) & ~np.isnan(Z[0]).any(axis=1)
+    return np.linalg.lstsq(Z[0][valid], surface.ravel()[valid], rcond=None)[0]
+
+def random_surface(Z, seed=0, noise=0.0):
+    rng = np.random.default_rng(seed)
+    coefs = rng.normal(size=Z[0].shape[1])
+    surface = np.einsum('ijk,k->ij', Z[1], coefs) + noise * rng.normal(size=Z[1].shape[:2])
+    return surface, coefs
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    clear_fit_operators()
+    yield
+    clear_fit_operators()
+
+def test_fit_matches_lstsq(basis):
+    surface, _ = random_surface(basis, noise=0.1)
+    surface[:20, :20] = np.nan
+    M = surface.ravel(), surface
+    flat, fitted, coefs = fit_zernike(basis, M)
+    np.testing.assert_allclose(coefs, lstsq_coefficients(basis, surface), atol=1e-10)
+    np.testing.assert_allclose(fitted, np.einsum('ijk,k->ij', basis[1], coefs), atol=1e-12)
+    assert np.shares_memory(flat, fitted) or np.array_equal(flat, fitted.ravel(), equal_nan=True)
+
+def test_exact_surface_recovers_coefficients(basis):
+    surface, coefs = random_surface(basis)
+    np.testing.assert_allclose(fit_zernike(basis, (surface.ravel(), surface))[2], coefs, atol=1e-10)
+
+def test_stack_coefficients_match_single(basis):
+    surfaces = np.stack([random_surface(basis, seed=i, noise=0.1)[0] for i in range(3)])
+    operator = fit_operator(basis, basis_valid_rows(basis))
+    stacked = operator.coefficients(surfaces)
+    assert stacked.shape == (3, basis[0].shape[1])
+    for surface, row in zip(surfaces, stacked):
+        np.testing.assert_allclose(row, operator.coefficients(surface), atol=1e-12)
+
+def test_operator_cached_per_mask(basis):
+    valid = basis_valid_rows(basis)
+    assert fit_operator(basis, valid) is fit_operator(basis, valid.copy())
+    other = valid.copy()
+    other[np.flatnonzero(valid)[0]] = False
+    assert fit_operator(basis, other) is not fit_operator(basis, valid)
+
+def test_remove_modes_matches_manual(basis):
+    surface, coefs = random_surface(basis, noise=0.1)
+    modes = [0, 1, 2, 4]
+    expected = surface - np.einsum('ijk,k->ij', basis[1][:, :, modes], coefs[modes])
+    np.testing.assert_allclose(remove_zernike_modes(basis, surface, coefs, modes), expected, atol=1e-12)
+    np.testing.assert_allclose(synthesize_modes(basis, coefs, modes), surface - expected, atol=1e-12)
+
+def test_remove_modes_stack_and_in_place(basis):
+    surfaces = np.stack([random_surface(basis, seed=i)[0] for i in range(4)])
+    coefs = np.random.default_rng(1).normal(size=(4, basis[0].shape[1]))
+    modes = [3, 5]
+    expected = np.stack([remove_zernike_modes(basis, s, c, modes) for s, c in zip(surfaces, coefs)])
+    np.testing.assert_allclose(remove_zernike_modes(basis, surfaces, coefs, modes), expected, atol=1e-12)
+    in_place = surfaces.copy()
+    assert remove_zernike_modes(basis, in_place, coefs, modes, out=in_place) is in_place
+    np.testing.assert_allclose(in_place, expected, atol=1e-12)
+
+def test_remove_no_modes_copies(basis):
+    surface, coefs = random_surface(basis)
+    result = remove_zernike_modes(basis, surface, coefs, [])
+    np.testing.assert_array_equal(result, surface)
+    assert result is not surface
+
+def test_scratch_stays_single_surface(basis):
+    surfaces = np.stack([random_surface(basis, seed=i)[0] for i in range(5)])
+    coefs = np.zeros((5, basis[0].shape[1]))
+    remove_zernike_modes(basis, surfaces, coefs, [0, 1])
+    assert mode_synthesizer(basis)._local.buffer.shape == basis[1].shape[:2]
+
+def test_decompose_surfaces_groups_masks(basis):
+    surfaces = np.stack([random_surface(basis, seed=i, noise=0.1)[0] for i in range(4)])
+    surfaces[1:3, :10, :] = np.nan  # a second mask shared by two surfaces
+    coefs, rms = decompose_surfaces(surfaces, basis, residual_rms=True)
+    assert coefs.shape == (4, basis[0].shape[1])
+    for surface, row in zip(surfaces, coefs):
+        np.testing.assert_allclose(row, lstsq_coefficients(basis, surface), atol=1e-10)
+    assert len(zernike_fit._fit_operators) == 2
+    assert np.all(rms > 0) and np.all(rms < 0.2)
+
+def test_decompose_surfaces_too_few_pixels_is_nan(basis):
+    good, _ = random_surface(basis)
+    empty = np.full_like(good, np.nan)
+    empty[32, 30:35] = 1.0  # fewer valid pixels than modes
+    coefs = decompose_surfaces([good, empty], basis)
+    assert np.all(np.isfinite(coefs[0]))
+    assert np.all(np.isnan(coefs[1]))
+
+def test_decompose_surfaces_masked_arrays_and_single(basis):
+    surface, coefs = random_surface(basis)
+    masked = np.ma.masked_invalid(surface)
+    np.testing.assert_allclose(decompose_surfaces([masked], basis)[0], coefs, atol=1e-10)
+    np.testing.assert_allclose(decompose_surfaces(surface, basis)[0], coefs, atol=1e-10)
+
+def test_decompose_surfaces_rejects_wrong_grid(basis):
+    with pytest.raises(ValueError):
+        decompose_surfaces(np.zeros((2, 10, 10)), basis)
@@ -0,0 +1,258 @@
+"""
+Precomputed least-squares Zernike fits for a fixed valid-pixel mask.
+
+Zernike_decomposition solves a fresh least-squares problem for every surface,
+although within a session (and for every frame formatted with the same pupil)
+the valid-pixel mask is identical and only the right-hand side changes.
+ZernikeFitOperator factors the masked basis once (thin QR, kept as the
+pseudo-inverse) so fitting one surface, or a matrix of many, is a single
+matrix product.  Operators are cached per basis and mask fingerprint by
+fit_operator; fit_zernike is a drop-in replacement for
+``Zernike_decomposition(Z, M, -1)``.
+
+ModeSynthesizer is the matching reconstruction side: ``sum_k c_k Z_k`` over
+any subset of modes, for one surface or a stack, as one matrix product from
+contiguous per-subset mode rows.  remove_zernike_modes subtracts such a sum
+through a reused single-surface scratch buffer instead of one full-size
+temporary per mode.
+
+decompose_surfaces fits a whole batch (e.g. a TEC training sweep): surfaces
+are grouped by valid-pixel mask so each group's operator is factored once,
+and the result is an (N, n_modes) coefficient matrix.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.linalg as sl
+
+FIT_OPERATOR_CACHE_SIZE = 4  # a full-grid operator holds n_modes x n_valid values (~70 MB in float64)
+MODE_SUBSET_CACHE_SIZE = 4   # contiguous mode rows kept per basis, one entry per mode subset
+TIP_TILT_POWER_MODES = (0, 1, 2, 4)  # piston, tip/tilt, and power
+
+# (id(Z[0]), mask fingerprint) -> (Z[0], operator); the basis is held so its id stays valid
+_fit_operators = OrderedDict()
+# id(Z[0]) -> (Z[0], rows where every mode is finite)
+_basis_rows = {}
+# id(Z[0]) -> (Z[0], ModeSynthesizer)
+_synthesizers = {}
+
+def mask_fingerprint(valid):
+    #Short digest of a boolean pixel mask
+    valid = np.asarray(valid, dtype=bool)
+    return f"{valid.size}:{hashlib.sha1(np.packbits(valid).tobytes()).hexdigest()}"
+
+def basis_valid_rows(Z):
+    #Flat mask of the pixels where every mode of the basis is defined (cached per basis)
+    entry = _basis_rows.get(id(Z[0]))
+    if entry is None or entry[0] is not Z[0]:
+        if len(_basis_rows) >= FIT_OPERATOR_CACHE_SIZE:
+            _basis_rows.pop(next(iter(_basis_rows)))
+        entry = (Z[0], ~np.isnan(Z[0]).any(axis=1))
+        _basis_rows[id(Z[0])] = entry
+    return entry[1]
+
+class ZernikeFitOperator:
+    """
+    Least-squares Zernike fit restricted to one flat valid-pixel mask.
+
+    The masked basis is factored in double precision; the stored pseudo-inverse
+    takes the basis dtype, so float32 bases keep fitting in single precision.
+    """
+
+    def __init__(self, Z, valid):
+        self.Z = Z
+        self.valid = np.asarray(valid, dtype=bool).ravel()
+        A = np.asarray(Z[0][self.valid], dtype=np.float64)  # a fresh copy, so the QR may overwrite it
+        q, r = sl.qr(A, mode='economic', overwrite_a=True, check_finite=False)
+        self.pinv = sl.solve_triangular(r, q.T, check_finite=False).astype(Z[0].dtype, copy=False)  # (n_modes, n_valid)
+
+    @property
+    def n_modes(self):
+        return self.pinv.shape[0]
+
+    def coefficients(self, surfaces):
+        """
+        Coefficients of one surface (flat or 2D) as (n_modes,), or of a stack
+        (N, H, W) / (N, n_pixels) as (N, n_modes).
+        """
+        surfaces = np.asarray(surfaces)
+        single = surfaces.ndim == 1 or surfaces.shape == self.Z[1].shape[:2]
+        Y = surfaces.reshape(1 if single else len(surfaces), -1)[:, self.valid]
+        coefs = Y @ self.pinv.T
+        return coefs[0] if single else coefs
+
+    def decompose(self, M):
+        #Same (flat fit, 2D fit, coefficients) tuple as Zernike_decomposition(Z, M, -1)
+        coefs = self.coefficients(M[0])
+        fit = mode_synthesizer(self.Z).synthesize(coefs)
+        return fit.ravel(), fit, coefs
+
+def fit_operator(Z, valid):
+    #Cached ZernikeFitOperator for a basis and flat valid-pixel mask
+    key = (id(Z[0]), mask_fingerprint(valid))
+    entry = _fit_operators.get(key)
+    if entry is None or entry[0] is not Z[0]:
+        entry = (Z[0], ZernikeFitOperator(Z, valid))
+        _fit_operators[key] = entry
+        while len(_fit_operators) > FIT_OPERATOR_CACHE_SIZE:
+            _fit_operators.popitem(last=False)
+    else:
+        _fit_operators.move_to_end(key)
+    return entry[1]
+
+def clear_fit_operators():
+    _fit_operators.clear()
+    _basis_rows.clear()
+    _synthesizers.clear()
+
+def surface_fit_operator(Z, surface):
+    #Operator for the pixels where both the surface and the basis are defined
+    return fit_operator(Z, ~np.isnan(np.ravel(surface)) & basis_valid_rows(Z))
+
+def fit_zernike(Z, M):
+    #Drop-in for Zernike_decomposition(Z, M, -1), reusing the factored basis for M's mask
+    return surface_fit_operator(Z, M[0]).decompose(M)
+
+def decompose_surfaces(surfaces, Z, residual_rms=False):
+    """
+    Zernike coefficients of many surfaces at once.
+
+    Parameters
+    ----------
+    surfaces : ndarray or sequence
+        (N, H, W) stack, a single (H, W) surface, or a sequence of (H, W) surfaces (NaN
+        or numpy masked arrays marking invalid pixels), on the grid of Z
+    Z : tuple
+        Zernike matrix tuple
+    residual_rms : bool
+        Also return the RMS of each surface minus its fit, over its valid pixels
+
+    Returns
+    -------
+    coefs : ndarray
+        (N, n_modes) coefficients; rows of surfaces with fewer valid pixels than modes are NaN
+    rms : ndarray
+        (N,) residual RMS, only if residual_rms
+    """
+    if isinstance(surfaces, np.ndarray) and not np.ma.isMaskedArray(surfaces):
+        stack = surfaces if surfaces.ndim == 3 else surfaces[np.newaxis]  # no copy of an array stack
+    else:
+        stack = np.stack([np.ma.filled(np.ma.asarray(surface, dtype=float), np.nan) for surface in surfaces])
+    if stack.shape[1:] != Z[1].shape[:2]:
+        raise ValueError(f"Surfaces of shape {stack.shape[1:]} do not match the {Z[1].shape[:2]} basis grid")
+    flat = stack.reshape(len(stack), -1)
+    defined = basis_valid_rows(Z)
+    n_modes = Z[0].shape[1]
+
+    groups = {}
+    for i, surface in enumerate(flat):
+        valid = ~np.isnan(surface) & defined
+        groups.setdefault(mask_fingerprint(valid), (valid, []))[1].append(i)
+
+    coefs = np.full((len(flat), n_modes), np.nan, dtype=np.result_type(flat, Z[0]))
+    rms = np.full(len(flat), np.nan)
+    for valid, members in groups.values():
+        if valid.sum() < n_modes:
+            continue
+        block = flat if len(members) == len(flat) else flat[members]
+        coefs[members] = fit_operator(Z, valid).coefficients(block)
+        if residual_rms:
+            residual = block[:, valid] - synthesize_modes(Z, coefs[members]).reshape(len(members), -1)[:, valid]
+            rms[members] = np.sqrt(np.mean(residual**2, axis=1))
+    return (coefs, rms) if residual_rms else coefs
+
+class ModeSynthesizer:
+    """
+    Reconstruction of Zernike mode sums for one basis.
+
+    Coefficients are always full vectors (n_modes,) or stacks (N, n_modes); `modes`
+    picks the indices that take part (None for all of them). The rows of each subset
+    are copied once into a contiguous (k, n_pixels) block, so a sum over k modes reads
+    k contiguous rows instead of k strided planes of the 3D matrix.
+    """
+
+    def __init__(self, Z):
+        self.Z = Z
+        self.shape = Z[1].shape[:2]
+        self._rows = OrderedDict()
+        self._local = threading.local()  # per-thread scratch, the GUI fits from several threads
+
+    def mode_rows(self, modes=None):
+        #(k, n_pixels) rows of the selected modes
+        if modes is None:
+            return self.Z[0].T
+        key = tuple(int(k) for k in modes)
+        rows = self._rows.get(key)
+        if rows is None:
+            rows = np.ascontiguousarray(self.Z[0][:, list(key)].T)
+            self._rows[key] = rows
+            while len(self._rows) > MODE_SUBSET_CACHE_SIZE:
+                self._rows.popitem(last=False)
+        else:
+            self._rows.move_to_end(key)
+        return rows
+
+    def synthesize(self, coefs, modes=None, out=None):
+        """
+        sum_k coefs[..., k] * Z_k over the selected modes, as (H, W) or (N, H, W).
+
+        out, if given, must be a C-contiguous array of that shape and is filled in place.
+        """
+        coefs = np.asarray(coefs)
+        rows = self.mode_rows(modes)
+        c = coefs if modes is None else coefs[..., list(modes)]
+        shape = coefs.shape[:-1] + self.shape
+        if out is None:
+            out = np.empty(shape, dtype=np.result_type(c, rows))
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError(f"Output buffer must be C-contiguous with shape {shape}")
+        np.matmul(c, rows, out=out.reshape(coefs.shape[:-1] + (rows.shape[1],)))
+        return out
+
+    def _scratch(self, dtype):
+        #One (H, W) buffer per thread, so the memory kept per synthesizer does not grow with the stacks seen
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or buffer.dtype != dtype:
+            buffer = self._local.buffer = np.empty(self.shape, dtype=dtype)
+        return buffer
+
+    def remove(self, surfaces, coefs, modes=None, out=None):
+        #surfaces minus the selected modes (all if None); out may be the surfaces themselves to subtract in place.
+        #Stacks are processed one surface at a time through the single-surface scratch buffer.
+        surfaces = np.asarray(surfaces)
+        if modes is not None and len(modes) == 0:
+            if out is None:
+                return surfaces.copy()
+            np.copyto(out, surfaces)
+            return out
+        coefs = np.asarray(coefs)
+        scratch = self._scratch(np.result_type(coefs, self.Z[0]))
+        if coefs.ndim == 1:
+            self.synthesize(coefs, modes, out=scratch)
+            return np.subtract(surfaces, scratch, out=out)
+        if out is None:
+            out = np.empty(surfaces.shape, dtype=np.result_type(surfaces, scratch))
+        for surface, c, result in zip(surfaces, coefs, out):
+            self.synthesize(c, modes, out=scratch)
+            np.subtract(surface, scratch, out=result)
+        return out
+
+def mode_synthesizer(Z):
+    #Cached ModeSynthesizer for a basis
+    entry = _synthesizers.get(id(Z[0]))
+    if entry is None or entry[0] is not Z[0]:
+        if len(_synthesizers) >= FIT_OPERATOR_CACHE_SIZE:
+            _synthesizers.pop(next(iter(_synthesizers)))
+        entry = (Z[0], ModeSynthesizer(Z))
+        _synthesizers[id(Z[0])] = entry
+    return entry[1]
+
+def synthesize_modes(Z, coefs, modes=None, out=None):
+    #sum_k c_k Z_k over `modes` (all modes if None) for one coefficient vector or an (N, n_modes) stack
+    return mode_synthesizer(Z).synthesize(coefs, modes, out)
+
+def remove_zernike_modes(Z, surfaces, coefs, modes, out=None):
+    #Surface (H, W) or stack (N, H, W) with the fitted `modes` subtracted; replaces remove_modes(M, C, Z, modes)
+    return mode_synthesizer(Z).remove(surfaces, coefs, modes, out)
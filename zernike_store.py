@@ -0,0 +1,127 @@
+"""
+Persistent store of Zernike bases, shared by every process on the machine.
+
+General_zernike_matrix is slow, and the same few geometries are rebuilt by every
+script, worker and GUI action.  get_zernike_basis generates a basis once per
+(mode count, outer radius, inner radius, grid size), saves its arrays as .npy
+files in the store directory and memory-maps them on every later call.  The
+maps are copy-on-write, so all processes using a basis share one copy of its
+pages while callers can still modify their view.  Bases on grids other than
+FULL_GRID_SIZE are resampled from the full-size entry (see
+resampling.match_zernike_basis) and stored as their own entries.
+
+The store lives in DEFAULT_STORE_DIR unless the INTERFEROMETER_BASIS_DIR
+environment variable points elsewhere.  Entries are written to temporary
+files and renamed into place, with the metadata file last, so a reader never
+sees a partial entry.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from .surface_processing import FULL_GRID_SIZE
+    from .resampling import resample_zernike_basis
+except ImportError:
+    from surface_processing import FULL_GRID_SIZE
+    from resampling import resample_zernike_basis
+
+STORE_DIR_ENV = 'INTERFEROMETER_BASIS_DIR'
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.interferometer', 'zernike_bases')
+STORE_VERSION = 1
+
+# Bases already opened by this process, by metadata path
+_open_bases = {}
+
+def store_dir():
+    return os.environ.get(STORE_DIR_ENV, DEFAULT_STORE_DIR)
+
+def basis_name(n_modes, outer_radius, inner_radius, grid_size=FULL_GRID_SIZE):
+    #File name stem of a stored basis
+    return f"zernike_v{STORE_VERSION}_{n_modes}modes_{outer_radius:g}_{inner_radius:g}_{grid_size}px"
+
+def _save_array(path, array):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, np.asarray(array), allow_pickle=False)
+    os.replace(tmp, path)
+
+def save_basis(meta_path, Z):
+    """
+    Write a Zernike matrix tuple to the store.
+
+    The flat matrix is not written when it is just the 3D matrix reshaped; it is then
+    rebuilt as a view of the mapped 3D matrix, so both share the same pages.
+    """
+    Z1 = np.asarray(Z[1])
+    flat_shape = (Z1.shape[0] * Z1.shape[1], Z1.shape[2])
+    flat_is_view = np.shape(Z[0]) == flat_shape and np.array_equal(Z[0], Z1.reshape(flat_shape), equal_nan=True)
+    stem = meta_path[:-len('.json')]
+    for i, element in enumerate(Z):
+        if not (i == 0 and flat_is_view):
+            _save_array(f"{stem}.{i}.npy", element)
+    tmp = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump({'version': STORE_VERSION, 'n_elements': len(Z), 'flat_is_view': flat_is_view}, f)
+    os.replace(tmp, meta_path)
+
+def load_basis(meta_path):
+    #Memory-map a stored basis (cached per process); raises OSError if it is not in the store
+    if meta_path in _open_bases:
+        return _open_bases[meta_path]
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    stem = meta_path[:-len('.json')]
+    elements = [None if (i == 0 and meta['flat_is_view']) else np.load(f"{stem}.{i}.npy", mmap_mode='c')
+                for i in range(meta['n_elements'])]
+    if meta['flat_is_view']:
+        Z1 = elements[1]
+        elements[0] = Z1.reshape(Z1.shape[0] * Z1.shape[1], Z1.shape[2])
+    Z = tuple(elements)
+    _open_bases[meta_path] = Z
+    return Z
+
+def stored_basis_path(Z):
+    #Metadata path of a basis returned by load_basis, or None for bases built elsewhere
+    for meta_path, stored in _open_bases.items():
+        if stored is Z:
+            return meta_path
+    return None
+
+def get_zernike_basis(n_modes, outer_radius, inner_radius, grid_size=FULL_GRID_SIZE, directory=None):
+    """
+    Zernike matrix tuple for an annular aperture, generated at most once per geometry.
+
+    Parameters
+    ----------
+    n_modes, outer_radius, inner_radius :
+        Arguments of General_zernike_matrix (radii in um, as everywhere else in the package)
+    grid_size : int
+        Side of the square grid; other sizes than FULL_GRID_SIZE are resampled from the full basis
+    directory : str or None
+        Store directory, default store_dir()
+    """
+    directory = store_dir() if directory is None else directory
+    meta_path = os.path.join(directory, basis_name(n_modes, outer_radius, inner_radius, grid_size) + '.json')
+    try:
+        return load_basis(meta_path)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if grid_size == FULL_GRID_SIZE:
+        from shared.General_zernike_matrix import General_zernike_matrix
+        print(f"Generating {n_modes}-mode Zernike basis ({outer_radius:g} / {inner_radius:g}); it will be stored in {directory}")
+        Z = General_zernike_matrix(n_modes, outer_radius, inner_radius)
+    else:
+        Z = resample_zernike_basis(get_zernike_basis(n_modes, outer_radius, inner_radius, FULL_GRID_SIZE, directory), grid_size)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        save_basis(meta_path, Z)
+    except OSError as e:
+        print(f"Could not store the Zernike basis ({e}); using it from memory")
+        return Z
+    return load_basis(meta_path)